@@ -8,11 +8,269 @@ import os
 from pathlib import Path
 import pandas as pd
 from datetime import datetime, timedelta, date
-import zipfile
 from unicodedata import normalize
 
 # Importar la clase desde functions.py
-from functions import EmailImageDownloader
+from functions import EmailImageDownloader, ImapSessionPool, ResultsZipPackager, SearchResultCache, ThumbnailCache
+
+# Tamaño máximo del ZIP que se ofrece como descarga directa (st.download_button lo carga en memoria);
+# los más grandes se sirven desde disco: enlace a static/ si está activo server.enableStaticServing, si no la ruta
+MAX_ZIP_DOWNLOAD_MB = 200
+CARPETA_ESTATICA = Path(__file__).parent / "static"
+
+# Galería de resultados: miniaturas generadas al guardar, por páginas
+CARPETA_MINIATURAS = ".cache/miniaturas"
+FORMATO_MINIATURAS = "WEBP"
+MINIATURAS_POR_PAGINA = 24
+COLUMNAS_GALERIA = 6
+
+# Sesiones IMAP reutilizables entre reruns: NOOP cada 4 minutos, cierre tras 25 minutos sin uso
+KEEPALIVE_IMAP_SEGUNDOS = 240
+INACTIVIDAD_MAXIMA_IMAP_SEGUNDOS = 1500
+
+# Búsquedas IMAP reutilizables durante poco tiempo (el buzón sigue recibiendo correo)
+TTL_BUSQUEDAS_SEGUNDOS = 120
+
+
+@st.cache_resource
+def obtener_pool_sesiones_imap():
+    """Pool de sesiones IMAP autenticadas, compartido por todos los reruns del proceso"""
+    return ImapSessionPool(keepalive_seconds=KEEPALIVE_IMAP_SEGUNDOS, max_idle_seconds=INACTIVIDAD_MAXIMA_IMAP_SEGUNDOS)
+
+
+@st.cache_resource
+def obtener_cache_busquedas():
+    """Resultados de SEARCH recientes por cuenta, carpeta y rango de fechas, compartidos entre reruns"""
+    return SearchResultCache(ttl_seconds=TTL_BUSQUEDAS_SEGUNDOS)
+
+
+# Lecturas de los resultados de una ejecución: id_ejecucion forma parte de la clave, así que una
+# ejecución nueva invalida todo y los reruns de la misma ejecución no vuelven a leer ni a recorrer nada
+@st.cache_data(max_entries=16, show_spinner=False)
+def cargar_reporte(ruta_reporte, id_ejecucion):
+    """DataFrame del reporte de emails"""
+    if ruta_reporte.endswith('.parquet'):
+        return pd.read_parquet(ruta_reporte)
+    return pd.read_csv(ruta_reporte)
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def leer_archivo(ruta, id_ejecucion):
+    """Contenido del reporte para el botón de descarga"""
+    with open(ruta, 'rb') as f:
+        return f.read()
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def cargar_resumen_adjuntos(ruta_adjuntos, id_ejecucion):
+    """Archivos y MB guardados por tipo de contenido y estrategia de descarga"""
+    columnas = ['content_type', 'estrategia', 'tamano_bytes']
+    if ruta_adjuntos.endswith('.parquet'):
+        df_adjuntos = pd.read_parquet(ruta_adjuntos, columns=columnas)
+    else:
+        df_adjuntos = pd.read_csv(ruta_adjuntos, usecols=columnas)
+    
+    if df_adjuntos.empty:
+        return None
+    
+    resumen = df_adjuntos.groupby(['content_type', 'estrategia'])['tamano_bytes'].agg(['count', 'sum'])
+    resumen['sum'] = (resumen['sum'] / (1024 * 1024)).round(2)
+    return resumen.rename(columns={'count': 'archivos', 'sum': 'MB'})
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def cargar_manifiesto(ruta_adjuntos, id_ejecucion):
+    """Archivos guardados por la ejecución (manifiesto = tabla de adjuntos)"""
+    return ResultsZipPackager.load_manifest(ruta_adjuntos)
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def cargar_galeria(ruta_adjuntos, id_ejecucion):
+    """Imágenes de la ejecución para la galería"""
+    return ThumbnailCache.load_gallery(ruta_adjuntos)
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def construir_zip(carpeta_base, ruta_adjuntos, id_ejecucion, indice_informe):
+    """Arma el ZIP una sola vez por ejecución y perfil; devuelve su ruta"""
+    zip_filename = f"archivos_{id_ejecucion}_{indice_informe}.zip"
+    zip_path, _ = ResultsZipPackager(carpeta_base).build(cargar_manifiesto(ruta_adjuntos, id_ejecucion), zip_filename)
+    return str(zip_path)
+
+
+def publicar_zip_estatico(zip_path):
+    """Enlaza el ZIP en la carpeta static/ de Streamlit (sin copiarlo); devuelve su ruta publicada o None"""
+    if not st.get_option("server.enableStaticServing"):
+        return None
+    
+    publicado = CARPETA_ESTATICA / zip_path.name
+    try:
+        CARPETA_ESTATICA.mkdir(exist_ok=True)
+        if not publicado.exists():
+            os.link(zip_path, publicado)
+    except OSError:
+        # Otro sistema de archivos (no se admite el enlace duro): se informa la ruta en disco
+        return None
+    return publicado
+
+
+def descartar_ejecucion():
+    """Olvida los resultados mostrados y borra los ZIP temporales de la ejecución anterior"""
+    ejecucion = st.session_state.pop('ultima_ejecucion', None)
+    if not ejecucion:
+        return
+    for zip_path in ejecucion['zips']:
+        try:
+            os.unlink(zip_path)
+        except OSError:
+            pass
+
+
+def mostrar_resultados(ejecucion):
+    """Resultados de la última ejecución (en cada rerun, desde las cachés); devuelve las filas de la galería"""
+    resultado = ejecucion['resultado']
+    id_ejecucion = ejecucion['id']
+    
+    # Proyección del modo estimación (no se descargó ningún archivo)
+    if resultado.get('estimate'):
+        col_est1, col_est2, col_est3 = st.columns(3)
+        col_est1.metric("📧 Emails que cumplen", f"{resultado['valid_emails']} / {resultado['total_emails']}")
+        col_est2.metric("📎 Archivos a descargar", resultado['total_files'])
+        col_est3.metric("💾 Tamaño estimado", f"{resultado['total_bytes'] / (1024 ** 3):.2f} GB")
+    
+    # Volumen transferido (con COMPRESS=DEFLATE los bytes en red son menos que los decodificados)
+    transferencia = resultado.get('transfer')
+    if transferencia and transferencia['decoded_bytes_in']:
+        st.caption(
+            f"🗜️ IMAP: {transferencia['wire_bytes_in'] / 1048576:.1f} MB en la red / "
+            f"{transferencia['decoded_bytes_in'] / 1048576:.1f} MB decodificados "
+            f"({'con' if transferencia['compression'] else 'sin'} compresión)"
+        )
+    
+    # Marcado de los emails descargados en el servidor
+    marcado = resultado.get('marked')
+    if marcado:
+        st.caption(
+            f"🏷️ {marcado['uids']} emails marcados en {marcado['commands']} comando(s)"
+            + (f" ({marcado['failed']} con error)" if marcado['failed'] else "")
+        )
+    
+    # Ritmo alcanzado por el control adaptativo
+    ritmo = resultado.get('rate', {}).get('imap')
+    if ritmo and ritmo['commands']:
+        st.caption(
+            f"⏱️ Ritmo IMAP: {ritmo['achieved_rate']:.1f} comandos/s, "
+            f"{ritmo['throttles']} limitaciones del servidor"
+        )
+    
+    # Un reporte por perfil (o el de la ejecución si no hay perfiles)
+    informes = resultado.get('profiles') or [dict(resultado, name=None, base_folder=ejecucion['carpeta_base'])]
+    filas_galeria = []
+    
+    for indice_informe, informe in enumerate(informes):
+        if informe['name']:
+            st.subheader(f"🧭 Perfil: {informe['name']}")
+        
+        csv_file = Path(informe['report_file'])
+        
+        if csv_file.exists():
+            st.success(f"📊 Reporte: {csv_file.name}")
+            
+            try:
+                df = cargar_reporte(str(csv_file), id_ejecucion)
+                
+                col1, col2 = st.columns(2)
+                
+                with col1:
+                    st.info(f"📈 Total emails: {len(df)}")
+                    emails_descargados = len(df[df['estado'] == 'DESCARGADO'])
+                    emails_descartados = len(df[df['estado'] == 'DESCARTADO'])
+                    
+                    st.write(f"✅ Descargados: {emails_descargados}")
+                    st.write(f"❌ Descartados: {emails_descartados}")
+                
+                with col2:
+                    motivos = df[df['estado'] == 'DESCARTADO']['motivo_rechazo'].value_counts()
+                    if not motivos.empty:
+                        st.write("**Motivos más comunes:**")
+                        for motivo, count in motivos.head(3).items():
+                            st.write(f"• {count}: {motivo[:50]}...")
+                
+                # Preview del CSV
+                with st.expander("👁️ Preview del reporte", expanded=False):
+                    st.dataframe(df.head(10))
+                
+                # Resumen por tipo de adjunto (tabla normalizada, una fila por archivo)
+                adjuntos_file = informe.get('attachments_file')
+                if adjuntos_file and Path(adjuntos_file).exists():
+                    resumen = cargar_resumen_adjuntos(adjuntos_file, id_ejecucion)
+                    if resumen is not None:
+                        with st.expander("📎 Adjuntos guardados por tipo", expanded=False):
+                            st.dataframe(resumen)
+                
+                # Botón descarga del reporte
+                st.download_button(
+                    label=f"⬇️ Descargar Reporte {csv_file.suffix[1:].upper()}",
+                    data=leer_archivo(str(csv_file), id_ejecucion),
+                    file_name=csv_file.name,
+                    mime="text/csv" if csv_file.suffix == '.csv' else "application/octet-stream",
+                    use_container_width=True,
+                    key=f"descargar_reporte_{indice_informe}"
+                )
+            
+            except Exception as e:
+                st.error(f"Error leyendo reporte: {e}")
+        
+        # Archivos producidos por esta ejecución (manifiesto = tabla de adjuntos)
+        adjuntos_file = informe.get('attachments_file')
+        if adjuntos_file and Path(adjuntos_file).exists() and not resultado.get('estimate'):
+            archivos_validos = cargar_manifiesto(adjuntos_file, id_ejecucion)
+            if ejecucion['miniaturas'] and ThumbnailCache.available():
+                filas_galeria.extend(cargar_galeria(adjuntos_file, id_ejecucion))
+            
+            if archivos_validos:
+                st.info(f"📦 {len(archivos_validos)} archivo(s) descargado(s)")
+                
+                # ZIP en disco con zipfile (formatos ya comprimidos se guardan sin recomprimir), uno por ejecución
+                zip_path = construir_zip(informe['base_folder'], adjuntos_file, id_ejecucion, indice_informe)
+                if not os.path.exists(zip_path):
+                    construir_zip.clear()
+                    zip_path = construir_zip(informe['base_folder'], adjuntos_file, id_ejecucion, indice_informe)
+                zip_path = Path(zip_path)
+                zip_size_mb = zip_path.stat().st_size / (1024 * 1024)
+                
+                if zip_size_mb <= MAX_ZIP_DOWNLOAD_MB:
+                    # El ZIP se conserva mientras sea la última ejecución; se borra al lanzar la siguiente
+                    if str(zip_path) not in ejecucion['zips']:
+                        ejecucion['zips'].append(str(zip_path))
+                    
+                    # Botón descarga ZIP
+                    with open(zip_path, 'rb') as zip_file:
+                        st.download_button(
+                            label=f"⬇️ Descargar Archivos (ZIP, {zip_size_mb:.1f} MB)",
+                            data=zip_file,
+                            file_name=zip_path.name,
+                            mime="application/zip",
+                            use_container_width=True,
+                            key=f"descargar_zip_{indice_informe}"
+                        )
+                else:
+                    # Demasiado grande para cargarlo en memoria: se sirve desde disco
+                    publicado = publicar_zip_estatico(zip_path)
+                    if publicado is not None:
+                        if str(publicado) not in ejecucion['zips']:
+                            ejecucion['zips'].append(str(publicado))
+                        st.markdown(
+                            f'<a href="app/static/{publicado.name}" download="{publicado.name}">'
+                            f'⬇️ Descargar Archivos (ZIP, {zip_size_mb:.0f} MB)</a>',
+                            unsafe_allow_html=True
+                        )
+                    else:
+                        st.warning(f"⚠️ El ZIP ocupa {zip_size_mb:.0f} MB: quedó guardado en `{zip_path.resolve()}`")
+            else:
+                st.warning("⚠️ No se descargaron archivos")
+    
+    return filas_galeria
 
 
 def normalizar_palabra(palabra):
@@ -200,6 +458,42 @@ with st.sidebar:
             4. Genera una nueva para 'Correo'
             5. Actualiza tu archivo .env
             """)
+    
+    st.divider()
+    
+    # Origen de los mensajes: servidor IMAP o exportación local
+    TIPOS_ORIGEN = {
+        "Servidor IMAP": "imap",
+        "Archivo mbox (Google Takeout, Thunderbird)": "mbox",
+        "Carpeta Maildir": "maildir",
+        "Archivos .eml": "eml"
+    }
+    origen_seleccionado = st.selectbox(
+        "📂 Origen de los mensajes",
+        options=list(TIPOS_ORIGEN.keys()),
+        help="Procesa una exportación local sin conectarse al servidor"
+    )
+    tipo_origen = TIPOS_ORIGEN[origen_seleccionado]
+    ruta_origen = ""
+    procesos_origen = 1
+    formato_mbox = "mboxrd"
+    
+    if tipo_origen != "imap":
+        ruta_origen = st.text_input(
+            "Ruta del archivo o carpeta",
+            help="Ruta local del mbox, de la carpeta Maildir o de la carpeta con archivos .eml"
+        )
+        procesos_origen = st.number_input(
+            "Procesos en paralelo",
+            min_value=1, max_value=16, value=max(1, min(4, os.cpu_count() or 1)),
+            help="Reparte el archivo en rangos de mensajes procesados en paralelo"
+        )
+        if tipo_origen == "mbox":
+            formato_mbox = st.selectbox(
+                "Variante de mbox",
+                options=["mboxrd", "mboxo"],
+                help="mboxrd (Google Takeout, la mayoría de exportadores) escapa '>From '; mboxo (Thunderbird antiguo) no"
+            )
         
 
 # Tabs principales
@@ -264,10 +558,47 @@ with tab1:
                 
                 # Calcular duración del rango
                 duracion = (fecha_fin - fecha_inicio).days + 1
+            
+            col_size1, col_size2 = st.columns(2)
+            
+            with col_size1:
+                conexiones_paralelas = st.number_input(
+                    "🔌 Conexiones en paralelo",
+                    min_value=1,
+                    max_value=8,
+                    value=1,
+                    help="Los emails se reparten entre conexiones según su tamaño (RFC822.SIZE); los muy grandes van por una conexión propia"
+                )
+            
+            with col_size2:
+                pequenos_primero = st.checkbox(
+                    "⚡ Emails pequeños primero",
+                    value=True,
+                    help="El reporte se llena rápido y los estudios grandes se descargan al final"
+                )
                 
         else:
             fecha_valida = True
-            st.info("ℹ️ Se buscarán emails en **todo el historial** (puede ser muy lento)")
+            st.info("ℹ️ Se buscarán emails en **todo el historial** (opcionalmente por ventanas de fechas, reanudable)")
+            
+            col_shard1, col_shard2 = st.columns(2)
+            
+            with col_shard1:
+                modo_fragmento = st.selectbox(
+                    "🧩 Fragmentar historial por",
+                    options=[None, "month", "week"],
+                    format_func=lambda m: {"month": "Mes", "week": "Semana"}.get(m, "Sin fragmentar"),
+                    help="Cada ventana se busca y procesa por separado, con checkpoint propio (se borran al terminar)"
+                )
+            
+            with col_shard2:
+                conexiones_paralelas = st.number_input(
+                    "🔌 Conexiones en paralelo",
+                    min_value=1,
+                    max_value=8,
+                    value=1,
+                    help="Ventanas procesadas simultáneamente, cada una con su propia conexión IMAP"
+                )
     
     with col2:
         st.subheader("🔍 Filtros Adicionales")
@@ -287,6 +618,39 @@ with tab1:
             index=0
         )
         
+        # Perfiles adicionales: se evalúan en la misma pasada que los filtros principales
+        with st.expander("🧭 Perfiles adicionales (una sola lectura del buzón)", expanded=False):
+            st.caption("Cada perfil guarda sus coincidencias en su propia carpeta y reporte. Separa varios valores con comas.")
+            perfiles_df = st.data_editor(
+                pd.DataFrame(columns=["nombre", "remitentes", "palabras_clave", "extensiones", "carpeta"]),
+                num_rows="dynamic",
+                use_container_width=True,
+                key="perfiles_adicionales"
+            )
+        
+        def separar_valores(valor):
+            if valor is None or pd.isna(valor):
+                return []
+            return [v.strip() for v in str(valor).split(",") if v.strip()]
+        
+        perfiles_adicionales = []
+        for _, fila in perfiles_df.iterrows():
+            nombre_perfil = "" if fila["nombre"] is None or pd.isna(fila["nombre"]) else str(fila["nombre"]).strip()
+            if not nombre_perfil:
+                continue
+            
+            perfil = {
+                "name": nombre_perfil,
+                "sender_emails": separar_valores(fila["remitentes"]),
+                "subject_keywords": [normalizar_palabra(p) for p in separar_valores(fila["palabras_clave"])]
+            }
+            extensiones_perfil = [e.lower() if e.startswith(".") else f".{e.lower()}" for e in separar_valores(fila["extensiones"])]
+            if extensiones_perfil:
+                perfil["allowed_extensions"] = extensiones_perfil
+            if separar_valores(fila["carpeta"]):
+                perfil["base_folder"] = str(fila["carpeta"]).strip()
+            perfiles_adicionales.append(perfil)
+        
         # === OPCIONES ADICIONALES DE FILTRADO ===
         st.subheader("⚙️ Opciones Avanzadas")
         
@@ -339,6 +703,50 @@ with tab2:
         por_fecha = st.checkbox("📅 Organizar por fecha", value=True)
         por_remitente = st.checkbox("👤 Organizar por remitente", value=True)
         por_asunto = st.checkbox("📝 Organizar por asunto", value=False)
+        
+        usar_cache_mensajes = st.checkbox(
+            "💾 Caché local de mensajes",
+            value=True,
+            help="Guarda los emails descargados para repetir el análisis con otros filtros sin volver a traerlos del servidor"
+        )
+        cache_max_mb = st.number_input(
+            "Tamaño máximo de la caché (MB)",
+            min_value=100,
+            max_value=100000,
+            value=2048,
+            step=256,
+            disabled=not usar_cache_mensajes
+        )
+        
+        formato_reporte = st.selectbox(
+            "📊 Formato del reporte",
+            options=["csv", "parquet"],
+            format_func=lambda f: "CSV" if f == "csv" else "Parquet (historiales grandes)",
+            help="El reporte se escribe a medida que se procesan los emails"
+        )
+        
+        modo_marcado = st.selectbox(
+            "🏷️ Marcar en el servidor los emails descargados",
+            options=["no", "seen", "keyword", "gmail_label"],
+            format_func=lambda m: {
+                "no": "No marcar",
+                "seen": "Como leídos",
+                "keyword": "Con una palabra clave IMAP",
+                "gmail_label": "Con una etiqueta de Gmail"
+            }[m],
+            help="Se aplica al final de la ejecución con unos pocos comandos sobre todos los emails descargados"
+        )
+        etiqueta_marcado = st.text_input(
+            "Palabra clave / etiqueta",
+            value="Archivado",
+            disabled=modo_marcado not in ("keyword", "gmail_label")
+        )
+        excluir_marcados = st.checkbox(
+            "⏭️ Excluir de la búsqueda los emails ya marcados",
+            value=False,
+            disabled=modo_marcado == "no",
+            help="Las próximas ejecuciones no vuelven a revisar el correo ya archivado (en modo 'leídos', tampoco el que se leyó a mano)"
+        )
     
     with col2:
         st.subheader("📄 Tipos de Archivo")
@@ -359,6 +767,43 @@ with tab2:
             ext_xlsx = st.checkbox("📊 XLS/XLSX", value=False)
             ext_txt = st.checkbox("📃 TXT", value=False)
         
+        descarga_por_secciones = st.checkbox(
+            "📥 Descargar sólo las partes adjuntas",
+            value=False,
+            help="Usa BODYSTRUCTURE para traer únicamente las partes MIME con tipos permitidos (sin HTML, videos, etc.)"
+        )
+        
+        indexar_dicom = st.checkbox(
+            "🏥 Indexar estudios DICOM",
+            value=False,
+            help="Registra paciente, estudio, serie y modalidad de cada DICOM guardado en un índice local dentro de la carpeta base"
+        )
+        
+        omitir_casi_duplicados = st.checkbox(
+            "🔁 Omitir imágenes casi duplicadas",
+            value=False,
+            help="Detecta la misma imagen recomprimida o reenviada (p. ej. por WhatsApp) con un hash perceptual"
+        )
+        
+        expandir_zip = st.checkbox(
+            "📦 Buscar archivos dentro de adjuntos ZIP",
+            value=True,
+            help="Extrae de los .zip sólo los archivos de los tipos seleccionados (con límites de tamaño)"
+        )
+        
+        # Sin Pillow no hay miniaturas: la galería no se ofrece
+        generar_miniaturas = ThumbnailCache.available() and st.checkbox(
+            "🖼️ Galería de miniaturas",
+            value=True,
+            help="Genera miniaturas al guardar para revisar los resultados sin descargar el ZIP"
+        )
+        
+        comprimir_almacenamiento = st.checkbox(
+            "🗜️ Guardar DICOM y BMP comprimidos",
+            value=False,
+            help="Se guardan como .dcm.zst / .bmp.zst (zstd, o gzip si no está instalado); el ZIP de resultados los entrega descomprimidos. JPG, PNG y PDF se guardan tal cual"
+        )
+        
         extensiones = []
         if ext_jpg: extensiones.extend([".jpg", ".jpeg"])
         if ext_png: extensiones.append(".png")
@@ -377,10 +822,12 @@ with tab2:
 with tab3:
     # Validaciones con validación mejorada de contraseñas
     errores = []
-    if not email_usuario:
+    if tipo_origen == "imap" and not email_usuario:
         errores.append("📧 Falta el email")
-    if not is_real_password(password_usuario):
+    if tipo_origen == "imap" and not is_real_password(password_usuario):
         errores.append("🔑 Falta configurar contraseña válida")
+    if tipo_origen != "imap" and not (ruta_origen and Path(ruta_origen).exists()):
+        errores.append("📂 La ruta del origen local no existe")
     if not extensiones:
         errores.append("📎 Falta seleccionar tipos de archivo")
     if usar_filtro_fecha and not fecha_valida:
@@ -392,7 +839,7 @@ with tab3:
             st.error(f"• {error}")
         
         # Mostrar información adicional para configurar contraseñas
-        if not is_real_password(password_usuario):
+        if tipo_origen == "imap" and not is_real_password(password_usuario):
             st.info("""
             💡 **Para configurar las contraseñas:**
             
@@ -414,7 +861,23 @@ with tab3:
     else:
         st.success("✅ **Configuración válida**")
         
-        if st.button("🚀 **EJECUTAR ANÁLISIS COMPLETO**", type="primary", use_container_width=True):
+        col_ejecutar, col_estimar = st.columns([3, 1])
+        
+        with col_ejecutar:
+            ejecutar = st.button("🚀 **EJECUTAR ANÁLISIS COMPLETO**", type="primary", use_container_width=True)
+        
+        # La estimación sólo existe para IMAP (BODYSTRUCTURE y RFC822.SIZE del servidor)
+        estimar = False
+        if tipo_origen == "imap":
+            with col_estimar:
+                estimar = st.button(
+                    "🔎 Estimar sin descargar",
+                    use_container_width=True,
+                    help="Cuenta emails, archivos y GB que se descargarían usando sólo BODYSTRUCTURE y RFC822.SIZE"
+                )
+        
+        if ejecutar or estimar:
+            descartar_ejecucion()
             
             # Preparar configuración de fechas
             if usar_filtro_fecha:
@@ -443,7 +906,14 @@ with tab3:
                     "port": puerto,
                     "email": email_usuario,
                     "password": password_usuario,
-                    "use_ssl": usar_ssl
+                    "use_ssl": usar_ssl,
+                    "compress": True
+                },
+                "source": {
+                    "type": tipo_origen,
+                    "path": ruta_origen,
+                    "mbox_format": formato_mbox,
+                    "workers": int(procesos_origen)
                 },
                 "filters": {
                     "subject_keywords": palabras_clave,
@@ -452,6 +922,16 @@ with tab3:
                     "has_attachments": True,
                     "folder": carpeta_email
                 },
+                # Con perfiles adicionales, los filtros principales son un perfil más de la misma pasada
+                "profiles": [
+                    {
+                        "name": "Principal",
+                        "sender_emails": remitentes,
+                        "subject_keywords": palabras_clave,
+                        "allowed_extensions": extensiones,
+                        "base_folder": carpeta_base
+                    }
+                ] + perfiles_adicionales if perfiles_adicionales else [],
                 "download_settings": {
                     "base_folder": carpeta_base,
                     "folder_structure": {
@@ -463,13 +943,73 @@ with tab3:
                     "max_file_size_mb": 0,
                     "rename_files": True,
                     "naming_pattern": "{date}_{sender}_{subject}_{index}_{original_name}",
-                    "download_google_drive_links": True
+                    "download_google_drive_links": True,
+                    "report_format": formato_reporte,
+                    "section_fetch": descarga_por_secciones,
+                    "dicom_index": {
+                        "enabled": indexar_dicom
+                    },
+                    "perceptual_dedup": {
+                        "enabled": omitir_casi_duplicados,
+                        "action": "skip",
+                        "max_distance": 6,
+                        "workers": 4,
+                        "index_path": ".cache/phash_index.npz"
+                    },
+                    "archive_expansion": {
+                        "enabled": expandir_zip,
+                        "max_members": 2000,
+                        "max_member_mb": 512,
+                        "max_total_mb": 2048,
+                        "max_ratio": 200,
+                        "workers": 4
+                    },
+                    "http_cache": {
+                        "enabled": True,
+                        "max_age_hours": 24,
+                        "preflight": True
+                    },
+                    "storage_compression": {
+                        "enabled": comprimir_almacenamiento,
+                        "codec": "zstd",
+                        "extensions": [".dcm", ".bmp"]
+                    },
+                    "thumbnails": {
+                        "enabled": generar_miniaturas,
+                        "cache_dir": CARPETA_MINIATURAS,
+                        "size": 256,
+                        "format": FORMATO_MINIATURAS,
+                        "workers": 2
+                    }
                 },
                 "processing": {
-                    "mark_as_read": False,
+                    "mark_processed": {
+                        "enabled": modo_marcado != "no",
+                        "mode": modo_marcado,
+                        "keyword": etiqueta_marcado,
+                        "label": etiqueta_marcado,
+                        "statuses": ["DESCARGADO"],
+                        "exclude_marked": modo_marcado != "no" and excluir_marcados
+                    },
                     "delete_duplicates": False,
                     "max_emails_per_run": 0,
-                    "delay_between_emails": 1.0
+                    "delay_between_emails": 1.0,
+                    "shard_mode": None if usar_filtro_fecha else modo_fragmento,
+                    "shard_workers": 1 if usar_filtro_fecha else int(conexiones_paralelas),
+                    "size_scheduling": {
+                        "enabled": usar_filtro_fecha,
+                        "connections": int(conexiones_paralelas),
+                        "large_message_mb": 20,
+                        "small_first": usar_filtro_fecha and pequenos_primero,
+                        "max_inflight_mb": 512
+                    },
+                    "journal": True,
+                    "message_cache": {
+                        "enabled": usar_cache_mensajes,
+                        "path": ".cache/mensajes.sqlite3",
+                        "max_size_mb": int(cache_max_mb),
+                        "compression": "zstd"
+                    }
                 },
                 "logging": {
                     "level": "DEBUG",
@@ -489,12 +1029,15 @@ with tab3:
                         st.info("🔄 Iniciando análisis de todo el historial...")
                 
                 downloader = EmailImageDownloader(config)
+                if tipo_origen == "imap":
+                    downloader.session_pool = obtener_pool_sesiones_imap()
+                    downloader.search_cache = obtener_cache_busquedas()
                 progress_bar.progress(20)
                 
                 with status_container:
                     st.info("🔄 Conectando al email...")
                 
-                resultado = downloader.run()
+                resultado = downloader.run_estimate() if estimar else downloader.run()
                 progress_bar.progress(100)
                 
                 if resultado:
@@ -502,87 +1045,19 @@ with tab3:
                         st.markdown("""
                         <div class="status-success">
                             <h3>✅ ¡Análisis completado!</h3>
-                            <p>Revisa el reporte CSV generado.</p>
+                            <p>Revisa el reporte generado.</p>
                         </div>
                         """, unsafe_allow_html=True)
                     
-                    # Buscar archivo CSV generado
-                    csv_files = list(Path('.').glob('reporte_analisis_emails_*.csv'))
-                    
-                    if csv_files:
-                        csv_file = max(csv_files, key=lambda x: x.stat().st_mtime)
-                        st.success(f"📊 Reporte: {csv_file.name}")
-                        
-                        try:
-                            df = pd.read_csv(csv_file)
-                            
-                            col1, col2 = st.columns(2)
-                            
-                            with col1:
-                                st.info(f"📈 Total emails: {len(df)}")
-                                emails_descargados = len(df[df['estado'] == 'DESCARGADO'])
-                                emails_descartados = len(df[df['estado'] == 'DESCARTADO'])
-                                
-                                st.write(f"✅ Descargados: {emails_descargados}")
-                                st.write(f"❌ Descartados: {emails_descartados}")
-                            
-                            with col2:
-                                motivos = df[df['estado'] == 'DESCARTADO']['motivo_rechazo'].value_counts()
-                                if not motivos.empty:
-                                    st.write("**Motivos más comunes:**")
-                                    for motivo, count in motivos.head(3).items():
-                                        st.write(f"• {count}: {motivo[:50]}...")
-                            
-                            # Preview del CSV
-                            with st.expander("👁️ Preview del reporte", expanded=False):
-                                st.dataframe(df.head(10))
-                            
-                            # Botón descarga CSV
-                            with open(csv_file, 'rb') as f:
-                                st.download_button(
-                                    label="⬇️ Descargar Reporte CSV",
-                                    data=f.read(),
-                                    file_name=csv_file.name,
-                                    mime="text/csv",
-                                    use_container_width=True
-                                )
-                                
-                        except Exception as e:
-                            st.error(f"Error leyendo CSV: {e}")
-                    
-                    # Verificar archivos descargados
-                    if os.path.exists(carpeta_base):
-                        archivos = list(Path(carpeta_base).rglob('*'))
-                        archivos_validos = [f for f in archivos if f.is_file()]
-                        
-                        if archivos_validos:
-                            st.info(f"📦 {len(archivos_validos)} archivo(s) descargado(s)")
-                            
-                            # Crear ZIP
-                            zip_filename = f"archivos_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
-                            
-                            with zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                                for archivo in archivos_validos:
-                                    ruta_relativa = archivo.relative_to(carpeta_base)
-                                    zip_file.write(archivo, ruta_relativa)
-                            
-                            # Botón descarga ZIP
-                            with open(zip_filename, 'rb') as zip_file:
-                                st.download_button(
-                                    label="⬇️ Descargar Archivos (ZIP)",
-                                    data=zip_file.read(),
-                                    file_name=zip_filename,
-                                    mime="application/zip",
-                                    use_container_width=True
-                                )
-                            
-                            # Limpiar ZIP temporal
-                            try:
-                                os.unlink(zip_filename)
-                            except:
-                                pass
-                        else:
-                            st.warning("⚠️ No se descargaron archivos")
+                    # Los resultados se leen desde la sesión y las cachés: sobreviven a los reruns de la interfaz
+                    st.session_state['ultima_ejecucion'] = {
+                        'id': datetime.now().strftime('%Y%m%d_%H%M%S_%f'),
+                        'resultado': resultado,
+                        'carpeta_base': carpeta_base,
+                        'miniaturas': generar_miniaturas,
+                        'zips': []
+                    }
+                    st.session_state['pagina_galeria'] = 1
                 else:
                     with status_container:
                         st.markdown("""
@@ -595,6 +1070,32 @@ with tab3:
                 progress_bar.progress(0)
                 with status_container:
                     st.error(f"❌ Error: {str(e)}")
+        
+        # Resultados de la última ejecución y su galería: sólo se cargan las miniaturas de la página visible
+        ejecucion = st.session_state.get('ultima_ejecucion')
+        filas_galeria = mostrar_resultados(ejecucion) if ejecucion else []
+        if filas_galeria:
+            st.markdown("---")
+            st.subheader(f"🖼️ Galería ({len(filas_galeria)} imágenes)")
+            
+            total_paginas = (len(filas_galeria) - 1) // MINIATURAS_POR_PAGINA + 1
+            pagina = st.number_input(
+                f"Página (de {total_paginas})",
+                min_value=1,
+                max_value=total_paginas,
+                step=1,
+                key="pagina_galeria"
+            )
+            
+            inicio = (pagina - 1) * MINIATURAS_POR_PAGINA
+            columnas_galeria = st.columns(COLUMNAS_GALERIA)
+            for posicion, fila in enumerate(filas_galeria[inicio:inicio + MINIATURAS_POR_PAGINA]):
+                miniatura = ThumbnailCache.thumbnail_path(CARPETA_MINIATURAS, fila['md5'], FORMATO_MINIATURAS)
+                with columnas_galeria[posicion % COLUMNAS_GALERIA]:
+                    if miniatura.exists():
+                        st.image(str(miniatura), caption=fila['nombre_original'], use_container_width=True)
+                    else:
+                        st.caption(f"⏳ {fila['nombre_original']}")
 
 # Footer
 st.markdown("---")
@@ -1,23 +1,2230 @@
 import email
 import email.header
+import email.utils
 import imaplib
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, date
 import re
 from pathlib import Path
 import os
 import hashlib
+import io
+import heapq
 import csv
+import fnmatch
+import functools
+import gzip
+import array
+import base64
+import json
+import mimetypes
+import mmap
+import quopri
+import random
+import shutil
+import sqlite3
+import ssl
+import struct
+import threading
+import time
+import unicodedata
+import weakref
+import zipfile
+import zlib
 import requests
-from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse, urlunparse, parse_qs, parse_qsl, urlencode, unquote
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from PIL import Image, features
+except ImportError:
+    Image = None
+    features = None
+
+def normalize_search_text(text):
+    """Forma de comparación: NFKD sin marcas diacríticas y casefold (cualquier acento, no sólo los del español)"""
+    if not text:
+        return ""
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(char for char in decomposed if not unicodedata.combining(char)).casefold()
+
+
+class FilterMatcher:
+    """
+    Filtros de remitente y asunto compilados una vez por ejecución. Las palabras clave se buscan en una
+    sola pasada (autómata Aho-Corasick si pyahocorasick está instalado, si no una regex combinada).
+    Los remitentes se separan en direcciones exactas, dominios completos ('@dominio.com' o '*.dominio.com',
+    también sus subdominios), comodines ('informes*@clinica.com') y texto libre, que conserva la coincidencia
+    por subcadena. Un '@' sin dominio completo ('@gmail', '@clinica') sigue siendo texto libre: coincide
+    con '@gmail.com', '@gmail.com.ar' o '@clinica-norte.org', como antes.
+    """
+    
+    def __init__(self, sender_emails, subject_keywords):
+        self.exact_senders = {}
+        self.domain_senders = {}
+        wildcard_patterns = []
+        substring_senders = {}
+        
+        for filter_sender in sender_emails or []:
+            normalized = filter_sender.strip().casefold()
+            if not normalized:
+                continue
+            if normalized.startswith('*.') and '@' not in normalized:
+                self.domain_senders[normalized[2:]] = filter_sender
+            elif normalized.startswith('@') and '.' in normalized.strip('.'):
+                self.domain_senders[normalized[1:]] = filter_sender
+            elif '*' in normalized or '?' in normalized:
+                wildcard_patterns.append((fnmatch.translate(normalized), filter_sender))
+            else:
+                if '@' in normalized and not normalized.startswith('@'):
+                    self.exact_senders[normalized] = filter_sender
+                substring_senders[normalized] = filter_sender
+        
+        self.sender_count = len(self.exact_senders) + len(self.domain_senders) + len(wildcard_patterns) + len(substring_senders)
+        self.substring_senders = substring_senders
+        self.substring_regex = self._compile_alternation(substring_senders)
+        self.wildcard_patterns = [filter_sender for _, filter_sender in wildcard_patterns]
+        self.wildcard_regex = re.compile(
+            '|'.join(f'(?P<w{index}>{pattern})' for index, (pattern, _) in enumerate(wildcard_patterns))
+        ) if wildcard_patterns else None
+        
+        self.keywords = {}
+        for keyword in subject_keywords or []:
+            normalized = normalize_search_text(keyword.strip())
+            if normalized:
+                self.keywords.setdefault(normalized, keyword)
+        
+        self.keyword_automaton = None
+        self.keyword_regex = None
+        if self.keywords and ahocorasick is not None:
+            self.keyword_automaton = ahocorasick.Automaton()
+            for normalized in self.keywords:
+                self.keyword_automaton.add_word(normalized, normalized)
+            self.keyword_automaton.make_automaton()
+        else:
+            self.keyword_regex = self._compile_alternation(self.keywords)
+    
+    @staticmethod
+    def _compile_alternation(literals):
+        if not literals:
+            return None
+        # Las más largas primero para que la alternancia prefiera la coincidencia más específica
+        return re.compile('|'.join(re.escape(literal) for literal in sorted(literals, key=len, reverse=True)))
+    
+    def match_sender(self, sender):
+        """Devuelve el filtro de remitente que coincide, o None"""
+        sender_normalized = (sender or '').casefold()
+        addresses = [address.casefold() for _, address in email.utils.getaddresses([sender or '']) if address]
+        
+        for address in addresses:
+            if address in self.exact_senders:
+                return self.exact_senders[address]
+            
+            domain = address.rpartition('@')[2]
+            while domain:
+                if domain in self.domain_senders:
+                    return self.domain_senders[domain]
+                domain = domain.partition('.')[2]
+            
+            if self.wildcard_regex is not None:
+                wildcard_match = self.wildcard_regex.match(address)
+                if wildcard_match:
+                    return self.wildcard_patterns[int(wildcard_match.lastgroup[1:])]
+        
+        if self.substring_regex is not None:
+            substring_match = self.substring_regex.search(sender_normalized)
+            if substring_match:
+                return self.substring_senders[substring_match.group(0)]
+        
+        return None
+    
+    def match_subject(self, subject):
+        """Devuelve la palabra clave (tal como se configuró) encontrada en el asunto, o None"""
+        subject_normalized = normalize_search_text(subject)
+        
+        if self.keyword_automaton is not None:
+            for _, normalized in self.keyword_automaton.iter(subject_normalized):
+                return self.keywords[normalized]
+            return None
+        
+        if self.keyword_regex is not None:
+            keyword_match = self.keyword_regex.search(subject_normalized)
+            if keyword_match:
+                return self.keywords[keyword_match.group(0)]
+        
+        return None
+
+
+@functools.lru_cache(maxsize=8192)
+def decode_header_value(header):
+    """Decodifica un header RFC 2047; memoizado porque remitentes, asuntos y charsets se repiten entre emails"""
+    decoded_header = ""
+    
+    for part, encoding in email.header.decode_header(header):
+        if isinstance(part, bytes):
+            if encoding:
+                try:
+                    decoded_header += part.decode(encoding)
+                except (UnicodeDecodeError, LookupError):
+                    decoded_header += part.decode('utf-8', errors='ignore')
+            else:
+                decoded_header += part.decode('utf-8', errors='ignore')
+        else:
+            decoded_header += str(part)
+    
+    return decoded_header
+
+
+class MessageMeta:
+    """Metadatos de un email decodificados una sola vez y compartidos por análisis, filtros, reporte y descarga"""
+    
+    __slots__ = ('email_id', 'sender', 'subject', 'date', 'message_id', 'size', 'attachment_summary')
+    
+    def __init__(self, email_id, sender, subject, date, message_id, size=None, attachment_summary=None):
+        self.email_id = email_id
+        self.sender = sender
+        self.subject = subject
+        self.date = date
+        self.message_id = message_id
+        self.size = size
+        # (total, tipos): se calcula al primer uso si no viene de BODYSTRUCTURE
+        self.attachment_summary = attachment_summary
+
+
+class DeflateIMAPMixin:
+    """
+    Transporte IMAP con soporte de COMPRESS=DEFLATE (RFC 4978): tras negociarlo, todo lo que
+    se envía y recibe por el socket va comprimido con deflate crudo. Lleva la cuenta de bytes
+    en la red frente a bytes decodificados, con o sin compresión.
+    """
+    
+    READ_CHUNK_SIZE = 65536
+    
+    def _init_transfer_stats(self):
+        if not hasattr(self, 'wire_bytes_in'):
+            self.compression_enabled = False
+            self.wire_bytes_in = 0
+            self.wire_bytes_out = 0
+            self.decoded_bytes_in = 0
+            self.decoded_bytes_out = 0
+            self._inflated = bytearray()
+    
+    def enable_compression(self):
+        """Negocia COMPRESS DEFLATE si el servidor lo anuncia; devuelve True si quedó activo"""
+        self._init_transfer_stats()
+        if self.compression_enabled or 'COMPRESS=DEFLATE' not in self.capabilities:
+            return self.compression_enabled
+        
+        imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+        typ, _ = self._simple_command('COMPRESS', 'DEFLATE')
+        if typ != 'OK':
+            return False
+        
+        self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self._decompressor = zlib.decompressobj(-15)
+        self.compression_enabled = True
+        return True
+    
+    def _fill_buffer(self):
+        # read1 devuelve primero lo que ya esté en el buffer del archivo y luego lo que llegue al socket
+        chunk = self.file.read1(self.READ_CHUNK_SIZE)
+        if not chunk:
+            return False
+        self.wire_bytes_in += len(chunk)
+        self._inflated += self._decompressor.decompress(chunk)
+        return True
+    
+    def read(self, size):
+        self._init_transfer_stats()
+        if not self.compression_enabled:
+            data = super().read(size)
+            self.wire_bytes_in += len(data)
+            self.decoded_bytes_in += len(data)
+            return data
+        
+        while len(self._inflated) < size and self._fill_buffer():
+            pass
+        data = bytes(self._inflated[:size])
+        del self._inflated[:size]
+        self.decoded_bytes_in += len(data)
+        return data
+    
+    def readline(self):
+        self._init_transfer_stats()
+        if not self.compression_enabled:
+            line = super().readline()
+            self.wire_bytes_in += len(line)
+            self.decoded_bytes_in += len(line)
+            return line
+        
+        while b'\n' not in self._inflated:
+            if len(self._inflated) > imaplib._MAXLINE:
+                raise self.error(f"got more than {imaplib._MAXLINE} bytes")
+            if not self._fill_buffer():
+                break
+        
+        end = self._inflated.find(b'\n') + 1 or len(self._inflated)
+        line = bytes(self._inflated[:end])
+        del self._inflated[:end]
+        self.decoded_bytes_in += len(line)
+        return line
+    
+    def send(self, data):
+        self._init_transfer_stats()
+        self.decoded_bytes_out += len(data)
+        if self.compression_enabled:
+            data = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.wire_bytes_out += len(data)
+        self.sock.sendall(data)
+    
+    def reset_transfer_stats(self):
+        """Pone a cero los contadores (al reutilizar la conexión en otra ejecución)"""
+        self._init_transfer_stats()
+        self.wire_bytes_in = 0
+        self.wire_bytes_out = 0
+        self.decoded_bytes_in = 0
+        self.decoded_bytes_out = 0
+    
+    def get_transfer_stats(self):
+        """Bytes en la red y decodificados, en ambos sentidos"""
+        self._init_transfer_stats()
+        return {
+            'compression': self.compression_enabled,
+            'wire_bytes_in': self.wire_bytes_in,
+            'decoded_bytes_in': self.decoded_bytes_in,
+            'wire_bytes_out': self.wire_bytes_out,
+            'decoded_bytes_out': self.decoded_bytes_out
+        }
+
+
+class CompressibleIMAP4(DeflateIMAPMixin, imaplib.IMAP4):
+    """IMAP4 sin SSL con soporte de COMPRESS=DEFLATE"""
+
+
+class CompressibleIMAP4_SSL(DeflateIMAPMixin, imaplib.IMAP4_SSL):
+    """IMAP4 sobre SSL con soporte de COMPRESS=DEFLATE"""
+
+
+def compress_uid_set(uids, max_length=4000):
+    """
+    Agrupa UIDs en conjuntos IMAP compactos ('3:7,10,12:15'). Se parten en varios conjuntos para
+    que ningún comando supere max_length caracteres (los servidores limitan el largo de línea)
+    """
+    uid_sets = []
+    ranges = []
+    length = 0
+    start = previous = None
+    
+    for uid in sorted({int(uid) for uid in uids}) + [None]:
+        if uid is not None and previous is not None and uid == previous + 1:
+            previous = uid
+            continue
+        
+        if start is not None:
+            item = str(start) if start == previous else f'{start}:{previous}'
+            if ranges and length + len(item) + 1 > max_length:
+                uid_sets.append(','.join(ranges))
+                ranges = []
+                length = 0
+            ranges.append(item)
+            length += len(item) + 1
+        start = previous = uid
+    
+    if ranges:
+        uid_sets.append(','.join(ranges))
+    return uid_sets
+
+
+class ImapSessionPool:
+    """
+    Sesiones IMAP ya autenticadas que sobreviven entre ejecuciones (p. ej. entre reruns de Streamlit):
+    al terminar, la conexión vuelve al pool en lugar de cerrarse; un hilo envía NOOP a las ociosas para
+    que el servidor no las corte y, antes de reutilizar una, se valida con otro NOOP. Las que fallan se
+    descartan y el descargador abre una conexión nueva.
+    """
+    
+    def __init__(self, keepalive_seconds=240, max_idle_seconds=1500, max_idle_per_account=4):
+        self.keepalive_seconds = keepalive_seconds
+        self.max_idle_seconds = max_idle_seconds
+        self.max_idle_per_account = max_idle_per_account
+        self.idle = {}
+        self.reused = 0
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._keepalive_loop, name='imap-keepalive', daemon=True)
+        self._thread.start()
+    
+    @staticmethod
+    def make_key(server, port, email_addr, password, use_ssl):
+        # La contraseña sólo entra como hash: si cambia, las sesiones anteriores no se reutilizan
+        return (server, int(port), email_addr, bool(use_ssl), hashlib.sha256(password.encode('utf-8')).hexdigest())
+    
+    def acquire(self, key):
+        """Una sesión autenticada y viva de la cuenta, o None si hay que conectar"""
+        while True:
+            with self.lock:
+                sessions = self.idle.get(key)
+                if not sessions:
+                    return None
+                connection, _ = sessions.pop()
+            
+            if self._is_alive(connection):
+                with self.lock:
+                    self.reused += 1
+                if hasattr(connection, 'reset_transfer_stats'):
+                    connection.reset_transfer_stats()
+                return connection
+            self._discard(connection)
+    
+    def release(self, key, connection):
+        """Devuelve la sesión al pool en estado autenticado (sin buzón seleccionado); si no sirve, la cierra"""
+        try:
+            if getattr(connection, 'state', 'SELECTED') == 'SELECTED':
+                connection.close()
+        except Exception:
+            self._discard(connection)
+            return False
+        
+        with self.lock:
+            sessions = self.idle.setdefault(key, [])
+            if len(sessions) < self.max_idle_per_account:
+                sessions.append((connection, time.monotonic()))
+                return True
+        
+        self._discard(connection)
+        return False
+    
+    @staticmethod
+    def _is_alive(connection):
+        try:
+            typ, _ = connection.noop()
+            return typ == 'OK'
+        except Exception:
+            return False
+    
+    @staticmethod
+    def _discard(connection):
+        try:
+            connection.logout()
+        except Exception:
+            try:
+                connection.shutdown()
+            except Exception:
+                pass
+    
+    def _keepalive_loop(self):
+        while not self._stop.wait(self.keepalive_seconds):
+            self.keepalive()
+    
+    def keepalive(self):
+        """NOOP a las sesiones ociosas; cierra las que no responden o llevan más de max_idle_seconds sin uso"""
+        with self.lock:
+            pending = [(key, session) for key, sessions in self.idle.items() for session in sessions]
+            self.idle = {}
+        
+        now = time.monotonic()
+        for key, (connection, idle_since) in pending:
+            if now - idle_since > self.max_idle_seconds or not self._is_alive(connection):
+                self._discard(connection)
+                continue
+            with self.lock:
+                self.idle.setdefault(key, []).append((connection, idle_since))
+    
+    def close(self):
+        self._stop.set()
+        with self.lock:
+            pending = [connection for sessions in self.idle.values() for connection, _ in sessions]
+            self.idle = {}
+        for connection in pending:
+            self._discard(connection)
+
+
+class SearchResultCache:
+    """
+    Resultados recientes de UID SEARCH por cuenta, carpeta, UIDVALIDITY y criterio (que ya incluye el
+    rango de fechas). El TTL es corto porque el buzón sigue recibiendo correo: sólo evita repetir la
+    misma búsqueda en ejecuciones seguidas (estimar y luego descargar, reintentos, reruns de la interfaz).
+    """
+    
+    def __init__(self, ttl_seconds=120, max_entries=256):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.entries = {}
+        self.hits = 0
+        self.lock = threading.Lock()
+    
+    def get(self, key):
+        """Respuesta cruda de SEARCH (bytes con los UIDs) o None si no está o ya caducó"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            stored_at, uids = entry
+            if time.monotonic() - stored_at > self.ttl_seconds:
+                del self.entries[key]
+                return None
+            self.hits += 1
+            return uids
+    
+    def put(self, key, uids):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.monotonic(), uids)
+            # Los diccionarios conservan el orden de inserción: se descartan las búsquedas más antiguas
+            while len(self.entries) > self.max_entries:
+                del self.entries[next(iter(self.entries))]
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class MessageCache:
+    """
+    Caché local de mensajes crudos (RFC822) en SQLite, con clave (cuenta, carpeta, UIDVALIDITY, UID).
+    Los mensajes se guardan comprimidos (zstd si está instalado, si no zlib) y, al superar el tamaño
+    máximo, se eliminan los de acceso más antiguo (LRU).
+    """
+    
+    def __init__(self, cache_path, max_size_mb=2048, compression='zstd'):
+        self.cache_path = Path(cache_path)
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = int(max_size_mb * 1024 * 1024)
+        self.codec = self._select_codec(compression)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        
+        self.conn = sqlite3.connect(str(self.cache_path), timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                account TEXT NOT NULL,
+                folder TEXT NOT NULL,
+                uidvalidity INTEGER NOT NULL,
+                uid INTEGER NOT NULL,
+                codec TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                stored_size INTEGER NOT NULL,
+                last_access REAL NOT NULL,
+                data BLOB NOT NULL,
+                PRIMARY KEY (account, folder, uidvalidity, uid)
+            )
+        """)
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_last_access ON messages (last_access)')
+        self.conn.commit()
+        self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(stored_size), 0) FROM messages').fetchone()[0]
+    
+    @staticmethod
+    def _select_codec(compression):
+        if compression == 'zstd' and zstd is not None:
+            return 'zstd'
+        if compression in ('zstd', 'zlib'):
+            return 'zlib'
+        return 'raw'
+    
+    def _encode(self, raw_message):
+        if self.codec == 'zstd':
+            return zstd.ZstdCompressor(level=3).compress(raw_message)
+        if self.codec == 'zlib':
+            return zlib.compress(raw_message, 6)
+        return raw_message
+    
+    @staticmethod
+    def _decode(codec, data):
+        if codec == 'zstd':
+            return zstd.ZstdDecompressor().decompress(data)
+        if codec == 'zlib':
+            return zlib.decompress(data)
+        return bytes(data)
+    
+    def get(self, key):
+        """Devuelve el mensaje crudo o None; actualiza su último acceso"""
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT codec, data FROM messages WHERE account=? AND folder=? AND uidvalidity=? AND uid=?', key
+            ).fetchone()
+            
+            if row is None or (row[0] == 'zstd' and zstd is None):
+                self.misses += 1
+                return None
+            
+            self.conn.execute(
+                'UPDATE messages SET last_access=? WHERE account=? AND folder=? AND uidvalidity=? AND uid=?',
+                (time.time(), *key)
+            )
+            self.conn.commit()
+            self.hits += 1
+            return self._decode(row[0], row[1])
+    
+    def contains(self, key):
+        with self.lock:
+            return self.conn.execute(
+                'SELECT 1 FROM messages WHERE account=? AND folder=? AND uidvalidity=? AND uid=?', key
+            ).fetchone() is not None
+    
+    def put(self, key, raw_message):
+        """Guarda un mensaje y aplica el límite de tamaño"""
+        data = self._encode(raw_message)
+        if len(data) > self.max_bytes:
+            return
+        
+        with self.lock:
+            previous = self.conn.execute(
+                'SELECT stored_size FROM messages WHERE account=? AND folder=? AND uidvalidity=? AND uid=?', key
+            ).fetchone()
+            self.conn.execute(
+                'INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (*key, self.codec, len(raw_message), len(data), time.time(), data)
+            )
+            self.total_bytes += len(data) - (previous[0] if previous else 0)
+            self._evict()
+            self.conn.commit()
+    
+    def _evict(self):
+        while self.total_bytes > self.max_bytes:
+            oldest = self.conn.execute(
+                'SELECT account, folder, uidvalidity, uid, stored_size FROM messages ORDER BY last_access LIMIT 64'
+            ).fetchall()
+            if not oldest:
+                self.total_bytes = 0
+                break
+            for account, folder, uidvalidity, uid, stored_size in oldest:
+                self.conn.execute(
+                    'DELETE FROM messages WHERE account=? AND folder=? AND uidvalidity=? AND uid=?',
+                    (account, folder, uidvalidity, uid)
+                )
+                self.total_bytes -= stored_size
+                if self.total_bytes <= self.max_bytes:
+                    break
+    
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+DICOM_PREAMBLE_LENGTH = 128
+DICOM_HEADER_MAX_BYTES = 64 * 1024
+
+# Tags que se guardan en el índice local: (grupo, elemento) -> columna
+DICOM_INDEX_TAGS = {
+    (0x0008, 0x0018): 'sop_instance_uid',
+    (0x0008, 0x0020): 'study_date',
+    (0x0008, 0x0060): 'modality',
+    (0x0010, 0x0010): 'patient_name',
+    (0x0010, 0x0020): 'patient_id',
+    (0x0020, 0x000D): 'study_uid',
+    (0x0020, 0x000E): 'series_uid',
+}
+DICOM_LAST_INDEX_TAG = max(DICOM_INDEX_TAGS)
+
+# VR explícitos con 2 bytes reservados y longitud de 4 bytes
+DICOM_LONG_VRS = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'}
+DICOM_UNDEFINED_LENGTH = 0xFFFFFFFF
+
+
+def is_dicom_data(data):
+    """Un archivo DICOM (Part 10) tiene 128 bytes de preámbulo y luego 'DICM'"""
+    return len(data) >= DICOM_PREAMBLE_LENGTH + 4 and data[DICOM_PREAMBLE_LENGTH:DICOM_PREAMBLE_LENGTH + 4] == b'DICM'
+
+
+def _read_dicom_element(buf, offset, explicit, endian):
+    """Lee la cabecera de un elemento; devuelve (tag, vr, longitud, offset del valor)"""
+    group, element = struct.unpack_from(endian + 'HH', buf, offset)
+    offset += 4
+    
+    # Los ítems y delimitadores (FFFE,xxxx) siempre van con VR implícito
+    if not explicit or group == 0xFFFE:
+        length, = struct.unpack_from(endian + 'I', buf, offset)
+        return (group, element), None, length, offset + 4
+    
+    vr = bytes(buf[offset:offset + 2])
+    if vr in DICOM_LONG_VRS:
+        length, = struct.unpack_from(endian + 'I', buf, offset + 4)
+        return (group, element), vr, length, offset + 8
+    
+    length, = struct.unpack_from(endian + 'H', buf, offset + 2)
+    return (group, element), vr, length, offset + 4
+
+
+def _skip_dicom_undefined(buf, offset, explicit, endian):
+    """Salta una secuencia (o ítem) de longitud indefinida hasta su delimitador"""
+    while offset < len(buf):
+        tag, vr, length, offset = _read_dicom_element(buf, offset, explicit, endian)
+        if tag in ((0xFFFE, 0xE0DD), (0xFFFE, 0xE00D)):
+            return offset
+        if length == DICOM_UNDEFINED_LENGTH:
+            offset = _skip_dicom_undefined(buf, offset, explicit, endian)
+        elif tag != (0xFFFE, 0xE000):
+            offset += length
+        elif length:
+            offset += length
+    return offset
+
+
+def read_dicom_header(data, max_bytes=DICOM_HEADER_MAX_BYTES):
+    """
+    Lee sólo el preámbulo, el file meta header (grupo 0002) y los primeros elementos del dataset hasta
+    el último tag indexado, sin recorrer los datos de imagen. Devuelve un dict con los tags de
+    DICOM_INDEX_TAGS (más transfer_syntax) o None si no es DICOM.
+    """
+    if not is_dicom_data(data):
+        return None
+    
+    buf = memoryview(data)[:max_bytes]
+    tags = {}
+    offset = DICOM_PREAMBLE_LENGTH + 4
+    
+    try:
+        # File meta header: siempre explicit VR little endian
+        while offset + 8 <= len(buf) and struct.unpack_from('<H', buf, offset)[0] == 0x0002:
+            tag, vr, length, offset = _read_dicom_element(buf, offset, True, '<')
+            if tag == (0x0002, 0x0010):
+                tags['transfer_syntax'] = bytes(buf[offset:offset + length]).rstrip(b'\x00 ').decode('ascii', 'replace')
+            offset += length
+        
+        transfer_syntax = tags.get('transfer_syntax', '1.2.840.10008.1.2.1')
+        if transfer_syntax == '1.2.840.10008.1.2.1.99':
+            # Deflated: el dataset va comprimido, sólo hay datos del file meta
+            return tags
+        explicit = transfer_syntax != '1.2.840.10008.1.2'
+        endian = '>' if transfer_syntax == '1.2.840.10008.1.2.2' else '<'
+        
+        while offset + 8 <= len(buf):
+            tag, vr, length, offset = _read_dicom_element(buf, offset, explicit, endian)
+            if tag > DICOM_LAST_INDEX_TAG:
+                break
+            if length == DICOM_UNDEFINED_LENGTH:
+                offset = _skip_dicom_undefined(buf, offset, explicit, endian)
+                continue
+            if tag in DICOM_INDEX_TAGS:
+                value = bytes(buf[offset:offset + length]).rstrip(b'\x00 ')
+                tags[DICOM_INDEX_TAGS[tag]] = value.decode('latin-1').strip()
+            offset += length
+    except struct.error:
+        # Cabecera truncada (p. ej. sólo se leyó el comienzo): se devuelve lo leído
+        pass
+    
+    return tags
+
+
+class DicomIndex:
+    """
+    Índice local (SQLite) de los archivos DICOM descargados: paciente, estudio, serie, modalidad y fecha
+    de cada archivo, para consultar y agrupar estudios sin volver a abrir los archivos.
+    """
+    
+    COLUMNS = ('patient_id', 'patient_name', 'study_uid', 'series_uid', 'sop_instance_uid',
+               'modality', 'study_date', 'transfer_syntax')
+    
+    def __init__(self, index_path):
+        self.index_path = Path(index_path)
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        
+        self.conn = sqlite3.connect(str(self.index_path), timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS dicom_files (
+                path TEXT PRIMARY KEY,
+                email_id INTEGER,
+                {', '.join(f'{column} TEXT' for column in self.COLUMNS)},
+                size INTEGER,
+                indexed_at REAL NOT NULL
+            )
+        """)
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_dicom_study ON dicom_files (study_uid, series_uid)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_dicom_patient ON dicom_files (patient_id)')
+        self.conn.commit()
+    
+    def record(self, entries):
+        """Guarda (ruta, email_id, tamaño, tags) de varios archivos en una sola transacción"""
+        if not entries:
+            return
+        
+        now = time.time()
+        rows = [
+            (str(path), email_id, *(tags.get(column) for column in self.COLUMNS), size, now)
+            for path, email_id, size, tags in entries
+        ]
+        placeholders = ', '.join('?' * (len(self.COLUMNS) + 4))
+        with self.lock:
+            self.conn.executemany(f'INSERT OR REPLACE INTO dicom_files VALUES ({placeholders})', rows)
+            self.conn.commit()
+    
+    def studies(self, patient_id=None):
+        """Un registro por estudio: paciente, fecha, modalidades, series, archivos y bytes"""
+        query = """
+            SELECT study_uid, patient_id, MAX(patient_name), MIN(study_date),
+                   GROUP_CONCAT(DISTINCT modality), COUNT(DISTINCT series_uid), COUNT(*), SUM(size)
+            FROM dicom_files
+        """
+        params = ()
+        if patient_id is not None:
+            query += ' WHERE patient_id = ?'
+            params = (patient_id,)
+        query += ' GROUP BY study_uid, patient_id ORDER BY MIN(study_date), study_uid'
+        
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+        
+        return [
+            {
+                'study_uid': study_uid,
+                'patient_id': patient,
+                'patient_name': patient_name,
+                'study_date': study_date,
+                'modalities': sorted(filter(None, (modalities or '').split(','))),
+                'series': series,
+                'files': files,
+                'bytes': total_size or 0
+            }
+            for study_uid, patient, patient_name, study_date, modalities, series, files, total_size in rows
+        ]
+    
+    def files(self, study_uid):
+        """Rutas de los archivos de un estudio, agrupables por serie"""
+        with self.lock:
+            return self.conn.execute(
+                'SELECT series_uid, path FROM dicom_files WHERE study_uid = ? ORDER BY series_uid, path',
+                (study_uid,)
+            ).fetchall()
+    
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.tif', '.webp'}
+
+
+def compute_image_dhash(data):
+    """dHash de 64 bits (gradiente horizontal de la imagen en grises reducida a 9x8); None si no se puede leer"""
+    if Image is None or np is None:
+        return None
+    
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            # En JPEG draft() decodifica directamente a escala reducida, sin pasar por la resolución completa
+            image.draft('L', (64, 64))
+            pixels = np.asarray(image.convert('L').resize((9, 8), Image.Resampling.LANCZOS), dtype=np.int16)
+    except Exception:
+        return None
+    
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+class PerceptualHashIndex:
+    """
+    Índice de casi duplicados: un dHash de 64 bits por imagen guardado en un arreglo NumPy (8 bytes por
+    imagen) y persistido en .npz. La distancia de Hamming se calcula contra todo el índice de una vez
+    (XOR + popcount vectorizados), así que cada consulta es O(n) en C aun con 100k imágenes.
+    """
+    
+    def __init__(self, index_path=None, max_distance=6, workers=4):
+        self.index_path = Path(index_path) if index_path else None
+        self.max_distance = max_distance
+        self.read_only = False
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='phash')
+        self.hashes = np.empty(1024, dtype=np.uint64)
+        self.paths = []
+        self.count = 0
+        self.dirty = False
+        # Rutas agregadas en esta ejecución: pueden seguir en la etapa de escritura, se dan por existentes
+        self.session_paths = set()
+        
+        if self.index_path is not None and self.index_path.exists():
+            with np.load(self.index_path, allow_pickle=False) as stored:
+                hashes = stored['hashes']
+                paths = bytes(stored['paths']).decode('utf-8')
+            self.count = len(hashes)
+            self.hashes = np.empty(max(1024, self.count * 2), dtype=np.uint64)
+            self.hashes[:self.count] = hashes
+            self.paths = paths.split('\n') if self.count else []
+    
+    @staticmethod
+    def _popcount(values):
+        if hasattr(np, 'bitwise_count'):
+            return np.bitwise_count(values)
+        return np.unpackbits(values.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+    
+    def hash_many(self, datas):
+        """Calcula los dHash de varias imágenes en el pool (Pillow libera el GIL al decodificar)"""
+        return list(self.executor.map(compute_image_dhash, datas))
+    
+    def find(self, image_hash, scope=None):
+        """
+        Devuelve (ruta, distancia) de la imagen indexada más parecida a distancia <= max_distance, o None.
+        Con scope sólo cuentan rutas bajo esa carpeta; se ignoran archivos que ya no existen.
+        """
+        with self.lock:
+            if not self.count:
+                return None
+            distances = self._popcount(self.hashes[:self.count] ^ np.uint64(image_hash))
+            candidates = np.flatnonzero(distances <= self.max_distance)
+            candidates = candidates[np.argsort(distances[candidates], kind='stable')]
+            matches = [(self.paths[position], int(distances[position])) for position in candidates]
+        
+        for path, distance in matches:
+            if (scope is None or path.startswith(scope)) and (path in self.session_paths or os.path.exists(path)):
+                return path, distance
+        return None
+    
+    def add(self, image_hash, path):
+        with self.lock:
+            if self.count == len(self.hashes):
+                grown = np.empty(len(self.hashes) * 2, dtype=np.uint64)
+                grown[:self.count] = self.hashes[:self.count]
+                self.hashes = grown
+            self.hashes[self.count] = image_hash
+            self.paths.append(str(path))
+            self.session_paths.add(str(path))
+            self.count += 1
+            self.dirty = True
+    
+    def save(self):
+        """Persiste el índice (escritura atómica); no hace nada si no hubo cambios o es de sólo lectura"""
+        if self.index_path is None or self.read_only or not self.dirty:
+            return
+        
+        with self.lock:
+            self.index_path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = self.index_path.with_name(self.index_path.name + '.tmp')
+            with open(temp_path, 'wb') as temp_file:
+                np.savez_compressed(
+                    temp_file,
+                    hashes=self.hashes[:self.count],
+                    paths=np.frombuffer('\n'.join(self.paths).encode('utf-8'), dtype=np.uint8)
+                )
+            os.replace(temp_path, self.index_path)
+            self.dirty = False
+    
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.save()
+
+
+def make_thumbnail(source_path, target_path, size, image_format):
+    """Genera la miniatura de un archivo (en un proceso aparte); devuelve la ruta o None si no es legible"""
+    target_path = Path(target_path)
+    if target_path.exists():
+        return str(target_path)
+    
+    try:
+        source = io.BytesIO(read_stored_file(source_path)) if stored_compression(source_path) else source_path
+        with Image.open(source) as image:
+            # draft() hace que el decodificador JPEG entregue directamente una versión reducida
+            image.draft('RGB', (size, size))
+            image.thumbnail((size, size), Image.Resampling.LANCZOS)
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            
+            target_path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = target_path.with_name(f"{target_path.name}.{os.getpid()}.tmp")
+            image.save(temp_path, image_format, quality=80)
+            os.replace(temp_path, target_path)
+    except Exception:
+        return None
+    
+    return str(target_path)
+
+
+class ThumbnailCache:
+    """
+    Miniaturas de las imágenes guardadas, en una caché direccionada por el MD5 del contenido
+    (<cache_dir>/ab/abcdef....webp): la misma imagen en varias ejecuciones o carpetas se genera una
+    sola vez. La generación corre en un pool de procesos y nunca bloquea la descarga.
+    """
+    
+    def __init__(self, cache_dir='.cache/miniaturas', size=256, image_format='WEBP', workers=2):
+        self.cache_dir = Path(cache_dir)
+        self.size = int(size)
+        self.image_format = self.resolve_format(image_format)
+        self.executor = ProcessPoolExecutor(max_workers=max(1, workers))
+    
+    @staticmethod
+    def available():
+        """Las miniaturas requieren Pillow"""
+        return Image is not None
+    
+    @staticmethod
+    def resolve_format(image_format):
+        image_format = (image_format or 'WEBP').upper()
+        if image_format == 'WEBP' and (features is None or not features.check('webp')):
+            return 'JPEG'
+        return image_format
+    
+    @classmethod
+    def thumbnail_path(cls, cache_dir, md5, image_format='WEBP'):
+        extension = '.webp' if cls.resolve_format(image_format) == 'WEBP' else '.jpg'
+        return Path(cache_dir) / md5[:2] / f"{md5}{extension}"
+    
+    def submit(self, file_path, md5):
+        """Encola la miniatura de un archivo ya escrito; no hace nada si ya está en la caché"""
+        if Path(original_file_name(file_path)).suffix.lower() not in IMAGE_EXTENSIONS or not md5:
+            return
+        
+        target_path = self.thumbnail_path(self.cache_dir, md5, self.image_format)
+        if target_path.exists():
+            return
+        
+        self.executor.submit(make_thumbnail, str(file_path), str(target_path), self.size, self.image_format)
+    
+    def close(self):
+        self.executor.shutdown(wait=True)
+    
+    @staticmethod
+    def load_gallery(attachments_file):
+        """Imágenes guardadas de una ejecución (ruta, md5, nombre original) desde su tabla de adjuntos"""
+        attachments_file = Path(attachments_file)
+        columns = ['ruta_archivo', 'md5', 'nombre_original']
+        
+        if attachments_file.suffix == '.parquet':
+            rows = pq.read_table(str(attachments_file), columns=columns).to_pylist()
+        else:
+            with open(attachments_file, 'r', newline='', encoding='utf-8') as csvfile:
+                rows = [{column: row[column] for column in columns} for row in csv.DictReader(csvfile)]
+        
+        return [
+            row for row in rows
+            if row['ruta_archivo'] and row['md5'] and Path(original_file_name(row['ruta_archivo'])).suffix.lower() in IMAGE_EXTENSIONS
+        ]
+
+
+ARCHIVE_CONTENT_TYPES = {'application/zip', 'application/x-zip-compressed', 'application/x-zip'}
+
+
+class ArchiveExpander:
+    """
+    Expande adjuntos ZIP en memoria (sin extraer a disco) y entrega de a uno los miembros con tipos
+    permitidos, por extensión o por magic bytes. Limita cantidad de miembros, tamaño por miembro,
+    tamaño total y tasa de compresión (zip bombs); los tamaños declarados no se dan por buenos y
+    cada lectura se corta en el límite. Unos pocos miembros se descomprimen por adelantado en
+    paralelo (zlib libera el GIL), cada uno reservado antes de leerlo.
+    """
+    
+    HEAD_BYTES = 256
+    
+    def __init__(self, detect_extension, max_members=2000, max_member_mb=512, max_total_mb=2048,
+                 max_ratio=200, workers=4):
+        self.detect_extension = detect_extension
+        self.max_members = int(max_members)
+        self.max_member_bytes = int(max_member_mb * 1024 * 1024)
+        self.max_total_bytes = int(max_total_mb * 1024 * 1024)
+        self.max_ratio = max_ratio
+        self.workers = max(1, workers)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='zip')
+    
+    @staticmethod
+    def is_ignored_member(info):
+        return info.is_dir() or info.filename.startswith('__MACOSX/') or Path(info.filename).name.startswith('._')
+    
+    def may_contain_allowed(self, infos, allowed_extensions):
+        """
+        Clasificación por nombre (sin leer datos): True si algún miembro tiene una extensión permitida
+        o podría tenerla por magic bytes (sin extensión o con una desconocida, p. ej. DICOM sin '.dcm')
+        """
+        for info in infos:
+            if self.is_ignored_member(info) or info.flag_bits & 0x1:
+                continue
+            extension = Path(info.filename).suffix.lower()
+            if extension in allowed_extensions or not extension or mimetypes.guess_type(info.filename)[0] is None:
+                return True
+        return False
+    
+    def classify(self, data, allowed_extensions):
+        """Clasifica un ZIP completo leyendo sólo el comienzo de cada miembro: True si tiene alguno permitido"""
+        allowed_extensions = set(allowed_extensions)
+        try:
+            with zipfile.ZipFile(io.BytesIO(data)) as archive:
+                for info in archive.infolist()[:self.max_members]:
+                    if self.is_ignored_member(info) or info.flag_bits & 0x1:
+                        continue
+                    if Path(info.filename).suffix.lower() in allowed_extensions:
+                        return True
+                    with archive.open(info) as member:
+                        detected = self.detect_extension(member.read(self.HEAD_BYTES))
+                    if detected and detected in allowed_extensions:
+                        return True
+        except (zipfile.BadZipFile, OSError, RuntimeError):
+            return False
+        return False
+    
+    def list_tail_members(self, tail):
+        """
+        Miembros de un ZIP a partir de sus últimos bytes (directorio central + registro final),
+        sin tener el archivo completo; None si el directorio central no entra en ese tramo
+        """
+        try:
+            with zipfile.ZipFile(io.BytesIO(tail)) as archive:
+                return archive.infolist()
+        except (zipfile.BadZipFile, OSError, ValueError):
+            return None
+    
+    def _scan(self, infos, warnings):
+        """Aplica los límites de cantidad, tamaño y tasa de compresión a partir del directorio central"""
+        candidates = []
+        declared_total = 0
+        for info in infos:
+            name = info.filename
+            if self.is_ignored_member(info):
+                continue
+            if info.flag_bits & 0x1:
+                warnings.append(f"{name}: cifrado")
+                continue
+            if info.file_size > self.max_member_bytes:
+                warnings.append(f"{name}: supera el tamaño máximo por miembro")
+                continue
+            if info.file_size > 1024 * 1024 and info.file_size > info.compress_size * self.max_ratio:
+                warnings.append(f"{name}: tasa de compresión sospechosa")
+                continue
+            if len(candidates) >= self.max_members or declared_total + info.file_size > self.max_total_bytes:
+                warnings.append(f"Límite del ZIP alcanzado: se omiten {name} y los siguientes")
+                break
+            declared_total += info.file_size
+            candidates.append(info)
+        return candidates
+    
+    def iter_members(self, data, allowed_extensions, warnings, reserve=None, release=None):
+        """
+        Genera (nombre, datos, estrategia, reservado) de los miembros aceptados, en orden, y agrega los
+        avisos a warnings. reserve(bytes, pendientes) se llama con el tamaño declarado antes de leer cada
+        miembro (pendientes: lo ya reservado por este ZIP y aún no entregado); quien consume libera
+        'reservado' con release() cuando termina de usar los datos. Los miembros descartados se liberan acá.
+        """
+        allowed_extensions = set(allowed_extensions)
+        try:
+            with zipfile.ZipFile(io.BytesIO(data)) as archive:
+                candidates = self._scan(archive.infolist(), warnings)
+        except (zipfile.BadZipFile, OSError) as e:
+            warnings.append(f"ZIP ilegible: {e}")
+            return
+        
+        def read_member(info):
+            # Cada hilo usa su propio ZipFile: el objeto no es seguro para lecturas concurrentes
+            with zipfile.ZipFile(io.BytesIO(data)) as member_archive, member_archive.open(info) as member:
+                name = Path(info.filename).name
+                extension = Path(name).suffix.lower()
+                head = member.read(self.HEAD_BYTES)
+                
+                if extension in allowed_extensions:
+                    strategy = 'zip_filename'
+                else:
+                    detected = self.detect_extension(head)
+                    if not detected or detected not in allowed_extensions:
+                        return None
+                    strategy = 'zip_magic_bytes'
+                    if extension != detected:
+                        name = f"{name}{detected}"
+                
+                # Se lee hasta un byte más de lo declarado (y reservado) para detectar tamaños falsos
+                content = head + member.read(info.file_size + 1 - len(head))
+            
+            if len(content) > info.file_size:
+                return ('', None, f"{info.filename}: tamaño real mayor al declarado")
+            return (name, content, strategy)
+        
+        guarded_read = self._guard(read_member)
+        window = []
+        pending = {'bytes': 0}
+        remaining = iter(candidates)
+        
+        def submit_next():
+            info = next(remaining, None)
+            if info is None:
+                return
+            if reserve is not None:
+                reserve(info.file_size, pending['bytes'])
+            pending['bytes'] += info.file_size
+            window.append((info, self.executor.submit(guarded_read, info)))
+        
+        try:
+            for _ in range(self.workers):
+                submit_next()
+            
+            while window:
+                info, future = window.pop(0)
+                result = future.result()
+                pending['bytes'] -= info.file_size
+                
+                if result is None or result[1] is None:
+                    if release is not None:
+                        release(info.file_size)
+                    if result is not None:
+                        warnings.append(result[2])
+                    submit_next()
+                    continue
+                
+                name, content, strategy = result
+                yield name, content, strategy, info.file_size
+                submit_next()
+        finally:
+            # Consumo interrumpido: se esperan y liberan los miembros leídos por adelantado
+            for info, future in window:
+                future.result()
+                if release is not None:
+                    release(info.file_size)
+    
+    @staticmethod
+    def _guard(read_member):
+        def guarded(info):
+            try:
+                return read_member(info)
+            except Exception as e:
+                return ('', None, f"{info.filename}: {e}")
+        return guarded
+    
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+TRACKING_QUERY_PARAMS = ('utm_', 'fbclid', 'gclid', 'mc_cid', 'mc_eid')
+# Tipos que puede devolver un enlace a imagen/documento (el resto se descarta con el HEAD previo)
+LINK_CONTENT_TYPES = ('image/', 'application/pdf', 'application/dicom', 'application/octet-stream')
+
+
+def normalize_download_url(url):
+    """Clave de caché de una URL: esquema y host en minúsculas, sin fragmento ni parámetros de seguimiento, query ordenada"""
+    parsed = urlparse(url.strip())
+    query = sorted(
+        (name, value) for name, value in parse_qsl(parsed.query, keep_blank_values=True)
+        if not name.lower().startswith(TRACKING_QUERY_PARAMS)
+    )
+    netloc = parsed.netloc.lower()
+    if (parsed.scheme == 'https' and netloc.endswith(':443')) or (parsed.scheme == 'http' and netloc.endswith(':80')):
+        netloc = netloc.rsplit(':', 1)[0]
+    return urlunparse((parsed.scheme.lower(), netloc, parsed.path or '/', '', urlencode(query), ''))
+
+
+class HttpDownloadCache:
+    """
+    Caché persistente (SQLite) de descargas por enlace, con clave URL normalizada o 'drive:<file_id>':
+    guarda ETag, Last-Modified, tipo, MD5 y la ruta del archivo ya descargado, para resolver las
+    referencias repetidas desde disco o con una revalidación condicional (304) en lugar de bajar el cuerpo.
+    """
+    
+    COLUMNS = ('key', 'url', 'etag', 'last_modified', 'content_type', 'content_disposition',
+               'size', 'md5', 'path', 'fetched_at')
+    
+    def __init__(self, cache_path):
+        self.cache_path = Path(cache_path)
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.revalidations = 0
+        self.lock = threading.Lock()
+        
+        self.conn = sqlite3.connect(str(self.cache_path), timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS downloads (
+                key TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                content_type TEXT,
+                content_disposition TEXT,
+                size INTEGER NOT NULL,
+                md5 TEXT NOT NULL,
+                path TEXT NOT NULL,
+                fetched_at REAL NOT NULL
+            )
+        """)
+        self.conn.commit()
+    
+    def get(self, key):
+        """Entrada de la caché como dict, o None si no existe o su archivo ya no está (o cambió de tamaño)"""
+        with self.lock:
+            row = self.conn.execute(f"SELECT {', '.join(self.COLUMNS)} FROM downloads WHERE key=?", (key,)).fetchone()
+        
+        if row is None:
+            return None
+        entry = dict(zip(self.COLUMNS, row))
+        if not os.path.isfile(entry['path']) or os.path.getsize(entry['path']) != entry['size']:
+            return None
+        return entry
+    
+    def put(self, entry):
+        with self.lock:
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO downloads VALUES ({', '.join('?' * len(self.COLUMNS))})",
+                tuple(entry[column] for column in self.COLUMNS)
+            )
+            self.conn.commit()
+    
+    def touch(self, key):
+        """Marca una entrada como recién validada (respuesta 304)"""
+        with self.lock:
+            self.conn.execute('UPDATE downloads SET fetched_at=? WHERE key=?', (time.time(), key))
+            self.conn.commit()
+    
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class AdaptiveRateController:
+    """
+    Control de ritmo AIMD para comandos contra un servidor: con respuestas limpias el ritmo sube de forma
+    aditiva y ante una señal de limitación ([THROTTLED], NO [LIMIT], HTTP 429/503, conexión cortada) baja
+    a la mitad y se espera con jitter. Compartido entre hilos: todas las conexiones a la misma cuenta
+    respetan el mismo ritmo.
+    """
+    
+    THROTTLE_MARKERS = ('THROTTLED', '[LIMIT]', 'OVERQUOTA', '[UNAVAILABLE]', 'TOO MANY', 'RATE LIMIT', 'BANDWIDTH')
+    
+    def __init__(self, initial_delay=1.0, min_delay=0.05, max_delay=60.0, increase_step=0.25, decrease_factor=0.5, jitter=0.5):
+        self.min_rate = 1.0 / max_delay
+        self.max_rate = 1.0 / min_delay if min_delay > 0 else float('inf')
+        self.rate = min(self.max_rate, 1.0 / initial_delay) if initial_delay > 0 else self.max_rate
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.jitter = jitter
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+        
+        self.started_at = None
+        self.commands = 0
+        self.throttles = 0
+        self.waited_seconds = 0.0
+    
+    @classmethod
+    def is_throttle_signal(cls, text):
+        """Indica si el texto de una respuesta o excepción es una señal de limitación del servidor"""
+        if not text:
+            return False
+        if isinstance(text, (list, tuple)):
+            text = b' '.join(t if isinstance(t, bytes) else str(t).encode() for t in text if t is not None)
+        if isinstance(text, bytes):
+            text = text.decode('utf-8', errors='replace')
+        text = text.upper()
+        return any(marker in text for marker in cls.THROTTLE_MARKERS)
+    
+    def wait(self):
+        """Espera hasta el siguiente turno permitido por el ritmo actual"""
+        with self.lock:
+            now = time.monotonic()
+            if self.started_at is None:
+                self.started_at = now
+            slot = max(now, self.next_slot)
+            interval = 1.0 / self.rate if self.rate != float('inf') else 0.0
+            self.next_slot = slot + interval
+            self.commands += 1
+            delay = slot - now
+            self.waited_seconds += delay
+        
+        if delay > 0:
+            time.sleep(delay)
+    
+    def on_success(self):
+        """Aumento aditivo del ritmo tras una respuesta limpia"""
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase_step)
+    
+    def on_throttle(self, retry_after=None):
+        """Reducción multiplicativa del ritmo y pausa con jitter; devuelve los segundos de pausa"""
+        with self.lock:
+            self.throttles += 1
+            # Sin límite superior configurado se parte de 10 comandos/segundo
+            current_rate = self.rate if self.rate != float('inf') else 10.0
+            self.rate = max(self.min_rate, current_rate * self.decrease_factor)
+            backoff = max(float(retry_after or 0), 1.0 / self.rate) * random.uniform(1.0, 1.0 + self.jitter)
+            self.next_slot = max(self.next_slot, time.monotonic() + backoff)
+        return backoff
+    
+    def get_stats(self):
+        """Ritmo logrado (comandos/segundo), ritmo actual permitido y limitaciones recibidas"""
+        elapsed = time.monotonic() - self.started_at if self.started_at is not None else 0.0
+        return {
+            'commands': self.commands,
+            'throttles': self.throttles,
+            'achieved_rate': self.commands / elapsed if elapsed > 0 else 0.0,
+            'current_rate': self.rate if self.rate != float('inf') else None,
+            'waited_seconds': self.waited_seconds
+        }
+
+
+class OfflineMessageSource:
+    """
+    Fuente de mensajes sin servidor: archivo mbox (índice de offsets de los separadores 'From '
+    construido una sola vez con mmap y guardado junto al archivo), carpeta Maildir o archivos .eml.
+    Los identificadores son la posición en el índice (1..n), en bytes como los UID de IMAP.
+    En Maildir y .eml los archivos se ordenan por una clave estable de cada mensaje (nombre único
+    de Maildir sin carpeta ni marcas, ruta relativa del .eml), y la huella de la fuente se calcula
+    sobre esa lista: si aparece o desaparece un mensaje los IDs cambian y el diario no se reanuda.
+    mbox_format: 'mboxrd' (se quita un '>' de las líneas '>From ') o 'mboxo' (el cuerpo queda tal cual).
+    """
+    
+    MBOX_FORMATS = ('mboxrd', 'mboxo')
+    
+    def __init__(self, source_type, path, mbox_format='mboxrd'):
+        self.source_type = source_type
+        self.path = Path(path)
+        self.mbox_format = mbox_format if mbox_format in self.MBOX_FORMATS else 'mboxrd'
+        self.offsets = None
+        self.dates = None
+        self.files = None
+        self.keys = None
+        self._fingerprint = None
+        self._file = None
+        self._mmap = None
+        
+        if source_type == 'mbox':
+            self._open_mbox()
+        elif source_type == 'maildir':
+            # Maildir: mensajes en cur/ y new/ (tmp/ son entregas a medio escribir)
+            files = [p for folder in ('cur', 'new') for p in (self.path / folder).glob('*') if p.is_file()]
+            self._set_files(files, self.maildir_key)
+        elif source_type == 'eml':
+            files = [self.path] if self.path.is_file() else list(self.path.rglob('*.eml'))
+            self._set_files(files, lambda p: p.relative_to(self.path).as_posix() if p != self.path else p.name)
+        else:
+            raise ValueError(f"Tipo de fuente desconocido: {source_type}")
+    
+    @staticmethod
+    def maildir_key(path):
+        """Nombre único del mensaje en Maildir: no cambia al pasar de new/ a cur/ ni al cambiar las marcas (':2,S')"""
+        return path.name.split(':', 1)[0]
+    
+    def _set_files(self, files, key):
+        keyed = sorted((key(p), p) for p in files)
+        self.keys = [k for k, _ in keyed]
+        self.files = [p for _, p in keyed]
+    
+    @property
+    def fingerprint(self):
+        """Identificador de la versión de la fuente (equivalente a UIDVALIDITY para el diario)"""
+        if self._fingerprint is None:
+            if self.keys is None:
+                stat = self.path.stat()
+                raw = f"{self.path.resolve()}:{stat.st_size}:{stat.st_mtime_ns}".encode()
+            else:
+                raw = '\0'.join([str(self.path.resolve())] + self.keys).encode('utf-8', 'surrogateescape')
+            self._fingerprint = int(hashlib.sha1(raw).hexdigest()[:12], 16)
+        return self._fingerprint
+    
+    def _index_paths(self):
+        return self.path.with_name(self.path.name + '.offsets'), self.path.with_name(self.path.name + '.offsets.json')
+    
+    def _open_mbox(self):
+        self._file = open(self.path, 'rb')
+        size = self.path.stat().st_size
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        
+        offsets_path, meta_path = self._index_paths()
+        stat = self.path.stat()
+        
+        # Índice en caché: válido mientras el mbox no cambie de tamaño ni de fecha de modificación
+        if offsets_path.exists() and meta_path.exists():
+            try:
+                meta = json.loads(meta_path.read_text(encoding='utf-8'))
+                if meta['size'] == stat.st_size and meta['mtime_ns'] == stat.st_mtime_ns:
+                    with open(offsets_path, 'rb') as index_file:
+                        self.offsets = array.array('Q')
+                        self.offsets.fromfile(index_file, meta['count'])
+                        self.dates = array.array('q')
+                        self.dates.fromfile(index_file, meta['count'])
+                    return
+            except Exception:
+                pass
+        
+        self._build_mbox_index()
+        
+        try:
+            with open(offsets_path, 'wb') as index_file:
+                self.offsets.tofile(index_file)
+                self.dates.tofile(index_file)
+            meta_path.write_text(json.dumps({
+                'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'count': len(self.offsets)
+            }), encoding='utf-8')
+        except OSError:
+            # Sin permiso de escritura junto al mbox: el índice se reconstruirá la próxima vez
+            pass
+    
+    def _build_mbox_index(self):
+        """Recorre el mbox buscando las líneas separadoras 'From ' y la fecha que llevan"""
+        self.offsets = array.array('Q')
+        self.dates = array.array('q')
+        data = self._mmap
+        position = 0 if data[:5] == b'From ' else data.find(b'\nFrom ')
+        if position > 0:
+            position += 1
+        
+        while position >= 0 and position < len(data):
+            line_end = data.find(b'\n', position)
+            from_line = data[position:line_end if line_end >= 0 else len(data)]
+            self.offsets.append(position)
+            self.dates.append(self._parse_from_line_date(from_line))
+            
+            next_separator = data.find(b'\nFrom ', position + 1)
+            position = next_separator + 1 if next_separator >= 0 else -1
+    
+    @staticmethod
+    def _parse_from_line_date(from_line):
+        """Fecha (ordinal de día) de la línea 'From remitente Wed Jan  3 10:00:00 2024'; 0 si no se reconoce"""
+        try:
+            parts = from_line.decode('ascii', errors='replace').split()
+            return datetime.strptime(' '.join(parts[-5:]), '%a %b %d %H:%M:%S %Y').toordinal()
+        except (ValueError, IndexError):
+            return 0
+    
+    def __len__(self):
+        return len(self.offsets) if self.offsets is not None else len(self.files)
+    
+    def list_ids(self, start_date=None, end_date=None):
+        """IDs de los mensajes; en mbox se descartan por la fecha del separador los que están fuera del rango"""
+        if self.offsets is None or start_date is None or end_date is None:
+            return [str(index).encode() for index in range(1, len(self) + 1)]
+        
+        # Margen de un día: la línea 'From ' usa la hora local de entrega
+        first_day = start_date.toordinal() - 1
+        last_day = end_date.toordinal() + 1
+        return [str(index + 1).encode() for index, day in enumerate(self.dates) if day == 0 or first_day <= day <= last_day]
+    
+    def get_raw(self, message_id):
+        """Mensaje crudo por ID (1..n)"""
+        index = int(message_id) - 1
+        
+        if self.offsets is not None:
+            start = self.offsets[index]
+            end = self.offsets[index + 1] if index + 1 < len(self.offsets) else len(self._mmap)
+            raw = self._mmap[start:end]
+            # Se quita la línea separadora 'From ' y, en mboxrd, el escape '>From ' de las líneas del cuerpo
+            raw = raw[raw.find(b'\n') + 1:]
+            if self.mbox_format == 'mboxrd':
+                return re.sub(rb'(?m)^>(>*From )', rb'\1', raw)
+            return raw
+        
+        return self.files[index].read_bytes()
+    
+    def close(self):
+        if self._mmap:
+            self._mmap.close()
+        if self._file:
+            self._file.close()
+
+
+class SharedMessageFetch:
+    """Fuente de mensajes de los perfiles: cada mensaje se obtiene una sola vez y lo evalúan todos los perfiles"""
+    
+    def __init__(self, fetch):
+        self.fetch = fetch
+        self.email_id = None
+        self.raw = None
+    
+    def get_raw(self, email_id):
+        if email_id != self.email_id:
+            self.raw = self.fetch(email_id)
+            self.email_id = email_id
+        return self.raw
+    
+    def close(self):
+        self.email_id = None
+        self.raw = None
+
+
+class RunJournal:
+    """
+    Diario persistente (JSON Lines) de una ejecución: registra el veredicto de análisis
+    y el resultado de descarga de cada email a medida que ocurren, para poder reanudar
+    una ejecución interrumpida sin volver a descargar los mensajes ya completados.
+    En memoria sólo queda un índice por UID (estado, aprobado y posición de sus líneas);
+    la fila y los adjuntos se vuelven a leer del archivo al reanudar ese email.
+    """
+    
+    DOWNLOAD_FIELDS = ('estado', 'archivos_descargados', 'ruta_descarga', 'motivo_rechazo')
+    
+    def __init__(self, journal_path, signature, uidvalidity):
+        self.journal_path = Path(journal_path)
+        self.signature = signature
+        self.uidvalidity = uidvalidity
+        # uid -> [estado, aprobado, posición de la línea de análisis, posición de la línea de descarga]
+        self.index = {}
+        self.lock = threading.Lock()
+        self.resumed = False
+        self._file = None
+        self._reader = None
+    
+    def open(self):
+        """Carga el diario existente (si corresponde a esta configuración) y lo abre para escritura"""
+        self.journal_path.parent.mkdir(parents=True, exist_ok=True)
+        
+        if self.journal_path.exists() and self._load():
+            self.resumed = True
+            self._file = open(self.journal_path, 'ab')
+        else:
+            # Diario nuevo: el anterior (ejecución terminada o UIDVALIDITY distinto) se descarta
+            self.index.clear()
+            self._file = open(self.journal_path, 'wb')
+            self._write({'e': 'start', 'signature': self.signature, 'uidvalidity': self.uidvalidity})
+        
+        return self
+    
+    def _load(self):
+        """Reconstruye el índice desde el diario; devuelve False si no es reanudable"""
+        completed = False
+        offset = 0
+        
+        with open(self.journal_path, 'rb') as journal_file:
+            for line_number, line in enumerate(journal_file):
+                line_offset = offset
+                offset += len(line)
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Última línea truncada por una interrupción: se ignora
+                    continue
+                
+                event = entry.get('e')
+                if line_number == 0:
+                    if event != 'start' or entry.get('signature') != self.signature:
+                        return False
+                    if entry.get('uidvalidity') != self.uidvalidity:
+                        return False
+                elif event == 'analysis':
+                    self.index[entry['uid']] = [entry['row']['estado'], entry['approved'], line_offset, None]
+                elif event == 'download' and entry['uid'] in self.index:
+                    self.index[entry['uid']][0] = entry['estado']
+                    self.index[entry['uid']][3] = line_offset
+                elif event == 'completed':
+                    completed = True
+        
+        if not completed and self.index and not line.endswith(b'\n'):
+            # Se completa la línea truncada para que la próxima entrada empiece en una línea propia
+            with open(self.journal_path, 'ab') as journal_file:
+                journal_file.write(b'\n')
+        
+        return not completed and bool(self.index)
+    
+    def _write(self, entry):
+        """Agrega una entrada al diario; devuelve la posición de su línea en el archivo"""
+        line = (json.dumps(entry, ensure_ascii=False, default=str) + '\n').encode('utf-8')
+        with self.lock:
+            offset = self._file.tell()
+            self._file.write(line)
+            self._file.flush()
+        return offset
+    
+    def _read_entry(self, offset):
+        with self.lock:
+            if self._reader is None:
+                self._reader = open(self.journal_path, 'rb')
+            self._reader.seek(offset)
+            return json.loads(self._reader.readline())
+    
+    def record_analysis(self, uid, approved, row):
+        """Registra el veredicto del análisis de un email"""
+        uid = int(uid)
+        offset = self._write({'e': 'analysis', 'uid': uid, 'approved': approved, 'row': row})
+        self.index[uid] = [row['estado'], approved, offset, None]
+    
+    def record_download(self, uid, estado, archivos_descargados, ruta_descarga, adjuntos=None, motivo_rechazo=None):
+        """Registra el resultado de la descarga de un email aprobado (con sus adjuntos guardados)"""
+        uid = int(uid)
+        entry = {'e': 'download', 'uid': uid, 'estado': estado,
+                 'archivos_descargados': archivos_descargados, 'ruta_descarga': ruta_descarga,
+                 'adjuntos': adjuntos or []}
+        if motivo_rechazo is not None:
+            entry['motivo_rechazo'] = motivo_rechazo
+        offset = self._write(entry)
+        if uid in self.index:
+            self.index[uid][0] = estado
+            self.index[uid][3] = offset
+    
+    def get_resumable(self, uid):
+        """Devuelve (fila, aprobado, adjuntos) si el email ya fue procesado sin error, o None"""
+        indexed = self.index.get(int(uid))
+        if indexed is None or indexed[0] == 'ERROR':
+            return None
+        
+        estado, approved, analysis_offset, download_offset = indexed
+        row = self._read_entry(analysis_offset)['row']
+        attachments = []
+        if download_offset is not None:
+            download = self._read_entry(download_offset)
+            row.update({key: download[key] for key in self.DOWNLOAD_FIELDS if key in download})
+            attachments = download.get('adjuntos', [])
+        return row, approved, attachments
+    
+    def mark_completed(self):
+        """Marca la ejecución como terminada: la próxima ejecución empezará un diario nuevo"""
+        self._write({'e': 'completed', 'at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')})
+    
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+        if self._reader:
+            self._reader.close()
+            self._reader = None
+
+
+class CapturedRowsWriter:
+    """Destino de una captura del reporte en disco: cada fila agregada se escribe como una línea JSON"""
+    
+    def __init__(self, capture_file, kind):
+        self.capture_file = capture_file
+        self.kind = kind
+    
+    def append(self, row):
+        self.capture_file.write(json.dumps({self.kind: row}, ensure_ascii=False, default=str) + '\n')
+
+
+class ReportTableWriter:
+    """Escritor incremental de una tabla del reporte en CSV o Parquet (por lotes)"""
+    
+    CSV_FLUSH_EVERY = 100
+    PARQUET_BATCH_SIZE = 1000
+    
+    def __init__(self, path, report_format, fieldnames, schema_fields):
+        self.path = Path(path)
+        self.report_format = report_format
+        self.fieldnames = fieldnames
+        self.schema_fields = schema_fields
+        self._batch = []
+        self._unflushed = 0
+        
+        if report_format == 'parquet':
+            if pq is None:
+                raise RuntimeError("El formato Parquet requiere pyarrow instalado")
+            self._file = None
+            self._writer = pq.ParquetWriter(str(self.path), self.schema())
+        else:
+            self._file = open(self.path, 'w', newline='', encoding='utf-8')
+            self._writer = csv.DictWriter(self._file, fieldnames=fieldnames)
+            self._writer.writeheader()
+    
+    def schema(self):
+        types = {'int': pa.int64(), 'str': pa.string()}
+        return pa.schema([(name, types[kind]) for name, kind in self.schema_fields])
+    
+    def write(self, row):
+        if self.report_format == 'parquet':
+            self._batch.append(row)
+            if len(self._batch) >= self.PARQUET_BATCH_SIZE:
+                self._flush_batch()
+        else:
+            self._writer.writerow(row)
+            self._unflushed += 1
+            if self._unflushed >= self.CSV_FLUSH_EVERY:
+                self._file.flush()
+                self._unflushed = 0
+    
+    def _flush_batch(self):
+        if self._batch:
+            self._writer.write_table(pa.Table.from_pylist(self._batch, schema=self.schema()))
+            self._batch = []
+    
+    def close(self):
+        if self._writer is None:
+            return
+        if self.report_format == 'parquet':
+            self._flush_batch()
+            self._writer.close()
+        else:
+            self._file.close()
+        self._writer = None
+
+
+class ReportStore:
+    """
+    Almacén del reporte indexado por email_id: las actualizaciones de estado son O(1),
+    mantiene contadores acumulados y escribe cada fila al archivo (CSV o Parquet) en cuanto
+    su estado es definitivo, de modo que la memoria no crece con el tamaño de la ejecución.
+    Junto a la tabla de emails mantiene una tabla normalizada de adjuntos guardados
+    (una fila por archivo, enlazada por email_id).
+    Sin ruta de archivo, las filas se conservan en memoria (uso por conexiones auxiliares).
+    """
+    
+    SCHEMA = [
+        ('email_id', 'int'),
+        ('fecha', 'str'),
+        ('remitente', 'str'),
+        ('asunto', 'str'),
+        ('archivos_adjuntos_total', 'int'),
+        ('tipos_archivos', 'str'),
+        ('estado', 'str'),
+        ('archivos_descargados', 'int'),
+        ('motivo_rechazo', 'str'),
+        ('ruta_descarga', 'str')
+    ]
+    ATTACHMENT_SCHEMA = [
+        ('email_id', 'int'),
+        ('indice', 'int'),
+        ('nombre_original', 'str'),
+        ('ruta_archivo', 'str'),
+        ('content_type', 'str'),
+        ('estrategia', 'str'),
+        ('tamano_bytes', 'int'),
+        ('md5', 'str'),
+        ('casi_duplicado_de', 'str'),
+        ('compresion', 'str'),
+        ('tamano_en_disco', 'int')
+    ]
+    FIELDNAMES = [name for name, _ in SCHEMA]
+    ATTACHMENT_FIELDNAMES = [name for name, _ in ATTACHMENT_SCHEMA]
+    PENDING_STATUS = 'PENDIENTE_DESCARGA'
+    
+    def __init__(self, report_path=None, report_format='csv'):
+        self.report_path = Path(report_path) if report_path else None
+        self.attachments_path = None
+        self.report_format = report_format
+        self.pending = {}
+        self.status_counts = {}
+        self.total_rows = 0
+        self.total_files = 0
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self._captured = None
+        self._captured_attachments = None
+        self._capture_file = None
+        self.tracked_statuses = ()
+        self.tracked_uids = set()
+        
+        if self.report_path is not None:
+            self.attachments_path = self.report_path.with_name(
+                f"{self.report_path.stem}_adjuntos{self.report_path.suffix}"
+            )
+            self.rows = None
+            self.attachment_rows = None
+            self._writer = ReportTableWriter(self.report_path, report_format, self.FIELDNAMES, self.SCHEMA)
+            self._attachment_writer = ReportTableWriter(
+                self.attachments_path, report_format, self.ATTACHMENT_FIELDNAMES, self.ATTACHMENT_SCHEMA
+            )
+        else:
+            self.rows = []
+            self.attachment_rows = []
+            self._writer = None
+            self._attachment_writer = None
+    
+    def add(self, row):
+        """Agrega una fila; las pendientes de descarga quedan indexadas hasta su actualización"""
+        with self.lock:
+            self.total_rows += 1
+            self.status_counts[row['estado']] = self.status_counts.get(row['estado'], 0) + 1
+            
+            if row['estado'] == self.PENDING_STATUS:
+                self.pending[row['email_id']] = row
+            else:
+                self._emit(row)
+    
+    def extend(self, rows):
+        for row in rows:
+            self.add(row)
+    
+    def update(self, email_id, estado, archivos_descargados, ruta_descarga, motivo_rechazo=None):
+        """Actualiza el estado de una fila pendiente y la escribe; devuelve False si no existía"""
+        with self.lock:
+            row = self.pending.pop(int(email_id), None)
+            if row is None:
+                return False
+            
+            self.status_counts[row['estado']] -= 1
+            self.status_counts[estado] = self.status_counts.get(estado, 0) + 1
+            row['estado'] = estado
+            row['archivos_descargados'] = archivos_descargados
+            row['ruta_descarga'] = ruta_descarga
+            if motivo_rechazo is not None:
+                row['motivo_rechazo'] = motivo_rechazo
+            self._emit(row)
+            return True
+    
+    def add_attachment(self, record):
+        """Registra un archivo guardado en la tabla de adjuntos"""
+        with self.lock:
+            self.total_bytes += record['tamano_bytes']
+            
+            if self._captured_attachments is not None:
+                self._captured_attachments.append(record)
+            
+            if self._attachment_writer is None:
+                self.attachment_rows.append(record)
+            else:
+                self._attachment_writer.write(record)
+    
+    def extend_attachments(self, records):
+        for record in records:
+            self.add_attachment(record)
+    
+    def track_statuses(self, statuses):
+        """Recuerda los email_id de las filas que terminen en estos estados (para marcarlos en el servidor)"""
+        self.tracked_statuses = frozenset(statuses)
+    
+    def _emit(self, row):
+        self.total_files += row['archivos_descargados'] or 0
+        
+        if row['estado'] in self.tracked_statuses:
+            self.tracked_uids.add(row['email_id'])
+        
+        if self._captured is not None:
+            self._captured.append(row)
+        
+        if self._writer is None:
+            self.rows.append(row)
+        else:
+            self._writer.write(row)
+    
+    def flush_pending(self):
+        """Escribe las filas que siguen pendientes (descarga nunca realizada) con su estado actual"""
+        with self.lock:
+            pending_rows = list(self.pending.values())
+            self.pending.clear()
+            for row in pending_rows:
+                self._emit(row)
+    
+    def begin_capture(self, capture_path=None):
+        """
+        Empieza a registrar las filas finalizadas (p. ej. para el checkpoint de una ventana); con
+        capture_path se vuelcan a un JSON Lines en disco en lugar de acumularse en memoria
+        """
+        if capture_path is not None:
+            self._capture_file = open(capture_path, 'w', encoding='utf-8')
+            self._captured = CapturedRowsWriter(self._capture_file, 'fila')
+            self._captured_attachments = CapturedRowsWriter(self._capture_file, 'adjunto')
+        else:
+            self._captured = []
+            self._captured_attachments = []
+    
+    def end_capture(self):
+        """
+        Termina el registro y devuelve (filas de emails, filas de adjuntos) desde begin_capture;
+        si la captura fue a disco las filas ya están en el archivo y se devuelve (None, None)
+        """
+        self.flush_pending()
+        if self._capture_file is not None:
+            self._capture_file.close()
+            self._capture_file = None
+            captured = (None, None)
+        else:
+            captured = (self._captured or [], self._captured_attachments or [])
+        self._captured = None
+        self._captured_attachments = None
+        return captured
+    
+    def extend_captured(self, capture_path):
+        """Incorpora las filas y adjuntos de una captura en disco, de a una línea"""
+        with open(capture_path, 'r', encoding='utf-8') as capture_file:
+            for line in capture_file:
+                entry = json.loads(line)
+                if 'fila' in entry:
+                    self.add(entry['fila'])
+                else:
+                    self.add_attachment(entry['adjunto'])
+    
+    def count(self, estado):
+        return self.status_counts.get(estado, 0)
+    
+    def close(self):
+        """Vacía las filas pendientes y cierra los archivos del reporte"""
+        self.flush_pending()
+        
+        if self._writer is not None:
+            self._writer.close()
+            self._attachment_writer.close()
+
+
+# Almacenamiento comprimido: 'estudio.dcm' se guarda como 'estudio.dcm.zst' (o '.gz'). Sólo formatos sin
+# compresión propia; los lectores reconocen el sufijo doble y entregan el contenido original
+STORAGE_CODEC_SUFFIXES = {'zstd': '.zst', 'gzip': '.gz'}
+STORAGE_DEFAULT_LEVELS = {'zstd': 3, 'gzip': 6}
+STORAGE_COMPRESSIBLE_EXTENSIONS = {'.dcm', '.bmp', '.tif', '.tiff', '.txt', '.csv', '.xml', '.json', '.doc', '.xls'}
+
+
+def stored_compression(file_path):
+    """Códec con el que se guardó un archivo ('zstd', 'gzip') o None si está tal cual"""
+    path = Path(file_path)
+    if Path(path.stem).suffix.lower() not in STORAGE_COMPRESSIBLE_EXTENSIONS:
+        return None
+    for codec, suffix in STORAGE_CODEC_SUFFIXES.items():
+        if path.suffix.lower() == suffix:
+            return codec
+    return None
+
+
+def original_file_name(file_path):
+    """Nombre del archivo sin el sufijo de almacenamiento comprimido"""
+    path = Path(file_path)
+    return path.stem if stored_compression(path) else path.name
+
+
+def compress_for_storage(data, codec, level):
+    if codec == 'zstd':
+        # El tamaño original queda en la cabecera del frame
+        return zstd.ZstdCompressor(level=level).compress(data)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def open_stored_file(file_path, codec=None):
+    """
+    Abre un archivo guardado para leer su contenido original (descomprime al vuelo si hace falta);
+    codec es el del manifiesto ('' = sin comprimir) y si no se conoce se deduce del sufijo
+    """
+    if codec is None:
+        codec = stored_compression(file_path)
+    if codec == 'zstd':
+        if zstd is None:
+            raise RuntimeError(f"{file_path} está comprimido con zstd y zstandard no está instalado")
+        return zstd.ZstdDecompressor().stream_reader(open(file_path, 'rb'), closefd=True)
+    if codec == 'gzip':
+        return gzip.open(file_path, 'rb')
+    return open(file_path, 'rb')
+
+
+def read_stored_file(file_path):
+    """Contenido original completo de un archivo guardado"""
+    with open_stored_file(file_path) as stored_file:
+        return stored_file.read()
+
+
+class ResultsZipPackager:
+    """
+    Empaqueta en un ZIP sólo los archivos producidos por una ejecución (según su manifiesto), con
+    zipfile en modo ZIP64. Los formatos ya comprimidos se guardan sin recomprimir (STORED) y el resto
+    con deflate; cada archivo se copia por bloques al ZIP en disco, sin leer nunca el árbol completo
+    ni el ZIP resultante en memoria.
+    """
+    
+    STORED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.pdf', '.zip', '.gz', '.zst',
+                         '.docx', '.xlsx', '.mp4', '.mov'}
+    CHUNK_SIZE = 1024 * 1024
+    
+    def __init__(self, base_folder):
+        self.base_folder = Path(base_folder)
+    
+    @staticmethod
+    def load_manifest(attachments_file):
+        """
+        Lee los archivos guardados desde la tabla de adjuntos de la ejecución: pares (ruta, compresión),
+        con la compresión de almacenamiento de la columna 'compresion' ('' = tal cual; None si el
+        manifiesto es anterior a esa columna)
+        """
+        attachments_file = Path(attachments_file)
+        
+        if attachments_file.suffix == '.parquet':
+            columns = ['ruta_archivo']
+            if 'compresion' in pq.read_schema(str(attachments_file)).names:
+                columns.append('compresion')
+            rows = pq.read_table(str(attachments_file), columns=columns).to_pylist()
+        else:
+            with open(attachments_file, 'r', newline='', encoding='utf-8') as csvfile:
+                rows = list(csv.DictReader(csvfile))
+        
+        # Sin duplicados y sólo archivos que siguen existiendo
+        entries = {row['ruta_archivo']: row.get('compresion') for row in rows if row['ruta_archivo']}
+        return [(Path(path), codec) for path, codec in entries.items() if Path(path).is_file()]
+    
+    def _member_info(self, file_path, codec):
+        """ZipInfo del archivo: nombre relativo a la carpeta base, fecha de modificación y método"""
+        # Los archivos guardados comprimidos entran al ZIP con su nombre original; el códec es el del
+        # manifiesto y sólo se deduce del sufijo si el manifiesto no lo trae
+        if codec is None:
+            codec = stored_compression(file_path) or ''
+        name = file_path.stem if codec else file_path.name
+        folder = file_path.parent
+        arcname = (folder.relative_to(self.base_folder) / name).as_posix() \
+            if folder.is_relative_to(self.base_folder) else name
+        
+        mtime = datetime.fromtimestamp(file_path.stat().st_mtime)
+        info = zipfile.ZipInfo(arcname, date_time=max(mtime.timetuple()[:6], (1980, 1, 1, 0, 0, 0)))
+        stored = not codec and file_path.suffix.lower() in self.STORED_EXTENSIONS
+        info.compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+        return info, codec
+    
+    def build(self, file_paths, zip_path):
+        """
+        Escribe el ZIP con los archivos indicados (rutas o pares (ruta, compresión) de load_manifest);
+        devuelve (ruta del ZIP, cantidad de archivos)
+        """
+        count = 0
+        
+        with zipfile.ZipFile(zip_path, 'w', allowZip64=True) as archive:
+            for entry in file_paths:
+                file_path, codec = entry if isinstance(entry, tuple) else (entry, None)
+                info, codec = self._member_info(Path(file_path), codec)
+                # force_zip64: el tamaño original de un archivo guardado comprimido no se conoce de antemano
+                with open_stored_file(file_path, codec) as source, archive.open(info, 'w', force_zip64=True) as member:
+                    shutil.copyfileobj(source, member, self.CHUNK_SIZE)
+                count += 1
+        
+        return Path(zip_path), count
+
+
+class AttachmentWriter:
+    """
+    Etapa de escritura en segundo plano: una cola acotada por bytes alimenta un pool de hilos que
+    escribe cada archivo en un temporal y lo publica con un renombrado atómico. Un índice en memoria
+    de carpetas creadas y nombres ocupados evita repetir mkdir y stat por cada archivo.
+    """
+    
+    def __init__(self, workers=4, max_pending_mb=256):
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='writer')
+        self.max_pending_bytes = int(max_pending_mb * 1024 * 1024)
+        self.pending_bytes = 0
+        self.condition = threading.Condition()
+        self.lock = threading.Lock()
+        self.folder_names = {}
+    
+    def _folder_index(self, folder):
+        """Nombres ya presentes en la carpeta (se crea y se lista una sola vez)"""
+        names = self.folder_names.get(folder)
+        if names is None:
+            folder.mkdir(parents=True, exist_ok=True)
+            names = {entry.name for entry in os.scandir(folder)}
+            self.folder_names[folder] = names
+        return names
+    
+    def ensure_folder(self, folder):
+        with self.lock:
+            self._folder_index(Path(folder))
+    
+    def reserve_path(self, folder, filename):
+        """Reserva un nombre libre en la carpeta ('nombre_1.ext', 'nombre_2.ext'... si ya existe)"""
+        folder = Path(folder)
+        with self.lock:
+            names = self._folder_index(folder)
+            candidate = filename
+            stem, suffix = Path(filename).stem, Path(filename).suffix
+            if stored_compression(filename):
+                # 'estudio.dcm.zst' -> 'estudio_1.dcm.zst'
+                stem, suffix = Path(stem).stem, Path(stem).suffix + suffix
+            counter = 1
+            while candidate in names:
+                candidate = f"{stem}_{counter}{suffix}"
+                counter += 1
+            names.add(candidate)
+        return folder / candidate
+    
+    def _publish(self, tmp_path, file_path):
+        """Publica el temporal sin pisar archivos creados por otro proceso; devuelve la ruta final"""
+        while True:
+            try:
+                os.link(tmp_path, file_path)
+                os.unlink(tmp_path)
+                return file_path
+            except FileExistsError:
+                file_path = self.reserve_path(file_path.parent, file_path.name)
+            except OSError:
+                # Sistemas de archivos sin enlaces duros: renombrado atómico simple
+                os.replace(tmp_path, file_path)
+                return file_path
+    
+    def _write(self, file_path, data, compression):
+        tmp_path = file_path.with_name(f".{file_path.name}.{threading.get_ident()}.tmp")
+        try:
+            with open(tmp_path, 'wb') as tmp_file:
+                # La compresión para almacenamiento también corre en el pool de escritura
+                tmp_file.write(compress_for_storage(data, *compression) if compression else data)
+            return self._publish(tmp_path, file_path)
+        except Exception:
+            if tmp_path.exists():
+                tmp_path.unlink()
+            raise
+        finally:
+            with self.condition:
+                self.pending_bytes -= len(data)
+                self.condition.notify_all()
+    
+    def submit(self, file_path, data, compression=None):
+        """
+        Encola la escritura (bloquea si hay demasiados bytes pendientes); el futuro devuelve la ruta final.
+        compression=(códec, nivel) guarda los datos comprimidos (la ruta ya debe llevar el sufijo del códec)
+        """
+        with self.condition:
+            while self.pending_bytes and self.pending_bytes + len(data) > self.max_pending_bytes:
+                self.condition.wait()
+            self.pending_bytes += len(data)
+        return self.executor.submit(self._write, Path(file_path), data, compression)
+    
+    def write(self, folder, filename, data, compression=None):
+        """Escritura síncrona (reserva de nombre + escritura atómica), para los descargadores por enlace"""
+        return self.submit(self.reserve_path(folder, filename), data, compression).result()
+    
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class InflightByteBudget:
+    """Límite de bytes de mensajes en vuelo compartido entre conexiones (acota la memoria)"""
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self.condition = threading.Condition()
+    
+    def acquire(self, size, held=0):
+        # Un mensaje más grande que el límite pasa solo cuando no hay otros en vuelo;
+        # held: bytes que el mismo hilo ya tiene reservados (no se espera por ellos)
+        with self.condition:
+            while self.in_flight > held and self.in_flight + size > self.max_bytes:
+                self.condition.wait()
+            self.in_flight += size
+    
+    def release(self, size):
+        with self.condition:
+            self.in_flight -= size
+            self.condition.notify_all()
+
 
 class EmailImageDownloader:
     def __init__(self, config):
         self.config = config
         self.mail = None
         self.logger = self.setup_logger()
-        self.report_data = []
+        self.report = ReportStore()
         self.duplicates_cache = {}
+        self.duplicates_lock = threading.Lock()
+        self.open_shard_start = None
+        self.failed_shards = 0
+        self.journal = None
+        self.uidvalidity = None
+        self.worker_transfer_stats = []
+        self.selected_folder = None
+        self.message_cache = None
+        self.cache_stats_from_workers = []
+        self.message_source = None
+        self.rate_controller = self.create_rate_controller()
+        self.http_rate_controller = self.create_rate_controller()
+        self.attachment_writer = None
+        self.dicom_index = None
+        self.perceptual_index = None
+        self.perceptual_index_failed = False
+        self.thumbnail_cache = None
+        self.archive_expander = None
+        self.http_cache = None
+        self.session_pool = None
+        self.session_key = None
+        self.search_cache = None
+        self.account_key = None
+        self.pending_saves = []
+        self.message_sizes = {}
+        self.inflight_budget = None
+        self.profile_name = None
+        self.profile_downloaders = []
+        self.filter_matcher = None
+        self.message_meta = weakref.WeakKeyDictionary()
         
     def setup_logger(self):
         logger = logging.getLogger('EmailDownloader')
@@ -83,18 +2290,29 @@ class EmailImageDownloader:
                 self.logger.error(f"   Password: {'✅' if password else '❌'}")
                 return False
             
-            self.logger.debug(f"🔌 Conectando a {server}:{port}")
+            self.account_key = (server, int(port), email_addr)
             
-            if use_ssl:
-                self.mail = imaplib.IMAP4_SSL(server, port)
-            else:
-                self.mail = imaplib.IMAP4(server, port)
+            pooled = None
+            if self.session_pool is not None:
+                self.session_key = ImapSessionPool.make_key(server, port, email_addr, password, use_ssl)
+                pooled = self.session_pool.acquire(self.session_key)
             
-            self.logger.debug(f"🔐 Autenticando con {email_addr}")
-            self.mail.login(email_addr, password)
+            if pooled is not None:
+                self.logger.debug(f"♻️ Reutilizando sesión IMAP autenticada de {email_addr}")
+                self.mail = pooled
+            else:
+                self.logger.debug(f"🔌 Conectando a {server}:{port}")
+                
+                self.mail = self.create_imap_connection(server, port, use_ssl)
+                
+                self.logger.debug(f"🔐 Autenticando con {email_addr}")
+                self.mail.login(email_addr, password)
+                self.enable_imap_compression()
             
             self.logger.debug(f"📬 Seleccionando INBOX")
             self.mail.select('INBOX')
+            self.selected_folder = 'INBOX'
+            self.uidvalidity = self.get_uidvalidity()
             
             self.logger.info(f"Conectado exitosamente a {email_addr}")
             return True
@@ -168,7 +2386,7 @@ class EmailImageDownloader:
             
             for email_id in email_ids:
                 try:
-                    result, msg_data = self.mail.fetch(email_id, '(RFC822)')
+                    result, msg_data = self.mail.fetch(email_id, '(BODY.PEEK[])')
                     if result != 'OK':
                         continue
                     
@@ -276,7 +2494,7 @@ class EmailImageDownloader:
             
             for email_id in email_ids:
                 try:
-                    result, msg_data = self.mail.fetch(email_id, '(RFC822)')
+                    result, msg_data = self.mail.fetch(email_id, '(BODY.PEEK[])')
                     if result != 'OK':
                         continue
                     
@@ -325,24 +2543,299 @@ class EmailImageDownloader:
 
 
 
-    def normalize_text_for_search(self, text):
-        """Normaliza texto para búsqueda (elimina acentos, convierte a minúsculas)"""
-        if not text:
-            return ""
+    def create_imap_connection(self, server, port, use_ssl):
+        """Crea la conexión IMAP (con soporte de COMPRESS=DEFLATE)"""
+        if use_ssl:
+            return CompressibleIMAP4_SSL(server, port)
+        return CompressibleIMAP4(server, port)
+    
+    def enable_imap_compression(self):
+        """Activa COMPRESS=DEFLATE (RFC 4978) si está habilitado y el servidor lo anuncia"""
+        settings = self.config.get('email_settings', self.config.get('imap', {}))
+        if not settings.get('compress', True) or not hasattr(self.mail, 'enable_compression'):
+            return False
         
-        # Convertir a minúsculas
-        text = text.lower()
+        try:
+            # Tras LOGIN el servidor puede anunciar capacidades nuevas
+            typ, data = self.mail.capability()
+            if typ == 'OK' and data and data[0]:
+                self.mail.capabilities = tuple(data[0].decode('ascii', errors='replace').upper().split())
+            
+            if self.mail.enable_compression():
+                self.logger.info("🗜️ Compresión IMAP activada (COMPRESS=DEFLATE)")
+                return True
+            self.logger.debug("El servidor no ofrece COMPRESS=DEFLATE")
+        except Exception as e:
+            self.logger.warning(f"⚠️ No se pudo activar la compresión IMAP: {e}")
         
-        # Eliminar acentos comunes en español
-        replacements = {
-            'á': 'a', 'é': 'e', 'í': 'i', 'ó': 'o', 'ú': 'u', 'ü': 'u',
-            'ñ': 'n', 'ç': 'c'
-        }
+        return False
+    
+    def get_transfer_stats(self):
+        """Estadísticas de transferencia de la ejecución (conexión principal y conexiones auxiliares)"""
+        totals = {'wire_bytes_in': 0, 'decoded_bytes_in': 0, 'wire_bytes_out': 0, 'decoded_bytes_out': 0}
+        connection_stats = list(self.worker_transfer_stats)
+        if self.mail is not None and hasattr(self.mail, 'get_transfer_stats'):
+            connection_stats.append(self.mail.get_transfer_stats())
+        
+        for stats in connection_stats:
+            for key in totals:
+                totals[key] += stats[key]
+        
+        totals['compression'] = any(stats['compression'] for stats in connection_stats)
+        return totals
+    
+    def get_source_config(self):
+        """Configuración de la fuente de mensajes ('imap' por defecto, o 'mbox', 'maildir', 'eml')"""
+        return self.config.get('source', {'type': 'imap'})
+    
+    def open_message_source(self):
+        """Abre la fuente offline configurada; devuelve None si la fuente es el servidor IMAP"""
+        source_config = self.get_source_config()
+        if source_config.get('type', 'imap') == 'imap':
+            return None
+        
+        self.message_source = OfflineMessageSource(
+            source_config['type'], source_config['path'], source_config.get('mbox_format', 'mboxrd')
+        )
+        self.uidvalidity = self.message_source.fingerprint
+        self.selected_folder = str(source_config['path'])
+        return self.message_source
+    
+    def run_offline_analysis(self):
+        """PASOS 1-3 sobre una fuente offline, repartiendo rangos de IDs entre procesos si se pide"""
+        date_range = self.config['filters']['date_range']
+        if date_range['enabled']:
+            email_ids = self.message_source.list_ids(date_range['start_date'], date_range['end_date'])
+        else:
+            email_ids = self.message_source.list_ids()
+        
+        workers = max(1, int(self.get_source_config().get('workers', 1)))
+        self.logger.info(f"📂 Fuente offline ({self.message_source.source_type}): {len(email_ids)} mensajes, {workers} proceso(s)")
+        
+        if workers == 1 or len(email_ids) < workers * 2 or self.profile_downloaders:
+            valid_emails, total_files = self.process_email_ids(email_ids)
+            return {'total_emails': len(email_ids), 'valid_emails': len(valid_emails), 'total_files': total_files}
+        
+        # Rangos contiguos de IDs (offsets consecutivos del mbox) por proceso
+        chunk_size = -(-len(email_ids) // (workers * 4))
+        id_ranges = [email_ids[i:i + chunk_size] for i in range(0, len(email_ids), chunk_size)]
+        totals = {'total_emails': 0, 'valid_emails': 0, 'total_files': 0}
+        worker_config = dict(self.config, processing=dict(self.config.get('processing', {}), journal=False))
+        
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(process_offline_range, worker_config, id_range) for id_range in id_ranges]
+            for future in as_completed(futures):
+                try:
+                    self.merge_shard_result(future.result(), totals)
+                except Exception as e:
+                    self.logger.error(f"❌ Error procesando un rango de la fuente offline: {e}")
+        
+        return totals
+    
+    def open_message_cache(self):
+        """Abre la caché local de mensajes si está habilitada"""
+        cache_config = self.config.get('processing', {}).get('message_cache', {})
+        if not cache_config.get('enabled', False) or self.message_cache is not None:
+            return self.message_cache
+        
+        try:
+            self.message_cache = MessageCache(
+                cache_config.get('path', '.cache/mensajes.sqlite3'),
+                cache_config.get('max_size_mb', 2048),
+                cache_config.get('compression', 'zstd')
+            )
+        except Exception as e:
+            self.logger.warning(f"⚠️ No se pudo abrir la caché de mensajes: {e}")
+        
+        return self.message_cache
+    
+    def get_message_cache_key(self, email_id):
+        """Clave de caché (cuenta, carpeta, UIDVALIDITY, UID); None si los UID no son estables"""
+        if self.uidvalidity is None:
+            return None
+        
+        if 'email_settings' in self.config:
+            account = self.config['email_settings'].get('email')
+        else:
+            account = self.config.get('credentials', {}).get('email')
+        
+        return (account, self.selected_folder, self.uidvalidity, int(email_id))
+    
+    def is_message_cached(self, email_id):
+        key = self.get_message_cache_key(email_id)
+        return self.message_cache is not None and key is not None and self.message_cache.contains(key)
+    
+    def fetch_raw_message(self, email_id):
+        """Obtiene el mensaje completo (BODY.PEEK[]: no marca \\Seen), primero desde la caché local; None si falla"""
+        if self.message_source is not None:
+            return self.message_source.get_raw(email_id)
+        
+        key = self.get_message_cache_key(email_id)
+        
+        if self.message_cache is not None and key is not None:
+            raw_message = self.message_cache.get(key)
+            if raw_message is not None:
+                return raw_message
+        
+        result, msg_data = self.imap_fetch(email_id, '(BODY.PEEK[])')
+        if result != 'OK' or not msg_data or not isinstance(msg_data[0], tuple):
+            return None
+        
+        raw_message = msg_data[0][1]
+        if self.message_cache is not None and key is not None:
+            try:
+                self.message_cache.put(key, raw_message)
+            except Exception as e:
+                self.logger.debug(f"No se pudo guardar en caché el email {email_id}: {e}")
+        
+        return raw_message
+    
+    def get_uidvalidity(self):
+        """Obtiene el UIDVALIDITY del buzón seleccionado (los UID sólo son estables mientras no cambie)"""
+        try:
+            _, data = self.mail.response('UIDVALIDITY')
+            if data and data[0]:
+                return int(data[0])
+        except Exception as e:
+            self.logger.debug(f"No se pudo obtener UIDVALIDITY: {e}")
+        return None
+    
+    def create_rate_controller(self):
+        """Crea el control de ritmo a partir de processing.delay_between_emails y processing.rate_control"""
+        processing = self.config.get('processing', {})
+        settings = processing.get('rate_control', {})
+        return AdaptiveRateController(
+            initial_delay=float(processing.get('delay_between_emails', 0.0)),
+            min_delay=float(settings.get('min_delay', 0.05)),
+            max_delay=float(settings.get('max_delay', 60.0)),
+            increase_step=float(settings.get('increase_step', 0.25)),
+            decrease_factor=float(settings.get('decrease_factor', 0.5))
+        )
+    
+    def get_max_retries(self):
+        return int(self.config.get('processing', {}).get('rate_control', {}).get('max_retries', 4))
+    
+    def reconnect_to_email(self):
+        """Reabre la conexión tras un corte del servidor; falla si cambió el UIDVALIDITY (UIDs ya no válidos)"""
+        previous_uidvalidity = self.uidvalidity
+        if self.mail is not None and hasattr(self.mail, 'get_transfer_stats'):
+            self.worker_transfer_stats.append(self.mail.get_transfer_stats())
+        
+        try:
+            self.mail.shutdown()
+        except Exception:
+            pass
+        self.mail = None
+        
+        if not self.connect_to_email():
+            return False
+        
+        if previous_uidvalidity is not None and self.uidvalidity != previous_uidvalidity:
+            self.logger.error("❌ El UIDVALIDITY cambió tras reconectar: los UID anteriores ya no son válidos")
+            return False
+        
+        self.logger.info("🔌 Reconectado al servidor tras un corte de conexión")
+        return True
+    
+    def run_imap_command(self, *args):
+        """Ejecuta un comando UID respetando el ritmo adaptativo y reintentando ante limitaciones del servidor"""
+        controller = self.rate_controller
+        max_retries = self.get_max_retries()
+        
+        for attempt in range(max_retries + 1):
+            controller.wait()
+            
+            try:
+                typ, data = self.mail.uid(*args)
+            except (imaplib.IMAP4.abort, ssl.SSLError, ConnectionResetError, OSError) as e:
+                # Conexión cortada por el servidor (suele ser la respuesta a un cliente demasiado rápido),
+                # reseteada o con error de TLS/socket: mismo tratamiento, pausa y reconexión
+                backoff = controller.on_throttle()
+                self.logger.warning(f"⚠️ Conexión IMAP cortada ({e}); pausa de {backoff:.1f}s y reconexión")
+                if attempt == max_retries or not self.reconnect_to_email():
+                    raise
+                continue
+            except imaplib.IMAP4.error as e:
+                if attempt == max_retries or not controller.is_throttle_signal(str(e)):
+                    raise
+                backoff = controller.on_throttle()
+                self.logger.warning(f"⚠️ Servidor limitando comandos ({e}); pausa de {backoff:.1f}s")
+                continue
+            
+            # Gmail avisa con el código [THROTTLED] incluso en respuestas OK
+            _, throttled = self.mail.response('THROTTLED')
+            if (typ != 'OK' and controller.is_throttle_signal(data)) or (throttled and throttled[0] is not None):
+                backoff = controller.on_throttle()
+                self.logger.warning(f"⚠️ Servidor limitando comandos ({typ}); pausa de {backoff:.1f}s")
+                if typ != 'OK' and attempt < max_retries:
+                    continue
+            else:
+                controller.on_success()
+            return typ, data
+        
+        return typ, data
+    
+    def http_get(self, client, url, **kwargs):
+        """GET HTTP con el ritmo adaptativo propio de las descargas por enlace (respeta Retry-After en 429/503)"""
+        return self.http_request(client, 'get', url, **kwargs)
+    
+    def http_request(self, client, method, url, **kwargs):
+        """Petición HTTP (get/head) con el ritmo adaptativo de las descargas por enlace"""
+        controller = self.http_rate_controller
+        max_retries = self.get_max_retries()
+        
+        for attempt in range(max_retries + 1):
+            controller.wait()
+            response = getattr(client, method)(url, **kwargs)
+            
+            if response.status_code not in (429, 503) or attempt == max_retries:
+                controller.on_success()
+                return response
+            
+            retry_after = response.headers.get('Retry-After')
+            backoff = controller.on_throttle(float(retry_after) if retry_after and retry_after.isdigit() else None)
+            self.logger.warning(f"⚠️ HTTP {response.status_code} en {urlparse(url).netloc}; pausa de {backoff:.1f}s")
+            response.close()
+        
+        return response
+    
+    def get_rate_stats(self):
+        """Ritmo logrado en IMAP y HTTP"""
+        return {'imap': self.rate_controller.get_stats(), 'http': self.http_rate_controller.get_stats()}
+    
+    def imap_search(self, search_criteria):
+        """Búsqueda IMAP por UID (identificadores estables entre sesiones, necesarios para reanudar)"""
+        exclusion = self.get_marked_search_exclusion()
+        if exclusion:
+            search_criteria = f'{search_criteria} {exclusion}'
         
-        for accented, plain in replacements.items():
-            text = text.replace(accented, plain)
+        cache_key = None
+        if self.search_cache is not None and self.account_key is not None and self.uidvalidity is not None:
+            cache_key = (self.account_key, self.selected_folder, self.uidvalidity, search_criteria)
+            cached = self.search_cache.get(cache_key)
+            if cached is not None:
+                self.logger.debug(f"♻️ Búsqueda reutilizada de la caché: {search_criteria}")
+                return 'OK', [cached]
         
-        return text
+        status, messages = self.run_imap_command('SEARCH', None, search_criteria)
+        if cache_key is not None and status == 'OK':
+            self.search_cache.put(cache_key, messages[0])
+        return status, messages
+    
+    def imap_fetch(self, email_id, message_parts):
+        """FETCH IMAP por UID"""
+        return self.run_imap_command('FETCH', email_id, message_parts)
+    
+    def normalize_text_for_search(self, text):
+        """Normaliza texto para búsqueda (elimina acentos, convierte a minúsculas)"""
+        return normalize_search_text(text)
+    
+    def get_filter_matcher(self):
+        """Compila los filtros de remitente y asunto la primera vez que se usan en la ejecución"""
+        if self.filter_matcher is None:
+            filters = self.config['filters']
+            self.filter_matcher = FilterMatcher(filters.get('sender_emails', []), filters.get('subject_keywords', []))
+        return self.filter_matcher
     
     def decode_email_header(self, header):
         """Decodifica headers de email que pueden estar en diferentes encodings"""
@@ -350,28 +2843,52 @@ class EmailImageDownloader:
             return ""
         
         try:
-            decoded_parts = email.header.decode_header(header)
-            decoded_header = ""
-            
-            for part, encoding in decoded_parts:
-                if isinstance(part, bytes):
-                    if encoding:
-                        try:
-                            decoded_header += part.decode(encoding)
-                        except (UnicodeDecodeError, LookupError):
-                            decoded_header += part.decode('utf-8', errors='ignore')
-                    else:
-                        decoded_header += part.decode('utf-8', errors='ignore')
-                else:
-                    decoded_header += str(part)
-            
-            return decoded_header
+            if isinstance(header, str):
+                return decode_header_value(header)
+            # Objetos Header (no hashables): sin memoizar
+            return decode_header_value.__wrapped__(header)
         except Exception as e:
             self.logger.debug(f"Error decodificando header: {e}")
             return str(header)
     
     def get_email_date(self, msg):
         """Obtiene la fecha del email"""
+        return self.get_message_meta(msg).date
+    
+    def get_message_meta(self, msg, email_id=None, size=None, attachment_summary=None):
+        """Metadatos del email: se decodifican la primera vez y luego todas las etapas reutilizan el mismo registro"""
+        meta = self.message_meta.get(msg)
+        if meta is None:
+            meta = MessageMeta(
+                email_id,
+                self.decode_email_header(msg['From']),
+                self.decode_email_header(msg['Subject']),
+                self.parse_email_date(msg),
+                (msg['Message-ID'] or '').strip(),
+                size,
+                attachment_summary
+            )
+            self.message_meta[msg] = meta
+        return meta
+    
+    def summarize_message_attachments(self, msg):
+        """Resumen de adjuntos (total, tipos) recorriendo el mensaje completo"""
+        total_attachments = 0
+        attachment_types = []
+        
+        for part in msg.walk():
+            filename = part.get_filename()
+            content_type = part.get_content_type()
+            
+            if filename or content_type.startswith('image/') or content_type == 'application/pdf':
+                total_attachments += 1
+                if content_type not in attachment_types:
+                    attachment_types.append(content_type)
+        
+        return total_attachments, attachment_types
+    
+    def parse_email_date(self, msg):
+        """Fecha del header Date (o la actual si falta o no se puede interpretar)"""
         date_header = msg['Date']
         if date_header:
             try:
@@ -392,7 +2909,7 @@ class EmailImageDownloader:
         
         if not filters['date_range']['enabled']:
             self.logger.warning("⚠️ Filtro de fecha deshabilitado - buscando TODOS los emails")
-            status, messages = self.mail.search(None, 'ALL')
+            status, messages = self.imap_search('ALL')
         else:
             start_date = filters['date_range'].get('start_date')
             end_date = filters['date_range'].get('end_date')
@@ -415,58 +2932,638 @@ class EmailImageDownloader:
             duration = (end_date - start_date).days + 1
             self.logger.info(f"📊 Duración del rango: {duration} días")
             
-            if duration == 1:
-                # Un solo día: usar SINCE y BEFORE del día siguiente
-                next_day = end_date + timedelta(days=1)
-                next_day_imap = next_day.strftime('%d-%b-%Y')
-                search_criteria = f'SINCE {start_imap} BEFORE {next_day_imap}'
-                self.logger.info(f"📅 Buscando emails hasta: {end_imap} (usando BEFORE {next_day_imap})")
+            # SINCE inicio y BEFORE el día siguiente al fin (BEFORE es exclusivo)
+            search_criteria = self.build_date_search_criteria(start_date, end_date)
+            self.logger.info(f"📅 Buscando emails hasta: {end_imap} (criterio: {search_criteria})")
+            
+            self.logger.info(f"🔍 Criterio de búsqueda FINAL: '{search_criteria}'")
+            
+            try:
+                status, messages = self.imap_search(search_criteria)
+                self.logger.info(f"🔍 Resultado de búsqueda IMAP: {status}")
+            except Exception as e:
+                self.logger.error(f"❌ Error en búsqueda IMAP: {e}")
+                return []
+        
+        if status != 'OK':
+            self.logger.error(f"❌ Error en búsqueda: {status}")
+            return []
+        
+        email_ids = messages[0].split()
+        self.logger.info(f"📊 TOTAL de emails encontrados: {len(email_ids)}")
+        
+        if email_ids:
+            # Obtener fechas del primer y último email para verificación (sólo el header Date)
+            try:
+                first_email_result, first_email_data = self.imap_fetch(email_ids[0], '(BODY.PEEK[HEADER.FIELDS (DATE)])')
+                if first_email_result == 'OK':
+                    first_msg = email.message_from_bytes(first_email_data[0][1])
+                    first_date = self.get_email_date(first_msg)
+                    self.logger.info(f"📅 Fecha del primer email: {first_date.strftime('%Y-%m-%d %H:%M:%S')}")
+                
+                last_email_result, last_email_data = self.imap_fetch(email_ids[-1], '(BODY.PEEK[HEADER.FIELDS (DATE)])')
+                if last_email_result == 'OK':
+                    last_msg = email.message_from_bytes(last_email_data[0][1])
+                    last_date = self.get_email_date(last_msg)
+                    self.logger.info(f"📅 Fecha del último email: {last_date.strftime('%Y-%m-%d %H:%M:%S')}")
+                    
+            except Exception as e:
+                self.logger.debug(f"Error obteniendo fechas de verificación: {e}")
+        
+        self.logger.info("=== BÚSQUEDA DE EMAILS COMPLETADA ===")
+        return email_ids
+    
+    def build_date_search_criteria(self, start_date, end_date):
+        """Construye el criterio IMAP SINCE/BEFORE para un rango de fechas inclusivo (sin inicio: sólo BEFORE)"""
+        next_day_imap = (end_date + timedelta(days=1)).strftime('%d-%b-%Y')
+        if start_date is None:
+            return f'BEFORE {next_day_imap}'
+        start_imap = start_date.strftime('%d-%b-%Y')
+        return f'SINCE {start_imap} BEFORE {next_day_imap}'
+    
+    def get_shard_mode(self):
+        """Devuelve el modo de fragmentación configurado ('month', 'week') o None (sin fragmentar)"""
+        shard_mode = self.config.get('processing', {}).get('shard_mode')
+        return shard_mode if shard_mode in ('month', 'week') else None
+    
+    def build_date_shards(self, start_date, end_date, mode):
+        """Divide un rango de fechas en ventanas (inicio, fin) inclusivas por mes o semana"""
+        if isinstance(start_date, datetime):
+            start_date = start_date.date()
+        if isinstance(end_date, datetime):
+            end_date = end_date.date()
+        
+        shards = []
+        current = start_date
+        
+        while current <= end_date:
+            if mode == 'week':
+                # Ventanas alineadas a lunes-domingo
+                shard_end = current + timedelta(days=6 - current.weekday())
+            else:
+                # Ventanas alineadas al mes calendario
+                if current.month == 12:
+                    next_month = date(current.year + 1, 1, 1)
+                else:
+                    next_month = date(current.year, current.month + 1, 1)
+                shard_end = next_month - timedelta(days=1)
+            
+            shard_end = min(shard_end, end_date)
+            shards.append((current, shard_end))
+            current = shard_end + timedelta(days=1)
+        
+        return shards
+    
+    def get_shards_for_run(self):
+        """Calcula las ventanas de búsqueda de la ejecución según filtros y modo de fragmentación"""
+        mode = self.get_shard_mode()
+        date_range = self.config['filters']['date_range']
+        
+        if date_range['enabled']:
+            start_date = date_range.get('start_date')
+            end_date = date_range.get('end_date')
+        else:
+            # Historial completo hasta hoy: desde la fecha configurada o, si no hay, desde el mes del mensaje
+            # más antiguo; en ese caso la primera ventana no tiene inicio y nada anterior queda fuera
+            start_date = self.config.get('processing', {}).get('history_start')
+            if start_date is None:
+                start_date = self.open_shard_start = self.get_oldest_message_date()
+            end_date = date.today()
+        
+        return self.build_date_shards(start_date, end_date, mode)
+    
+    def get_oldest_message_date(self):
+        """Primer día del mes del INTERNALDATE del mensaje con UID más bajo (número de secuencia 1)"""
+        try:
+            self.rate_controller.wait()
+            typ, data = self.mail.fetch('1', '(INTERNALDATE)')
+            if typ == 'OK' and data and data[0]:
+                raw = data[0][0] if isinstance(data[0], tuple) else data[0]
+                internal_date = imaplib.Internaldate2tuple(raw)
+                if internal_date:
+                    self.logger.info(f"📅 Mensaje más antiguo de la carpeta: {time.strftime('%Y-%m-%d', internal_date)}")
+                    return date(internal_date.tm_year, internal_date.tm_mon, 1)
+        except Exception as e:
+            self.logger.warning(f"⚠️ No se pudo obtener la fecha del mensaje más antiguo: {e}")
+        
+        # Carpeta vacía o sin INTERNALDATE: la primera ventana abierta igual cubre lo anterior
+        return date.today().replace(day=1)
+    
+    def get_run_signature(self):
+        """Genera una firma estable de la configuración (sin contraseña) para checkpoints"""
+        if 'email_settings' in self.config:
+            account = self.config['email_settings'].get('email')
+        else:
+            account = self.config.get('credentials', {}).get('email')
+        
+        filters = self.config['filters']
+        signature_data = {
+            'account': account,
+            'folder': filters.get('folder', 'INBOX'),
+            'sender_emails': sorted(filters.get('sender_emails', [])),
+            'subject_keywords': sorted(filters.get('subject_keywords', [])),
+            'allowed_extensions': sorted(self.config['download_settings']['allowed_extensions']),
+            'base_folder': self.config['download_settings']['base_folder'],
+            'shard_mode': self.get_shard_mode(),
+            'date_range': [filters['date_range'].get('start_date'), filters['date_range'].get('end_date')]
+                          if filters['date_range']['enabled'] else None
+        }
+        if self.get_source_config().get('type', 'imap') != 'imap':
+            signature_data['source'] = self.get_source_config()
+        raw = json.dumps(signature_data, sort_keys=True, default=str)
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:16]
+    
+    def get_state_path(self, configured, default_name):
+        """Ruta de un archivo de estado de la ejecución: la configurada o, si no hay, dentro de la carpeta base"""
+        if configured:
+            return Path(configured)
+        return Path(self.config['download_settings']['base_folder']) / default_name
+    
+    def get_shard_checkpoint_dir(self):
+        """Carpeta de checkpoints de esta configuración (processing.checkpoint_dir / firma)"""
+        configured = self.config.get('processing', {}).get('checkpoint_dir')
+        return self.get_state_path(configured, '.checkpoints') / self.get_run_signature()
+    
+    def get_shard_checkpoint_path(self, shard):
+        """Ruta del archivo de checkpoint para una ventana de fechas"""
+        shard_start, shard_end = shard
+        return self.get_shard_checkpoint_dir() / f"shard_{shard_start:%Y%m%d}_{shard_end:%Y%m%d}.json"
+    
+    def load_shard_checkpoint(self, shard):
+        """Carga el checkpoint de una ventana ya completada, o None si no existe"""
+        checkpoint_path = self.get_shard_checkpoint_path(shard)
+        if not checkpoint_path.exists():
+            return None
+        
+        try:
+            checkpoint = json.loads(checkpoint_path.read_text(encoding='utf-8'))
+            if checkpoint.get('status') == 'completed':
+                return checkpoint
+        except Exception as e:
+            self.logger.warning(f"⚠️ Checkpoint ilegible, se reprocesará la ventana: {checkpoint_path} ({e})")
+        
+        return None
+    
+    def save_shard_checkpoint(self, shard, result):
+        """Guarda el resultado de una ventana completada (escritura atómica)"""
+        checkpoint_path = self.get_shard_checkpoint_path(shard)
+        checkpoint_path.parent.mkdir(parents=True, exist_ok=True)
+        
+        checkpoint = dict(result)
+        checkpoint['status'] = 'completed'
+        checkpoint['completed_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        
+        tmp_path = checkpoint_path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(checkpoint, ensure_ascii=False, default=str), encoding='utf-8')
+        os.replace(tmp_path, checkpoint_path)
+    
+    def clear_shard_checkpoints(self):
+        """
+        Ejecución terminada: borra sus checkpoints para que la próxima vuelva a recorrer todas las ventanas.
+        Si alguna ventana falló se conservan, y la próxima ejecución reanuda sólo las pendientes.
+        """
+        if self.failed_shards:
+            self.logger.info(f"🧩 {self.failed_shards} ventana(s) con error: se conservan los checkpoints para reanudar")
+            return
+        
+        checkpoint_dir = self.get_shard_checkpoint_dir()
+        try:
+            shutil.rmtree(checkpoint_dir)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            self.logger.warning(f"⚠️ No se pudieron borrar los checkpoints de la ejecución: {checkpoint_dir} ({e})")
+    
+    def search_emails_in_shard(self, shard):
+        """Busca los emails de una sola ventana de fechas"""
+        shard_start, shard_end = shard
+        search_start = None if shard_start == self.open_shard_start else shard_start
+        search_criteria = self.build_date_search_criteria(search_start, shard_end)
+        
+        try:
+            status, messages = self.imap_search(search_criteria)
+        except Exception as e:
+            self.logger.error(f"❌ Error en búsqueda IMAP de la ventana {shard_start} - {shard_end}: {e}")
+            return None
+        
+        if status != 'OK':
+            self.logger.error(f"❌ Error en búsqueda de la ventana {shard_start} - {shard_end}: {status}")
+            return None
+        
+        return messages[0].split()
+    
+    def build_profile_config(self, profile):
+        """Configuración de un perfil: filtros y destino propios sobre la búsqueda y el procesamiento comunes"""
+        download_settings = self.config['download_settings']
+        config = dict(self.config, profiles=[])
+        config['filters'] = dict(
+            self.config['filters'],
+            sender_emails=profile.get('sender_emails', []),
+            subject_keywords=profile.get('subject_keywords', [])
+        )
+        config['download_settings'] = dict(
+            download_settings,
+            base_folder=profile.get('base_folder', download_settings['base_folder']),
+            allowed_extensions=profile.get('allowed_extensions', download_settings['allowed_extensions'])
+        )
+        return config
+    
+    def open_profiles(self):
+        """
+        Motor de reglas: cada perfil de config['profiles'] es un descargador con sus filtros, carpeta,
+        diario y reporte propios. Los mensajes se obtienen una sola vez y se evalúan contra todos.
+        """
+        profiles = self.config.get('profiles') or []
+        shared_fetch = SharedMessageFetch(self.fetch_raw_message)
+        used_prefixes = set()
+        
+        for profile in profiles:
+            child = EmailImageDownloader(self.build_profile_config(profile))
+            child.profile_name = profile['name']
+            child.message_source = shared_fetch
+            child.uidvalidity = self.uidvalidity
+            child.selected_folder = self.selected_folder
+            child.rate_controller = self.rate_controller
+            child.attachment_writer = self.get_attachment_writer()
+            child.dicom_index = self.get_dicom_index()
+            child.perceptual_index = self.get_perceptual_index()
+            child.thumbnail_cache = self.get_thumbnail_cache()
+            child.archive_expander = self.get_archive_expander()
+            child.http_cache = self.get_http_cache()
+            
+            prefix = 'reporte_' + (re.sub(r'[^a-z0-9-]+', '_', self.normalize_text_for_search(profile['name'])).strip('_') or 'perfil')
+            while prefix in used_prefixes:
+                prefix += '_'
+            used_prefixes.add(prefix)
+            
+            child.open_run_journal()
+            child.open_report_store(prefix=prefix)
+            self.profile_downloaders.append(child)
+        
+        if self.profile_downloaders:
+            self.logger.info(f"🧭 {len(self.profile_downloaders)} perfiles evaluados en una sola pasada: "
+                             + ", ".join(child.profile_name for child in self.profile_downloaders))
+        return self.profile_downloaders
+    
+    def process_email_ids_for_profiles(self, email_ids):
+        """Una pasada por los mensajes: cada uno se evalúa (y descarga) para todos los perfiles"""
+        valid_emails = []
+        total_files = 0
+        
+        for email_id in email_ids:
+            matched = False
+            for child in self.profile_downloaders:
+                child_valid, child_files = child.process_email_ids([email_id], finalize=False)
+                matched = matched or bool(child_valid)
+                total_files += child_files
+            if matched:
+                valid_emails.append(email_id)
+        
+        for child in self.profile_downloaders:
+            total_files += child.finalize_pending_saves(wait=True)
+        
+        return valid_emails, total_files
+    
+    def close_profiles(self, completed=False):
+        """Cierra los reportes y diarios de los perfiles; devuelve el resumen de cada uno"""
+        results = []
+        
+        for child in self.profile_downloaders:
+            child.finalize_pending_saves(wait=True)
+            report_filename = child.generate_report_csv()
+            results.append({
+                'name': child.profile_name,
+                'base_folder': child.config['download_settings']['base_folder'],
+                'valid_emails': child.report.count('DESCARGADO') + child.report.count('SIN_ARCHIVOS'),
+                'total_files': child.report.total_files,
+                'total_bytes': child.report.total_bytes,
+                'report_file': report_filename,
+                'attachments_file': str(child.report.attachments_path) if child.report.attachments_path else None
+            })
+            if child.journal:
+                if completed:
+                    child.journal.mark_completed()
+                child.journal.close()
+        
+        self.profile_downloaders = []
+        return results
+    
+    def run_with_inflight_budget(self, email_id, step):
+        """Ejecuta un paso sobre un email reservando su tamaño en el límite de bytes en vuelo"""
+        if self.inflight_budget is None:
+            return step(email_id)
+        
+        size = self.message_sizes.get(email_id, 0)
+        self.inflight_budget.acquire(size)
+        try:
+            return step(email_id)
+        finally:
+            self.inflight_budget.release(size)
+    
+    def process_email_ids(self, email_ids, finalize=True):
+        """Analiza y descarga una lista de emails; devuelve (emails válidos, archivos descargados)"""
+        if self.profile_downloaders:
+            return self.process_email_ids_for_profiles(email_ids)
+        
+        valid_emails = []
+        pending_downloads = []
+        resumed_count = 0
+        
+        for email_id in email_ids:
+            resumable = self.journal.get_resumable(email_id) if self.journal else None
+            
+            if resumable:
+                # Ya procesado en una ejecución anterior interrumpida: se toma del diario sin volver a descargar
+                row, approved, attachments = resumable
+                self.report.add(row)
+                self.report.extend_attachments(attachments)
+                resumed_count += 1
+                if approved:
+                    valid_emails.append(email_id)
+                    if row['estado'] == 'PENDIENTE_DESCARGA':
+                        pending_downloads.append(email_id)
+            elif self.run_with_inflight_budget(email_id, self.analyze_email_for_report):
+                valid_emails.append(email_id)
+                pending_downloads.append(email_id)
+        
+        if resumed_count:
+            self.logger.info(f"♻️ {resumed_count} emails recuperados del diario de ejecución")
+        
+        total_files_downloaded = 0
+        
+        for email_id in pending_downloads:
+            try:
+                files_downloaded = self.run_with_inflight_budget(email_id, self.download_images_from_email)
+                total_files_downloaded += files_downloaded
+            except Exception as e:
+                self.logger.error(f"Error descargando email {email_id}: {e}")
+        
+        # Las escrituras en curso deben quedar en el reporte (y en el total) antes de cerrar la ventana o el rango
+        if finalize:
+            total_files_downloaded += self.finalize_pending_saves(wait=True)
+        
+        return valid_emails, total_files_downloaded
+    
+    def process_shard(self, shard):
+        """Procesa una ventana de fechas completa y guarda su checkpoint"""
+        shard_start, shard_end = shard
+        email_ids = self.search_emails_in_shard(shard)
+        
+        if email_ids is None:
+            # Error de búsqueda: no se guarda checkpoint para reintentarla en la próxima ejecución
+            return None
+        
+        # Las filas de la ventana van a un archivo junto al checkpoint (no se acumulan en memoria)
+        rows_path = self.get_shard_checkpoint_path(shard).with_suffix('.rows.jsonl')
+        rows_path.parent.mkdir(parents=True, exist_ok=True)
+        self.report.begin_capture(rows_path)
+        valid_emails, files_downloaded = self.process_email_ids(email_ids)
+        self.report.end_capture()
+        
+        result = {
+            'shard_start': shard_start.isoformat(),
+            'shard_end': shard_end.isoformat(),
+            'total_emails': len(email_ids),
+            'valid_emails': len(valid_emails),
+            'total_files': files_downloaded,
+            'rows_file': str(rows_path)
+        }
+        self.save_shard_checkpoint(shard, result)
+        
+        self.logger.info(f"🧩 Ventana {shard_start} - {shard_end}: {len(email_ids)} emails, "
+                         f"{len(valid_emails)} válidos, {files_downloaded} archivos")
+        return result
+    
+    def open_worker_connection(self):
+        """Crea un descargador con conexión IMAP propia que comparte el estado de esta ejecución"""
+        worker = EmailImageDownloader(self.config)
+        worker.session_pool = self.session_pool
+        worker.search_cache = self.search_cache
+        if not worker.connect_to_email():
+            return None
+        
+        # Todas las conexiones escriben en el mismo diario de ejecución y comparten el ritmo de la cuenta
+        worker.journal = self.journal
+        worker.rate_controller = self.rate_controller
+        worker.http_rate_controller = self.http_rate_controller
+        worker.attachment_writer = self.get_attachment_writer()
+        worker.dicom_index = self.get_dicom_index()
+        worker.perceptual_index = self.get_perceptual_index()
+        worker.thumbnail_cache = self.get_thumbnail_cache()
+        worker.archive_expander = self.get_archive_expander()
+        worker.http_cache = self.get_http_cache()
+        worker.message_sizes = self.message_sizes
+        worker.duplicates_cache = self.duplicates_cache
+        worker.duplicates_lock = self.duplicates_lock
+        worker.open_shard_start = self.open_shard_start
+        worker.inflight_budget = self.inflight_budget
+        worker.open_message_cache()
+        return worker
+    
+    def close_worker_connection(self, worker):
+        """Cierra la conexión de un trabajador y recoge sus estadísticas"""
+        if worker.message_cache is not None:
+            self.cache_stats_from_workers.append((worker.message_cache.hits, worker.message_cache.misses))
+            worker.message_cache.close()
+        self.worker_transfer_stats.append(worker.get_transfer_stats())
+        worker.disconnect()
+    
+    def process_shard_in_worker(self, shard):
+        """Procesa una ventana en una conexión IMAP independiente (para ejecución en paralelo)"""
+        worker = self.open_worker_connection()
+        if worker is None:
+            return None
+        
+        try:
+            return worker.process_shard(shard)
+        finally:
+            self.close_worker_connection(worker)
+    
+    def get_size_scheduling_config(self):
+        return self.config.get('processing', {}).get('size_scheduling', {})
+    
+    def fetch_message_sizes(self, email_ids, batch_size=500):
+        """Obtiene RFC822.SIZE de todos los candidatos con FETCH por lotes de UIDs"""
+        sizes = {}
+        
+        for start in range(0, len(email_ids), batch_size):
+            batch = email_ids[start:start + batch_size]
+            message_set = ','.join(uid.decode() if isinstance(uid, bytes) else str(uid) for uid in batch)
+            try:
+                result, data = self.imap_fetch(message_set, '(RFC822.SIZE)')
+            except Exception as e:
+                self.logger.warning(f"⚠️ No se pudieron obtener los tamaños de un lote de emails: {e}")
+                continue
+            
+            if result != 'OK':
+                continue
+            
+            for item in data:
+                line = item[0] if isinstance(item, tuple) else item
+                if not isinstance(line, bytes):
+                    continue
+                uid_match = re.search(rb'UID (\d+)', line)
+                size_match = re.search(rb'RFC822\.SIZE (\d+)', line)
+                if uid_match and size_match:
+                    sizes[uid_match.group(1)] = int(size_match.group(1))
+        
+        return sizes
+    
+    def plan_fetch_lanes(self, email_ids, sizes, connections, large_bytes, small_first):
+        """
+        Reparte los emails en carriles equilibrados por bytes (no por cantidad). Los mensajes muy grandes
+        van a un carril propio para no bloquear a los demás; con small_first cada carril va de menor a mayor.
+        """
+        position = {email_id: index for index, email_id in enumerate(email_ids)}
+        large = [email_id for email_id in email_ids if sizes.get(email_id, 0) >= large_bytes]
+        regular = [email_id for email_id in email_ids if sizes.get(email_id, 0) < large_bytes]
+        if not regular:
+            # Todos son grandes: se reparten como cualquier otro lote
+            regular, large = large, []
+        
+        regular_lanes = connections - 1 if large and connections > 1 else connections
+        lanes = [[] for _ in range(max(1, regular_lanes))]
+        
+        # Asignación voraz: el mensaje más grande pendiente va al carril con menos bytes
+        lane_heap = [(0, lane_index) for lane_index in range(len(lanes))]
+        for email_id in sorted(regular, key=lambda email_id: sizes.get(email_id, 0), reverse=True):
+            lane_bytes, lane_index = heapq.heappop(lane_heap)
+            lanes[lane_index].append(email_id)
+            heapq.heappush(lane_heap, (lane_bytes + sizes.get(email_id, 0), lane_index))
+        
+        if large:
+            if connections > 1:
+                lanes.append(large)
             else:
-                # Múltiples días: usar SINCE y BEFORE
-                next_day = end_date + timedelta(days=1)
-                next_day_imap = next_day.strftime('%d-%b-%Y')
-                search_criteria = f'SINCE {start_imap} BEFORE {next_day_imap}'
-                self.logger.info(f"📅 Buscando emails hasta: {end_imap} (usando BEFORE {next_day_imap})")
+                lanes[0].extend(large)
+        
+        order_key = (lambda email_id: sizes.get(email_id, 0)) if small_first else position.get
+        return [sorted(lane, key=order_key) for lane in lanes if lane]
+    
+    def process_lane_in_worker(self, email_ids):
+        """Procesa un carril de emails en una conexión IMAP independiente"""
+        worker = self.open_worker_connection()
+        if worker is None:
+            return None
+        
+        try:
+            worker.report.begin_capture()
+            valid_emails, files_downloaded = worker.process_email_ids(email_ids)
+            rows, attachments = worker.report.end_capture()
+            return {'valid_emails': valid_emails, 'total_files': files_downloaded, 'rows': rows, 'attachments': attachments}
+        finally:
+            self.close_worker_connection(worker)
+    
+    def process_email_ids_by_size(self, email_ids):
+        """PASOS 2 y 3 con planificación por tamaño (RFC822.SIZE) entre varias conexiones"""
+        settings = self.get_size_scheduling_config()
+        if not settings.get('enabled', False) or self.message_source is not None or self.profile_downloaders:
+            return self.process_email_ids(email_ids)
+        
+        connections = max(1, int(settings.get('connections', 1)))
+        large_bytes = int(float(settings.get('large_message_mb', 20)) * 1024 * 1024)
+        
+        self.message_sizes = self.fetch_message_sizes(email_ids)
+        self.inflight_budget = InflightByteBudget(int(float(settings.get('max_inflight_mb', 512)) * 1024 * 1024))
+        lanes = self.plan_fetch_lanes(email_ids, self.message_sizes, connections, large_bytes, settings.get('small_first', True))
+        
+        total_bytes = sum(self.message_sizes.values())
+        self.logger.info(f"⚖️ {len(email_ids)} emails ({total_bytes / 1048576:.1f} MB) repartidos en {len(lanes)} carril(es): "
+                         + ", ".join(f"{sum(self.message_sizes.get(i, 0) for i in lane) / 1048576:.1f} MB" for lane in lanes))
+        
+        if len(lanes) == 1:
+            return self.process_email_ids(lanes[0])
+        
+        valid_emails = []
+        total_files = 0
+        
+        with ThreadPoolExecutor(max_workers=len(lanes) - 1) as executor:
+            futures = {executor.submit(self.process_lane_in_worker, lane): lane for lane in lanes[1:]}
             
-            self.logger.info(f"🔍 Criterio de búsqueda FINAL: '{search_criteria}'")
+            # El primer carril usa la conexión principal mientras los demás avanzan en paralelo
+            lane_valid, lane_files = self.process_email_ids(lanes[0])
+            valid_emails.extend(lane_valid)
+            total_files += lane_files
             
-            try:
-                status, messages = self.mail.search(None, search_criteria)
-                self.logger.info(f"🔍 Resultado de búsqueda IMAP: {status}")
-            except Exception as e:
-                self.logger.error(f"❌ Error en búsqueda IMAP: {e}")
-                return []
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    self.logger.error(f"❌ Error procesando un carril de emails: {e}")
+                    result = None
+                
+                if result is None:
+                    # Sin conexión adicional: el carril se procesa en la conexión principal
+                    lane_valid, lane_files = self.process_email_ids(futures[future])
+                    valid_emails.extend(lane_valid)
+                    total_files += lane_files
+                    continue
+                
+                self.report.extend(result['rows'])
+                self.report.extend_attachments(result['attachments'])
+                valid_emails.extend(result['valid_emails'])
+                total_files += result['total_files']
         
-        if status != 'OK':
-            self.logger.error(f"❌ Error en búsqueda: {status}")
-            return []
+        return valid_emails, total_files
+    
+    def run_sharded_analysis(self):
+        """Recorre el historial ventana por ventana, reanudando desde los checkpoints existentes"""
+        shards = self.get_shards_for_run()
+        workers = max(1, int(self.config.get('processing', {}).get('shard_workers', 1)))
         
-        email_ids = messages[0].split()
-        self.logger.info(f"📊 TOTAL de emails encontrados: {len(email_ids)}")
+        self.logger.info(f"🧩 Análisis fragmentado: {len(shards)} ventanas ({self.get_shard_mode()}), {workers} conexión(es)")
         
-        if email_ids:
-            # Obtener fechas del primer y último email para verificación
-            try:
-                first_email_result, first_email_data = self.mail.fetch(email_ids[0], '(RFC822)')
-                if first_email_result == 'OK':
-                    first_msg = email.message_from_bytes(first_email_data[0][1])
-                    first_date = self.get_email_date(first_msg)
-                    self.logger.info(f"📅 Fecha del primer email: {first_date.strftime('%Y-%m-%d %H:%M:%S')}")
-                
-                last_email_result, last_email_data = self.mail.fetch(email_ids[-1], '(RFC822)')
-                if last_email_result == 'OK':
-                    last_msg = email.message_from_bytes(last_email_data[0][1])
-                    last_date = self.get_email_date(last_msg)
-                    self.logger.info(f"📅 Fecha del último email: {last_date.strftime('%Y-%m-%d %H:%M:%S')}")
-                    
-            except Exception as e:
-                self.logger.debug(f"Error obteniendo fechas de verificación: {e}")
+        totals = {'total_emails': 0, 'valid_emails': 0, 'total_files': 0}
+        pending_shards = []
+        self.failed_shards = 0
         
-        self.logger.info("=== BÚSQUEDA DE EMAILS COMPLETADA ===")
-        return email_ids
+        for shard in shards:
+            checkpoint = self.load_shard_checkpoint(shard)
+            if checkpoint:
+                self.logger.info(f"⏭️ Ventana {shard[0]} - {shard[1]} ya procesada (checkpoint)")
+                self.merge_shard_result(checkpoint, totals)
+            else:
+                pending_shards.append(shard)
+        
+        if workers == 1:
+            for shard in pending_shards:
+                result = self.process_shard(shard)
+                if result:
+                    # Las filas ya quedaron en self.report
+                    for key in totals:
+                        totals[key] += result[key]
+                else:
+                    self.failed_shards += 1
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(self.process_shard_in_worker, shard): shard for shard in pending_shards}
+                for future in as_completed(futures):
+                    shard = futures[future]
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        self.logger.error(f"❌ Error procesando ventana {shard[0]} - {shard[1]}: {e}")
+                        result = None
+                    if result:
+                        self.merge_shard_result(result, totals)
+                    else:
+                        self.failed_shards += 1
+        
+        return totals
     
-    def check_email_matches_filters(self, msg, sender, subject):
-        """Verifica si un email cumple con los filtros configurados"""
+    def merge_shard_result(self, result, totals):
+        """Incorpora las filas y contadores de una ventana al reporte de la ejecución"""
+        if 'rows_file' in result:
+            self.report.extend_captured(result['rows_file'])
+        else:
+            # Checkpoints anteriores: filas dentro del propio JSON
+            self.report.extend(result['rows'])
+            self.report.extend_attachments(result.get('attachments', []))
+        for key in totals:
+            totals[key] += result[key]
+    
+    def check_email_matches_filters(self, msg, sender, subject, check_attachments=True):
+        """Verifica si un email cumple con los filtros configurados (los adjuntos se pueden evaluar aparte)"""
         filters = self.config['filters']
         rejection_reasons = []
         
@@ -490,18 +3587,16 @@ class EmailImageDownloader:
                 else:
                     self.logger.debug(f"✅ FILTRO FECHA: OK ({email_date.date()})")
         
+        matcher = self.get_filter_matcher()
+        
         # 2. Verificar remitentes
-        if filters['sender_emails'] and len(filters['sender_emails']) > 0:
+        if matcher.sender_count:
             # HAY remitentes específicos configurados
-            self.logger.debug(f"🔍 FILTRO REMITENTES: Verificando contra lista: {filters['sender_emails']}")
-            sender_match = False
-            for filter_sender in filters['sender_emails']:
-                if filter_sender.lower() in sender.lower():
-                    sender_match = True
-                    self.logger.debug(f"✅ FILTRO REMITENTES: Match encontrado con {filter_sender}")
-                    break
+            matched_sender = matcher.match_sender(sender)
             
-            if not sender_match:
+            if matched_sender:
+                self.logger.debug(f"✅ FILTRO REMITENTES: Match encontrado con {matched_sender}")
+            else:
                 rejection_reasons.append(f"Remitente no coincide con los configurados ({', '.join(filters['sender_emails'])})")
                 self.logger.debug(f"❌ FILTRO REMITENTES: No coincide con ninguno de la lista")
         else:
@@ -509,42 +3604,28 @@ class EmailImageDownloader:
             self.logger.debug(f"✅ FILTRO REMITENTES: Lista vacía - permitiendo cualquier remitente")
         
         # 3. Verificar palabras clave en asunto
-        if filters['subject_keywords'] and len(filters['subject_keywords']) > 0:
+        if matcher.keywords:
             # HAY palabras clave configuradas
-            self.logger.debug(f"🔍 FILTRO PALABRAS CLAVE: Verificando contra: {filters['subject_keywords']}")
-            subject_match = False
-            subject_normalized = self.normalize_text_for_search(subject)
-            
-            # Debug: mostrar asunto normalizado
-            self.logger.debug(f"🔍 Asunto original: '{subject}'")
-            self.logger.debug(f"🔍 Asunto normalizado: '{subject_normalized}'")
-            
-            for keyword in filters['subject_keywords']:
-                keyword_normalized = self.normalize_text_for_search(keyword)
-                self.logger.debug(f"🔍 Buscando palabra clave: '{keyword}' (normalizada: '{keyword_normalized}')")
-                
-                if keyword_normalized in subject_normalized:
-                    subject_match = True
-                    self.logger.debug(f"✅ FILTRO PALABRAS CLAVE: MATCH encontrado con palabra clave: '{keyword}'")
-                    break
-                else:
-                    self.logger.debug(f"❌ No match con: '{keyword_normalized}' en '{subject_normalized}'")
+            matched_keyword = matcher.match_subject(subject)
             
-            if not subject_match:
+            if matched_keyword:
+                self.logger.debug(f"✅ FILTRO PALABRAS CLAVE: MATCH encontrado con palabra clave: '{matched_keyword}'")
+            else:
                 rejection_reasons.append(f"Asunto no contiene palabras clave esperadas ({', '.join(filters['subject_keywords'])})")
-                self.logger.debug(f"❌ FILTRO PALABRAS CLAVE: No se encontró ninguna coincidencia")
+                self.logger.debug(f"❌ FILTRO PALABRAS CLAVE: No se encontró ninguna coincidencia en '{subject}'")
         else:
             # NO hay palabras clave = permitir cualquier asunto
             self.logger.debug(f"✅ FILTRO PALABRAS CLAVE: Lista vacía - permitiendo cualquier asunto")
         
         # 4. Verificar archivos adjuntos
-        self.logger.debug(f"🔍 FILTRO ARCHIVOS ADJUNTOS: Verificando...")
-        has_attachments = self.has_relevant_attachments(msg)
-        if not has_attachments:
-            rejection_reasons.append("Sin archivos adjuntos de tipos permitidos")
-            self.logger.debug(f"❌ FILTRO ARCHIVOS ADJUNTOS: No se encontraron archivos válidos")
-        else:
-            self.logger.debug(f"✅ FILTRO ARCHIVOS ADJUNTOS: Archivos válidos encontrados")
+        if check_attachments:
+            self.logger.debug(f"🔍 FILTRO ARCHIVOS ADJUNTOS: Verificando...")
+            has_attachments = self.has_relevant_attachments(msg)
+            if not has_attachments:
+                rejection_reasons.append("Sin archivos adjuntos de tipos permitidos")
+                self.logger.debug(f"❌ FILTRO ARCHIVOS ADJUNTOS: No se encontraron archivos válidos")
+            else:
+                self.logger.debug(f"✅ FILTRO ARCHIVOS ADJUNTOS: Archivos válidos encontrados")
         
         # Resultado final
         passes_all_filters = len(rejection_reasons) == 0
@@ -662,7 +3743,7 @@ class EmailImageDownloader:
                             attachment_details.append(f"GIF por magic bytes en parte {part_index}")
                             if '.gif' in allowed_extensions:
                                 attachment_found = True
-                        elif magic_bytes.startswith(b'DICM'):
+                        elif is_dicom_data(decoded_payload):
                             self.logger.debug(f"      🏥 DICOM DETECTADO POR MAGIC BYTES!")
                             attachment_details.append(f"DICOM por magic bytes en parte {part_index}")
                             if '.dcm' in allowed_extensions:
@@ -674,6 +3755,7 @@ class EmailImageDownloader:
                 self.logger.debug(f"      Error decodificando payload: {e}")
             
             # VERIFICACIONES ESPECÍFICAS
+            empty_archive = False
             
             # 1. Archivo con filename
             if filename:
@@ -689,13 +3771,34 @@ class EmailImageDownloader:
                         self.logger.debug(f"      ✅ MATCH POR FILENAME: {decoded_filename}")
                         attachment_details.append(f"Archivo válido: {decoded_filename}")
                         attachment_found = True
+                    elif self.is_expandable_archive(decoded_filename, content_type):
+                        # Los miembros se clasifican ya en el análisis (nombres y primeros bytes)
+                        if self.get_archive_expander().classify(decoded_payload or b'', allowed_extensions):
+                            self.logger.debug(f"      📦 ZIP A EXPANDIR: {decoded_filename}")
+                            attachment_details.append(f"Archivo ZIP: {decoded_filename}")
+                            attachment_found = True
+                        else:
+                            self.logger.debug(f"      ❌ ZIP sin archivos permitidos: {decoded_filename}")
+                            attachment_details.append(f"ZIP sin archivos permitidos: {decoded_filename}")
+                            empty_archive = True
                     else:
                         self.logger.debug(f"      ❌ Extensión no permitida: {file_ext}")
                 except Exception as e:
                     self.logger.debug(f"      Error procesando filename: {e}")
             
-            # 2. Content-Type específico
-            if content_type:
+            # 1b. ZIP sin nombre (sólo por su content-type): se clasifica igual, por sus miembros
+            elif self.is_expandable_archive(None, content_type):
+                if self.get_archive_expander().classify(decoded_payload or b'', allowed_extensions):
+                    self.logger.debug(f"      📦 ZIP A EXPANDIR (sin nombre) en parte {part_index}")
+                    attachment_details.append(f"Archivo ZIP sin nombre en parte {part_index}")
+                    attachment_found = True
+                else:
+                    self.logger.debug(f"      ❌ ZIP sin archivos permitidos en parte {part_index}")
+                    attachment_details.append(f"ZIP sin archivos permitidos en parte {part_index}")
+                    empty_archive = True
+            
+            # 2. Content-Type específico (un ZIP ya clasificado sin archivos permitidos no cuenta)
+            if content_type and not empty_archive:
                 self.logger.debug(f"      🔍 CONTENT-TYPE ANALYSIS: {content_type}")
                 
                 # Mapeo detallado
@@ -721,8 +3824,8 @@ class EmailImageDownloader:
                     else:
                         self.logger.debug(f"      ❌ Content-type no tiene extensiones permitidas")
             
-            # 3. Content-Disposition
-            if content_disposition:
+            # 3. Content-Disposition (un ZIP ya clasificado sin archivos permitidos no cuenta)
+            if content_disposition and not empty_archive:
                 self.logger.debug(f"      🔍 CONTENT-DISPOSITION ANALYSIS: {content_disposition}")
                 if 'attachment' in content_disposition.lower():
                     self.logger.debug(f"      ✅ MATCH POR CONTENT-DISPOSITION: attachment")
@@ -771,6 +3874,15 @@ class EmailImageDownloader:
                                         self.logger.debug(f"   🎯 ¡PNG DETECTADO EN BINARIO!")
                                         if '.png' in allowed_extensions:
                                             attachment_found = True
+                                    elif magic_bytes.startswith(b'PK\x03\x04'):
+                                        # Un ZIP cuenta si se guarda tal cual o si al expandirlo aporta miembros permitidos
+                                        if '.zip' in allowed_extensions or (
+                                                self.is_expandable_archive(None, 'application/zip')
+                                                and self.get_archive_expander().classify(payload, allowed_extensions)):
+                                            self.logger.debug(f"   📦 ¡ZIP CON ARCHIVOS PERMITIDOS EN BINARIO!")
+                                            attachment_found = True
+                                        else:
+                                            self.logger.debug(f"   ❌ ZIP sin archivos permitidos en parte {i}")
                                     else:
                                         # Considerar como archivo válido genérico
                                         attachment_found = True
@@ -852,20 +3964,446 @@ class EmailImageDownloader:
         
         return image_links
     
+    def use_section_fetch(self):
+        """Indica si está activo el modo de descarga por secciones MIME (BODY.PEEK[n.m])"""
+        return self.message_source is None and self.config['download_settings'].get('section_fetch', False)
+    
+    @staticmethod
+    def parse_imap_response(data):
+        """Convierte la respuesta de imaplib (bytes y tuplas con literales) en listas anidadas"""
+        token_pattern = re.compile(rb'\(|\)|"((?:[^"\\]|\\.)*)"|\{(\d+)\}\s*$|[^\s()"\[]+(?:\[[^\]]*\](?:<[\d.]+>)?)?')
+        root = []
+        stack = [root]
+        
+        for item in data:
+            if isinstance(item, tuple):
+                text, literal = item
+            else:
+                text, literal = item, None
+            
+            for match in token_pattern.finditer(text or b''):
+                token = match.group(0)
+                if token == b'(':
+                    stack[-1].append([])
+                    stack.append(stack[-1][-1])
+                elif token == b')':
+                    if len(stack) > 1:
+                        stack.pop()
+                elif match.group(1) is not None:
+                    stack[-1].append(re.sub(rb'\\(.)', rb'\1', match.group(1)))
+                elif match.group(2) is not None:
+                    stack[-1].append(literal)
+                    literal = None
+                elif token.upper() == b'NIL':
+                    stack[-1].append(None)
+                else:
+                    stack[-1].append(token)
+        
+        return root
+    
+    def parse_fetch_items(self, data):
+        """Devuelve un dict {ITEM: valor} de la primera respuesta FETCH (p. ej. 'BODYSTRUCTURE', 'BODY[HEADER]')"""
+        parsed = self.parse_imap_response(data)
+        
+        for position, value in enumerate(parsed):
+            if isinstance(value, list):
+                return self.fetch_items_to_dict(value)
+        
+        return {}
+    
+    def fetch_items_to_dict(self, value):
+        """Convierte la lista [ITEM valor ITEM valor ...] de una respuesta FETCH en dict"""
+        items = {}
+        for index in range(0, len(value) - 1, 2):
+            key = value[index]
+            if isinstance(key, bytes):
+                items[key.decode('ascii', errors='replace').upper()] = value[index + 1]
+        return items
+    
+    def decode_structure_params(self, params):
+        """Convierte la lista de parámetros de BODYSTRUCTURE en dict (decodificando RFC 2047/2231)"""
+        result = {}
+        if not isinstance(params, list):
+            return result
+        
+        for index in range(0, len(params) - 1, 2):
+            key = (params[index] or b'').decode('ascii', errors='replace').lower()
+            value = params[index + 1]
+            if isinstance(value, bytes):
+                value = value.decode('utf-8', errors='replace')
+            
+            if key.endswith('*') and value and "''" in value:
+                # RFC 2231: charset'idioma'valor-codificado
+                charset, _, encoded = value.split("'", 2)
+                value = unquote(encoded, encoding=charset or 'utf-8', errors='replace')
+                key = key[:-1]
+            
+            result[key] = self.decode_email_header(value) if value else value
+        
+        return result
+    
+    def flatten_bodystructure(self, structure, prefix=''):
+        """Recorre BODYSTRUCTURE y devuelve las partes hoja con su número de sección IMAP"""
+        parts = []
+        
+        if not isinstance(structure, list) or not structure:
+            return parts
+        
+        if isinstance(structure[0], list):
+            # multipart: hijos seguidos del subtipo
+            child_number = 0
+            for child in structure:
+                if not isinstance(child, list):
+                    break
+                child_number += 1
+                child_prefix = f"{prefix}.{child_number}" if prefix else str(child_number)
+                parts.extend(self.flatten_bodystructure(child, child_prefix))
+            return parts
+        
+        section = prefix or '1'
+        main_type = (structure[0] or b'').decode('ascii', errors='replace').lower()
+        sub_type = (structure[1] or b'').decode('ascii', errors='replace').lower()
+        content_type = f"{main_type}/{sub_type}"
+        params = self.decode_structure_params(structure[2])
+        encoding = (structure[5] or b'7bit').decode('ascii', errors='replace').lower()
+        size = int(structure[6]) if structure[6] else 0
+        
+        # Posición de la disposición según el tipo (RFC 3501, body-ext-1part)
+        if content_type == 'message/rfc822':
+            disposition_index = 11
+            if len(structure) > 8 and isinstance(structure[8], list) and structure[8]:
+                # El mensaje reenviado se recorre igual que lo haría msg.walk(). Sus partes son N.1, N.2...;
+                # si su cuerpo no es multipart, el cuerpo es la sección N.1 (RFC 3501, 6.4.5)
+                inner = structure[8]
+                inner_prefix = section if isinstance(inner[0], list) else f"{section}.1"
+                parts.extend(self.flatten_bodystructure(inner, inner_prefix))
+        elif main_type == 'text':
+            disposition_index = 9
+        else:
+            disposition_index = 8
+        
+        disposition = ''
+        disposition_params = {}
+        if len(structure) > disposition_index and isinstance(structure[disposition_index], list):
+            disposition_value = structure[disposition_index]
+            disposition = (disposition_value[0] or b'').decode('ascii', errors='replace').lower()
+            if len(disposition_value) > 1:
+                disposition_params = self.decode_structure_params(disposition_value[1])
+        
+        if content_type != 'message/rfc822':
+            parts.append({
+                'section': section,
+                'content_type': content_type,
+                'encoding': encoding,
+                'size': size,
+                'filename': disposition_params.get('filename') or params.get('name'),
+                'disposition': disposition
+            })
+        
+        return parts
+    
+    def summarize_structure_parts(self, parts):
+        """Resumen de adjuntos (total, tipos) equivalente al que calcula add_email_to_report con msg.walk()"""
+        total_attachments = 0
+        attachment_types = []
+        
+        for part in parts:
+            content_type = part['content_type']
+            if part['filename'] or content_type.startswith('image/') or content_type == 'application/pdf':
+                total_attachments += 1
+                if content_type not in attachment_types:
+                    attachment_types.append(content_type)
+        
+        return total_attachments, attachment_types
+    
+    def plan_section_downloads(self, parts):
+        """Elige las partes a descargar aplicando las mismas estrategias que la descarga completa"""
+        allowed_extensions = self.config['download_settings']['allowed_extensions']
+        ext_map = {
+            'image/jpeg': '.jpg',
+            'image/jpg': '.jpg',
+            'image/png': '.png',
+            'image/gif': '.gif',
+            'image/bmp': '.bmp',
+            'image/tiff': '.tiff',
+            'image/webp': '.webp',
+            'application/pdf': '.pdf',
+            'application/dicom': '.dcm',
+            'application/msword': '.doc',
+            'application/vnd.openxmlformats-officedocument.wordprocessingml.document': '.docx'
+        }
+        plan = []
+        
+        for index, part in enumerate(parts):
+            content_type = part['content_type']
+            filename = part['filename']
+            
+            # ESTRATEGIA 1: Archivo con filename
+            if filename:
+                if Path(filename).suffix.lower() in allowed_extensions or self.is_expandable_archive(filename, content_type):
+                    plan.append(dict(part, filename=filename, strategy='filename'))
+            
+            # ESTRATEGIA 2: Sin filename pero content-type conocido
+            elif content_type in ext_map:
+                if ext_map[content_type] in allowed_extensions:
+                    plan.append(dict(part, filename=f"archivo_parte_{index}{ext_map[content_type]}", strategy='content_type'))
+            
+            # ZIP sin nombre: sus miembros se clasifican al guardar
+            elif self.is_expandable_archive(None, content_type):
+                plan.append(dict(part, filename=f"archivo_parte_{index}.zip", strategy='content_type'))
+            
+            # ESTRATEGIA 3: Tipo genérico: se decide por los magic bytes (lectura parcial)
+            elif not content_type.startswith(('text/', 'multipart/')):
+                plan.append(dict(part, filename=None, strategy='magic_bytes', part_index=index))
+        
+        return plan
+    
+    def peek_section_magic(self, email_id, part):
+        """Lee sólo el comienzo de una sección (BODY.PEEK[n]<0.N>) y lo decodifica para detectar su tipo"""
+        # 256 bytes en base64 dan ~190 decodificados: alcanza para el 'DICM' en el offset 128. En
+        # quoted-printable un byte binario ocupa hasta 3 ('=00') más los saltos suaves: se leen 512
+        length = 512 if part['encoding'] == 'quoted-printable' else 256
+        result, data = self.imap_fetch(email_id, f"(BODY.PEEK[{part['section']}]<0.{length}>)")
+        if result != 'OK':
+            return None
+        
+        items = self.parse_fetch_items(data)
+        head = next((value for key, value in items.items() if key.startswith('BODY[')), None) or b''
+        if part['encoding'] == 'base64':
+            head = head.translate(None, b' \r\n\t')
+            head = base64.b64decode(head[:len(head) // 4 * 4])
+        elif part['encoding'] == 'quoted-printable':
+            # Un '=XX' cortado al final queda tal cual; el comienzo ya sale decodificado
+            head = quopri.decodestring(head)
+        return head
+    
+    def decode_section_payload(self, data, encoding):
+        """Decodifica el contenido de una sección según su Content-Transfer-Encoding"""
+        if encoding == 'base64':
+            return base64.b64decode(data.translate(None, b' \r\n\t'))
+        if encoding == 'quoted-printable':
+            return quopri.decodestring(data)
+        return data
+    
+    def fetch_structure_and_header(self, email_id):
+        """Obtiene BODYSTRUCTURE y los headers (sin marcar como leído); devuelve (msg, partes) o None"""
+        result, data = self.imap_fetch(email_id, '(BODYSTRUCTURE BODY.PEEK[HEADER])')
+        if result != 'OK':
+            return None
+        
+        items = self.parse_fetch_items(data)
+        header = items.get('BODY[HEADER]')
+        if 'BODYSTRUCTURE' not in items or header is None:
+            return None
+        
+        return email.message_from_bytes(header), self.flatten_bodystructure(items['BODYSTRUCTURE'])
+    
+    def analyze_email_by_structure(self, email_id):
+        """
+        Análisis sin descargar el cuerpo: filtros de remitente/asunto/fecha sobre los headers y
+        adjuntos según BODYSTRUCTURE. Devuelve None si hace falta el análisis completo (RFC822),
+        p. ej. cuando los archivos sólo podrían estar como enlaces o imágenes dentro del HTML.
+        """
+        try:
+            structure = self.fetch_structure_and_header(email_id)
+        except Exception as e:
+            self.logger.debug(f"BODYSTRUCTURE no disponible para {email_id}: {e}")
+            return None
+        
+        if structure is None:
+            return None
+        
+        msg, parts = structure
+        summary = self.summarize_structure_parts(parts)
+        meta = self.get_message_meta(msg, email_id, attachment_summary=summary)
+        sender = meta.sender
+        subject = meta.subject
+        
+        passes_filters, rejection_reasons = self.check_email_matches_filters(msg, sender, subject, check_attachments=False)
+        
+        if not passes_filters:
+            motivo_completo = "; ".join(rejection_reasons)
+            self.logger.warning(f"❌ EMAIL RECHAZADO: {sender} - {subject}")
+            self.logger.warning(f"   Motivos: {motivo_completo}")
+            row = self.add_email_to_report(email_id, msg, "DESCARTADO", 0, motivo_completo, "N/A", summary)
+            if self.journal:
+                self.journal.record_analysis(email_id, False, row)
+            return False
+        
+        # Las partes genéricas sólo cuentan si sus primeros bytes confirman un tipo permitido (lectura de 256 bytes)
+        # y los ZIP a expandir si su directorio central muestra algún miembro que podría serlo
+        plan = self.plan_section_downloads(parts)
+        if not any(self.is_section_confirmed(email_id, part) for part in plan):
+            # Sin candidatas o con HTML (posibles enlaces/imágenes embebidas) decide el análisis completo
+            if not plan or any(part['content_type'] == 'text/html' for part in parts):
+                return None
+            if any(self.is_expandable_archive(part['filename'], part['content_type']) for part in plan):
+                motivo = "ZIP sin archivos permitidos"
+            else:
+                motivo = "Sin archivos adjuntos de tipos permitidos"
+            self.logger.warning(f"❌ EMAIL RECHAZADO: {sender} - {subject}")
+            self.logger.warning(f"   Motivos: {motivo}")
+            row = self.add_email_to_report(email_id, msg, "DESCARTADO", 0, motivo, "N/A", summary)
+            if self.journal:
+                self.journal.record_analysis(email_id, False, row)
+            return False
+        
+        self.logger.info(f"✅ EMAIL APROBADO (BODYSTRUCTURE): {sender} - {subject}")
+        row = self.add_email_to_report(email_id, msg, "PENDIENTE_DESCARGA", 0, "", "", summary)
+        if self.journal:
+            self.journal.record_analysis(email_id, True, row)
+        return True
+    
+    def is_section_confirmed(self, email_id, part):
+        """True si una parte del plan de descarga aportaría al menos un archivo permitido"""
+        if part['strategy'] == 'magic_bytes':
+            return bool(self.resolve_magic_part(email_id, part))
+        if (self.is_expandable_archive(part['filename'], part['content_type'])
+                and '.zip' not in self.config['download_settings']['allowed_extensions']):
+            return self.resolve_archive_part(email_id, part)
+        return True
+    
+    def resolve_archive_part(self, email_id, part):
+        """
+        Clasifica un ZIP por los nombres de su directorio central leyendo sólo el final de la sección
+        (BODY.PEEK[n]<inicio.N>); True si algún miembro podría ser permitido o si no se pudo leer
+        """
+        tail_bytes = int(float(self.get_archive_config().get('analysis_tail_kb', 256)) * 1024)
+        start = max(0, part['size'] - tail_bytes)
+        result, data = self.imap_fetch(email_id, f"(BODY.PEEK[{part['section']}]<{start}.{tail_bytes}>)")
+        if result != 'OK':
+            return True
+        
+        items = self.parse_fetch_items(data)
+        tail = next((value for key, value in items.items() if key.startswith('BODY[')), None) or b''
+        if part['encoding'] == 'base64':
+            if start:
+                # Se descarta la línea cortada: las líneas base64 completas están alineadas a 4 caracteres
+                tail = tail[tail.find(b'\n') + 1:]
+            tail = tail.translate(None, b' \r\n\t')
+            try:
+                tail = base64.b64decode(tail[:len(tail) // 4 * 4])
+            except ValueError:
+                return True
+        
+        infos = self.get_archive_expander().list_tail_members(tail)
+        if infos is None:
+            self.logger.debug(f"Directorio central del ZIP {part['filename']} fuera del tramo leído")
+            return True
+        return self.archive_expander.may_contain_allowed(infos, set(self.config['download_settings']['allowed_extensions']))
+    
+    def resolve_magic_part(self, email_id, part):
+        """Decide el nombre de una parte genérica leyendo sus primeros bytes; False si no se descargaría"""
+        allowed_extensions = self.config['download_settings']['allowed_extensions']
+        head = self.peek_section_magic(email_id, part) or b''
+        detected_ext = self.detect_extension_from_magic(head)
+        
+        if detected_ext and detected_ext in allowed_extensions:
+            part['filename'] = f"archivo_magic_{part['part_index']}{detected_ext}"
+            return True
+        
+        if part['disposition'] == 'attachment':
+            # ESTRATEGIA 4: marcado como attachment
+            if 'image' in part['content_type']:
+                detected_ext = '.jpg'
+            elif 'pdf' in part['content_type']:
+                detected_ext = '.pdf'
+            else:
+                detected_ext = '.bin'
+            if detected_ext not in allowed_extensions:
+                return False
+            part['filename'] = f"attachment_{part['part_index']}{detected_ext}"
+            part['strategy'] = 'attachment'
+            return True
+        
+        return False
+    
+    def download_sections_from_email(self, email_id):
+        """
+        Descarga sólo las secciones MIME relevantes con BODY.PEEK[n.m] (no marca el email como leído).
+        Devuelve None si no hay partes candidatas y hace falta la descarga completa.
+        """
+        structure = self.fetch_structure_and_header(email_id)
+        if structure is None:
+            return None
+        
+        msg, parts = structure
+        plan = self.plan_section_downloads(parts)
+        if not plan:
+            return None
+        
+        meta = self.get_message_meta(msg, email_id, attachment_summary=self.summarize_structure_parts(parts))
+        sender = meta.sender
+        subject = meta.subject
+        allowed_extensions = self.config['download_settings']['allowed_extensions']
+        attachments_to_download = []
+        
+        self.logger.info(f"🔍 DESCARGA POR SECCIONES: De: {sender}, Asunto: {subject} ({len(plan)} partes candidatas)")
+        
+        for part in plan:
+            if part['strategy'] == 'magic_bytes' and not self.resolve_magic_part(email_id, part):
+                continue
+            
+            result, data = self.imap_fetch(email_id, f"(BODY.PEEK[{part['section']}])")
+            if result != 'OK':
+                self.logger.warning(f"⚠️ No se pudo obtener la sección {part['section']} del email {email_id}")
+                continue
+            
+            # imaplib entrega cada literal completo: la sección se decodifica en memoria y pasa a la misma
+            # etapa de guardado que los adjuntos de la descarga completa (el cuerpo del email nunca se trae)
+            items = self.parse_fetch_items(data)
+            raw = next((value for key, value in items.items() if key.startswith('BODY[')), None)
+            file_data = self.decode_section_payload(raw or b'', part['encoding'])
+            
+            if not file_data or len(file_data) < 10:
+                continue
+            
+            attachments_to_download.append({
+                'filename': part['filename'],
+                'data': file_data,
+                'content_type': part['content_type'],
+                'strategy': part['strategy'],
+                'source': f"seccion_{part['section']}"
+            })
+            self.logger.info(f"📎 AGREGADO PARA DESCARGA: {part['filename']} ({len(file_data)} bytes, sección {part['section']})")
+        
+        return self.save_attachments(email_id, msg, sender, subject, attachments_to_download)
+    
+    def detect_extension_from_magic(self, file_data):
+        """Detecta la extensión de un archivo por sus magic bytes"""
+        if file_data.startswith(b'\xff\xd8\xff'):  # JPEG
+            return '.jpg'
+        elif file_data.startswith(b'\x89PNG'):  # PNG
+            return '.png'
+        elif file_data.startswith(b'%PDF'):  # PDF
+            return '.pdf'
+        elif file_data.startswith(b'GIF8'):  # GIF
+            return '.gif'
+        elif is_dicom_data(file_data):  # DICOM: 'DICM' tras el preámbulo de 128 bytes
+            return '.dcm'
+        return None
+    
     def analyze_email_for_report(self, email_id):
         """
         VERSIÓN CON DEBUG EXTREMO - Para el caso específico de Patricia
         """
+        # Con el mensaje en caché local el análisis completo no cuesta red
+        if self.use_section_fetch() and not self.is_message_cached(email_id):
+            verdict = self.analyze_email_by_structure(email_id)
+            if verdict is not None:
+                return verdict
+        
         try:
-            result, msg_data = self.mail.fetch(email_id, '(RFC822)')
+            raw_message = self.fetch_raw_message(email_id)
             
-            if result != 'OK':
+            if raw_message is None:
                 self.add_email_to_report(email_id, None, "ERROR", 0, "Error obteniendo datos del email", "N/A")
                 return False
             
-            msg = email.message_from_bytes(msg_data[0][1])
-            sender = self.decode_email_header(msg['From'])
-            subject = self.decode_email_header(msg['Subject'])
+            msg = email.message_from_bytes(raw_message)
+            meta = self.get_message_meta(msg, email_id, size=len(raw_message))
+            sender = meta.sender
+            subject = meta.subject
             
             self.logger.debug(f"📧 ANÁLISIS DETALLADO: {sender} - {subject}")
             
@@ -885,7 +4423,9 @@ class EmailImageDownloader:
             
             if passes_filters:
                 self.logger.info(f"✅ EMAIL APROBADO: {sender} - {subject}")
-                self.add_email_to_report(email_id, msg, "PENDIENTE_DESCARGA", 0, "", "")
+                row = self.add_email_to_report(email_id, msg, "PENDIENTE_DESCARGA", 0, "", "")
+                if self.journal:
+                    self.journal.record_analysis(email_id, True, row)
                 return True
             else:
                 motivo_completo = "; ".join(rejection_reasons)
@@ -901,7 +4441,9 @@ class EmailImageDownloader:
                     has_attachments = self.has_relevant_attachments(msg)
                     self.logger.debug(f"   Resultado re-análisis: {has_attachments}")
                 
-                self.add_email_to_report(email_id, msg, "DESCARTADO", 0, motivo_completo, "N/A")
+                row = self.add_email_to_report(email_id, msg, "DESCARTADO", 0, motivo_completo, "N/A")
+                if self.journal:
+                    self.journal.record_analysis(email_id, False, row)
                 return False
                     
         except Exception as e:
@@ -912,25 +4454,17 @@ class EmailImageDownloader:
 
 
 
-    def add_email_to_report(self, email_id, msg, estado, archivos_descargados, motivo_rechazo, ruta_descarga):
-        """Agrega un email al reporte CSV"""
+    def add_email_to_report(self, email_id, msg, estado, archivos_descargados, motivo_rechazo, ruta_descarga,
+                            attachment_summary=None):
+        """Agrega un email al reporte CSV (attachment_summary evita recorrer el mensaje si ya se conoce)"""
         if msg:
-            sender = self.decode_email_header(msg['From'])
-            subject = self.decode_email_header(msg['Subject'])
-            email_date = self.get_email_date(msg)
-            
-            # Contar archivos adjuntos
-            total_attachments = 0
-            attachment_types = []
-            
-            for part in msg.walk():
-                filename = part.get_filename()
-                content_type = part.get_content_type()
-                
-                if filename or content_type.startswith('image/') or content_type == 'application/pdf':
-                    total_attachments += 1
-                    if content_type not in attachment_types:
-                        attachment_types.append(content_type)
+            meta = self.get_message_meta(msg, email_id, attachment_summary=attachment_summary)
+            if meta.attachment_summary is None:
+                meta.attachment_summary = attachment_summary or self.summarize_message_attachments(msg)
+            sender = meta.sender
+            subject = meta.subject
+            email_date = meta.date
+            total_attachments, attachment_types = meta.attachment_summary
         else:
             sender = "Error"
             subject = "Error obteniendo email"
@@ -938,7 +4472,7 @@ class EmailImageDownloader:
             total_attachments = 0
             attachment_types = []
         
-        self.report_data.append({
+        row = {
             'email_id': int(email_id),
             'fecha': email_date.strftime('%Y-%m-%d %H:%M:%S'),
             'remitente': sender,
@@ -949,36 +4483,70 @@ class EmailImageDownloader:
             'archivos_descargados': archivos_descargados,
             'motivo_rechazo': motivo_rechazo,
             'ruta_descarga': ruta_descarga
-        })
-    
-    def update_email_report_status(self, email_id, new_status, files_downloaded, download_path):
-        """Actualiza el estado de un email en el reporte"""
-        for entry in self.report_data:
-            if entry['email_id'] == int(email_id):
-                entry['estado'] = new_status
-                entry['archivos_descargados'] = files_downloaded
-                entry['ruta_descarga'] = download_path
-                break
+        }
+        self.report.add(row)
+        return row
     
-    def generate_report_csv(self):
-        """Genera el reporte CSV con todos los emails analizados"""
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        report_filename = f'reporte_analisis_emails_{timestamp}.csv'
+    def update_email_report_status(self, email_id, new_status, files_downloaded, download_path, attachments=None,
+                                   motivo_rechazo=None):
+        """Actualiza el estado de un email en el reporte (y registra sus adjuntos guardados)"""
+        if attachments:
+            self.report.extend_attachments(attachments)
+        
+        if not self.report.update(email_id, new_status, files_downloaded, download_path, motivo_rechazo):
+            self.logger.debug(f"Email {email_id} no estaba pendiente en el reporte")
+        
+        if self.journal:
+            self.journal.record_download(email_id, new_status, files_downloaded, download_path, attachments, motivo_rechazo)
+    
+    def open_report_store(self, prefix='reporte_analisis_emails'):
+        """Crea el reporte de la ejecución en disco; las filas se escriben a medida que se completan"""
+        report_format = self.config['download_settings'].get('report_format', 'csv')
+        if report_format == 'parquet' and pq is None:
+            self.logger.warning("⚠️ pyarrow no está disponible - el reporte se generará en CSV")
+            report_format = 'csv'
         
-        with open(report_filename, 'w', newline='', encoding='utf-8') as csvfile:
-            fieldnames = ['email_id', 'fecha', 'remitente', 'asunto', 'archivos_adjuntos_total', 
-                         'tipos_archivos', 'estado', 'archivos_descargados', 'motivo_rechazo', 'ruta_descarga']
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        report_filename = f'{prefix}_{timestamp}.{report_format}'
+        self.report = ReportStore(report_filename, report_format)
+        return report_filename
+    
+    def generate_report_csv(self):
+        """Cierra el reporte de la ejecución (o lo genera desde memoria si no se abrió en disco)"""
+        if self.report.report_path is not None:
+            self.report.close()
+            report_filename = str(self.report.report_path)
+        else:
+            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+            report_filename = f'reporte_analisis_emails_{timestamp}.csv'
+            self.report.flush_pending()
+            
+            with open(report_filename, 'w', newline='', encoding='utf-8') as csvfile:
+                writer = csv.DictWriter(csvfile, fieldnames=ReportStore.FIELDNAMES)
+                
+                writer.writeheader()
+                for row in self.report.rows:
+                    writer.writerow(row)
             
-            writer.writeheader()
-            for row in self.report_data:
-                writer.writerow(row)
+            attachments_filename = report_filename.replace('.csv', '_adjuntos.csv')
+            with open(attachments_filename, 'w', newline='', encoding='utf-8') as csvfile:
+                writer = csv.DictWriter(csvfile, fieldnames=ReportStore.ATTACHMENT_FIELDNAMES)
+                
+                writer.writeheader()
+                for record in self.report.attachment_rows:
+                    writer.writerow(record)
         
         self.logger.info(f"📊 REPORTE GENERADO: {report_filename}")
         return report_filename
     
     def create_folder_structure(self, msg, sender):
         """Crea la estructura de carpetas para organizar los archivos"""
+        folder_path, email_date = self.get_target_folder(msg, sender)
+        self.get_attachment_writer().ensure_folder(folder_path)
+        return folder_path, email_date
+    
+    def get_target_folder(self, msg, sender):
+        """Carpeta destino de los archivos de un email (sin crearla)"""
         base_path = Path(self.config['download_settings']['base_folder'])
         
         # Obtener fecha del email
@@ -991,7 +4559,6 @@ class EmailImageDownloader:
         
         # Estructura: base_folder/año/mes/día/remitente
         folder_path = base_path / str(email_date.year) / f"{email_date.month:02d}" / f"{email_date.day:02d}" / clean_sender
-        folder_path.mkdir(parents=True, exist_ok=True)
         
         return folder_path, email_date
     
@@ -1042,13 +4609,12 @@ class EmailImageDownloader:
         # Clave para el cache basada en fecha
         date_key = email_date.strftime('%Y-%m-%d')
         
-        if date_key not in self.duplicates_cache:
-            self.duplicates_cache[date_key] = set()
-        
-        if file_hash in self.duplicates_cache[date_key]:
-            return True
-        
-        self.duplicates_cache[date_key].add(file_hash)
+        # Caché compartida entre las conexiones de la ejecución: comprobar y registrar es una sola operación
+        with self.duplicates_lock:
+            day_hashes = self.duplicates_cache.setdefault(date_key, set())
+            if file_hash in day_hashes:
+                return True
+            day_hashes.add(file_hash)
         return False
     
     def extract_google_drive_links(self, html_content):
@@ -1070,7 +4636,157 @@ class EmailImageDownloader:
                     'download_url': f'https://drive.google.com/uc?export=download&id={match}'
                 })
         
-        return drive_links
+        return drive_links
+    
+    def get_http_cache(self):
+        """Caché de descargas por enlace (download_settings.http_cache); se abre al primer uso"""
+        cache_config = self.config['download_settings'].get('http_cache', {})
+        if not cache_config.get('enabled', False) or self.http_cache is not None:
+            return self.http_cache
+        
+        try:
+            self.http_cache = HttpDownloadCache(
+                self.get_state_path(cache_config.get('path'), '.cache/descargas_http.sqlite3')
+            )
+        except Exception as e:
+            self.logger.warning(f"⚠️ No se pudo abrir la caché de descargas: {e}")
+        
+        return self.http_cache
+    
+    def get_max_file_bytes(self):
+        """Tamaño máximo por archivo descargado por enlace (download_settings.max_file_size_mb; 0 = sin límite)"""
+        return int(float(self.config['download_settings'].get('max_file_size_mb', 0) or 0) * 1024 * 1024)
+    
+    def preflight_link(self, client, url, allowed_types=None, **kwargs):
+        """HEAD previo al GET: False si el servidor anuncia un tamaño mayor al máximo o un tipo no permitido"""
+        try:
+            response = self.http_request(client, 'head', url, allow_redirects=True, timeout=15, **kwargs)
+        except Exception as e:
+            self.logger.debug(f"HEAD falló para {url}: {e}")
+            return True
+        
+        # Muchos servidores no implementan HEAD: en ese caso decide el GET
+        if response.status_code >= 400:
+            return True
+        
+        content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        if allowed_types and content_type and not content_type.startswith(allowed_types):
+            self.logger.info(f"⏭️ Enlace omitido por tipo ({content_type}): {url}")
+            return False
+        
+        content_length = response.headers.get('Content-Length', '')
+        max_bytes = self.get_max_file_bytes()
+        if max_bytes and content_length.isdigit() and int(content_length) > max_bytes:
+            self.logger.info(f"⏭️ Enlace omitido por tamaño ({int(content_length) / 1048576:.1f} MB): {url}")
+            return False
+        
+        return True
+    
+    def fetch_link_content(self, client, url, cache_key, allowed_types=None, preflight=True, headers=None):
+        """
+        Contenido de un enlace: desde la caché si es reciente, revalidado con If-None-Match/If-Modified-Since
+        si no, o descargado (tras un HEAD previo) si no estaba. Devuelve un dict con data, source y los
+        headers relevantes, o None si el enlace se omite. Si se resolvió con la caché ('cache' o
+        'revalidated') no trae data sino el path del archivo ya guardado (ver reuse_cached_link).
+        """
+        cache = self.get_http_cache()
+        cache_config = self.config['download_settings'].get('http_cache', {})
+        entry = cache.get(cache_key) if cache is not None else None
+        request_headers = dict(headers or {})
+        
+        if entry is not None:
+            if time.time() - entry['fetched_at'] < float(cache_config.get('max_age_hours', 24)) * 3600:
+                cache.hits += 1
+                return self.resolve_cached_link(entry, 'cache')
+            if entry['etag']:
+                request_headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                request_headers['If-Modified-Since'] = entry['last_modified']
+        elif preflight and cache_config.get('preflight', True):
+            if not self.preflight_link(client, url, allowed_types, headers=request_headers):
+                return None
+        
+        response = self.http_get(client, url, headers=request_headers, timeout=30, stream=True)
+        if entry is not None and response.status_code == 304:
+            response.close()
+            cache.touch(cache_key)
+            cache.revalidations += 1
+            return self.resolve_cached_link(entry, 'revalidated')
+        response.raise_for_status()
+        
+        # Lectura por bloques con corte en el tamaño máximo (el Content-Length puede faltar o mentir)
+        max_bytes = self.get_max_file_bytes()
+        chunks = []
+        received = 0
+        for chunk in response.iter_content(chunk_size=65536):
+            received += len(chunk)
+            if max_bytes and received > max_bytes:
+                response.close()
+                self.logger.info(f"⏭️ Enlace omitido por tamaño (> {max_bytes / 1048576:.0f} MB): {url}")
+                return None
+            chunks.append(chunk)
+        
+        return {
+            'data': b''.join(chunks),
+            'source': 'network',
+            'key': cache_key,
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'content_type': response.headers.get('Content-Type', ''),
+            'content_disposition': response.headers.get('Content-Disposition', '')
+        }
+    
+    def resolve_cached_link(self, entry, source):
+        """Enlace ya descargado: se entrega la entrada de la caché (con el path del archivo), sin leerlo"""
+        self.logger.debug(f"💾 Enlace resuelto sin descargar ({source}): {entry['url']}")
+        return dict(entry, data=None, source=source)
+    
+    def reuse_cached_link(self, download, target_folder, filename):
+        """
+        Guarda un enlace resuelto con la caché sin volver a escribir sus bytes: el archivo ya descargado
+        se enlaza (enlace duro) en la carpeta del email. Si ya está en esa carpeta, o el sistema de
+        archivos no admite enlaces duros, se reutiliza su ruta. Devuelve la ruta a registrar.
+        """
+        cached_path = Path(download['path'])
+        if cached_path.parent == Path(target_folder):
+            self.logger.info(f"♻️ Enlace ya descargado en esta carpeta: {cached_path}")
+            return cached_path
+        
+        codec = stored_compression(cached_path)
+        if codec:
+            filename += STORAGE_CODEC_SUFFIXES[codec]
+        file_path = self.get_attachment_writer().reserve_path(target_folder, filename)
+        try:
+            os.link(cached_path, file_path)
+        except OSError as e:
+            self.logger.debug(f"Enlace duro no disponible ({e}): se reutiliza {cached_path}")
+            return cached_path
+        
+        self.logger.info(f"🔗 Enlace resuelto desde la caché (sin copiar): {file_path} → {cached_path}")
+        return file_path
+    
+    def remember_link_download(self, download, file_path):
+        """Registra en la caché un enlace recién descargado y guardado en disco"""
+        if download['source'] != 'network' or self.http_cache is None:
+            return
+        
+        try:
+            self.http_cache.put({
+                'key': download['key'],
+                'url': download['url'],
+                'etag': download['etag'],
+                'last_modified': download['last_modified'],
+                'content_type': download['content_type'],
+                'content_disposition': download['content_disposition'],
+                # Tamaño en disco (el archivo puede estar comprimido): es el que se verifica al reutilizarlo
+                'size': os.path.getsize(file_path),
+                'md5': hashlib.md5(download['data']).hexdigest(),
+                'path': str(file_path),
+                'fetched_at': time.time()
+            })
+        except Exception as e:
+            self.logger.warning(f"⚠️ No se pudo actualizar la caché de descargas: {e}")
     
     def download_from_google_drive(self, drive_info, target_folder, base_filename, index, email_date):
         """Descarga archivo desde Google Drive"""
@@ -1081,22 +4797,25 @@ class EmailImageDownloader:
             self.logger.debug(f"☁️ Descargando desde Google Drive: {url}")
             
             session = requests.Session()
-            response = session.get(url, stream=True)
+            cache_key = f"drive:{drive_info['file_id']}"
+            download = self.fetch_link_content(session, url, cache_key)
+            if download is None:
+                return None
             
             # Google Drive a veces requiere confirmación para archivos grandes
-            if 'virus scan warning' in response.text.lower():
+            if download['source'] == 'network' and b'virus scan warning' in download['data'].lower():
                 # Buscar el enlace de confirmación
-                confirm_pattern = r'confirm=([0-9A-Za-z_]+)'
-                confirm_match = re.search(confirm_pattern, response.text)
+                confirm_pattern = rb'confirm=([0-9A-Za-z_]+)'
+                confirm_match = re.search(confirm_pattern, download['data'])
                 if confirm_match:
-                    confirm_token = confirm_match.group(1)
+                    confirm_token = confirm_match.group(1).decode()
                     confirm_url = f"{url}&confirm={confirm_token}"
-                    response = session.get(confirm_url, stream=True)
-            
-            response.raise_for_status()
+                    download = self.fetch_link_content(session, confirm_url, cache_key, preflight=False)
+                    if download is None:
+                        return None
             
             # Determinar extensión del archivo
-            content_disposition = response.headers.get('Content-Disposition', '')
+            content_disposition = download['content_disposition'] or ''
             if 'filename=' in content_disposition:
                 filename_match = re.search(r'filename="?([^"]+)"?', content_disposition)
                 if filename_match:
@@ -1105,7 +4824,7 @@ class EmailImageDownloader:
                 else:
                     file_ext = '.bin'
             else:
-                content_type = response.headers.get('Content-Type', '')
+                content_type = download['content_type'] or ''
                 if 'pdf' in content_type:
                     file_ext = '.pdf'
                 elif 'image' in content_type:
@@ -1115,13 +4834,11 @@ class EmailImageDownloader:
             
             # Generar nombre de archivo
             filename = f"{base_filename}_drive_{index}{file_ext}"
-            file_path = target_folder / filename
+            if download['source'] != 'network':
+                return self.reuse_cached_link(download, target_folder, filename)
             
-            # Descargar contenido
-            file_data = b''
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    file_data += chunk
+            file_path = target_folder / filename
+            file_data = download['data']
             
             if len(file_data) == 0:
                 return None
@@ -1131,25 +4848,21 @@ class EmailImageDownloader:
                 self.logger.info(f"⏭️ Duplicado omitido: {filename}")
                 return None
             
-            # Resolver conflictos de nombres
-            counter = 1
-            original_path = file_path
-            while file_path.exists():
-                stem = original_path.stem
-                suffix = original_path.suffix
-                file_path = original_path.parent / f"{stem}_{counter}{suffix}"
-                counter += 1
-            
-            # Guardar archivo
-            file_path.write_bytes(file_data)
-            
-            if file_path.exists() and file_path.stat().st_size > 0:
-                self.logger.info(f"✅ Descargado desde Google Drive: {file_path}")
-                return file_path
-            else:
-                if file_path.exists():
-                    file_path.unlink()
+            image_hash = self.hash_images([(filename, file_data)]).get(0)
+            near_duplicate = self.find_near_duplicate(image_hash)
+            if self.skip_near_duplicate(filename, near_duplicate):
                 return None
+            
+            # Guardar archivo (nombre libre + escritura atómica)
+            file_path = self.save_link_file(target_folder, filename, file_data)
+            self.remember_link_download(download, file_path)
+            if image_hash is not None and near_duplicate is None:
+                self.perceptual_index.add(image_hash, file_path)
+            self.logger.info(f"✅ Descargado desde Google Drive: {file_path}")
+            dicom_tags = read_dicom_header(file_data)
+            if dicom_tags is not None:
+                self.record_dicom_files([(file_path, None, len(file_data), dicom_tags)])
+            return file_path
                 
         except Exception as e:
             self.logger.error(f"Error descargando desde Google Drive: {e}")
@@ -1171,8 +4884,11 @@ class EmailImageDownloader:
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
             }
             
-            response = requests.get(url, headers=headers, timeout=30, stream=True)
-            response.raise_for_status()
+            download = self.fetch_link_content(
+                requests, url, normalize_download_url(url), allowed_types=LINK_CONTENT_TYPES, headers=headers
+            )
+            if download is None:
+                return None
             
             # Determinar extensión desde URL o Content-Type
             file_ext = None
@@ -1180,7 +4896,7 @@ class EmailImageDownloader:
                 file_ext = '.' + url.split('.')[-1].split('?')[0].lower()
             
             if not file_ext or file_ext not in self.config['download_settings']['allowed_extensions']:
-                content_type = response.headers.get('Content-Type', '')
+                content_type = download['content_type'] or ''
                 if 'image/jpeg' in content_type:
                     file_ext = '.jpg'
                 elif 'image/png' in content_type:
@@ -1201,13 +4917,11 @@ class EmailImageDownloader:
             else:
                 filename = f"imagen_link_{index}{file_ext}"
             
-            file_path = target_folder / filename
+            if download['source'] != 'network':
+                return self.reuse_cached_link(download, target_folder, filename)
             
-            # Descargar contenido
-            file_data = b''
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    file_data += chunk
+            file_path = target_folder / filename
+            file_data = download['data']
             
             if len(file_data) == 0:
                 return None
@@ -1217,25 +4931,21 @@ class EmailImageDownloader:
                 self.logger.info(f"⏭️ Duplicado omitido: {filename}")
                 return None
             
-            # Resolver conflictos de nombres
-            counter = 1
-            original_path = file_path
-            while file_path.exists():
-                stem = original_path.stem
-                suffix = original_path.suffix
-                file_path = original_path.parent / f"{stem}_{counter}{suffix}"
-                counter += 1
-            
-            # Guardar archivo
-            file_path.write_bytes(file_data)
-            
-            if file_path.exists() and file_path.stat().st_size > 0:
-                self.logger.info(f"✅ Descargado desde enlace: {file_path}")
-                return file_path
-            else:
-                if file_path.exists():
-                    file_path.unlink()
+            image_hash = self.hash_images([(filename, file_data)]).get(0)
+            near_duplicate = self.find_near_duplicate(image_hash)
+            if self.skip_near_duplicate(filename, near_duplicate):
                 return None
+            
+            # Guardar archivo (nombre libre + escritura atómica)
+            file_path = self.save_link_file(target_folder, filename, file_data)
+            self.remember_link_download(download, file_path)
+            if image_hash is not None and near_duplicate is None:
+                self.perceptual_index.add(image_hash, file_path)
+            self.logger.info(f"✅ Descargado desde enlace: {file_path}")
+            dicom_tags = read_dicom_header(file_data)
+            if dicom_tags is not None:
+                self.record_dicom_files([(file_path, None, len(file_data), dicom_tags)])
+            return file_path
                 
         except Exception as e:
             self.logger.error(f"Error descargando imagen desde enlace {link_info.get('url', 'unknown')}: {e}")
@@ -1245,16 +4955,25 @@ class EmailImageDownloader:
         """
         Versión MEJORADA: Descarga archivos usando detección más agresiva
         """
+        if self.use_section_fetch() and not self.is_message_cached(email_id):
+            try:
+                downloaded_count = self.download_sections_from_email(email_id)
+                if downloaded_count is not None:
+                    return downloaded_count
+            except Exception as e:
+                self.logger.warning(f"⚠️ Descarga por secciones falló para {email_id}, usando RFC822: {e}")
+        
         try:
-            result, msg_data = self.mail.fetch(email_id, '(RFC822)')
+            raw_message = self.fetch_raw_message(email_id)
             
-            if result != 'OK':
+            if raw_message is None:
                 self.update_email_report_status(email_id, "ERROR", 0, "Error obteniendo email para descarga")
                 return 0
             
-            msg = email.message_from_bytes(msg_data[0][1])
-            sender = self.decode_email_header(msg['From'])
-            subject = self.decode_email_header(msg['Subject'])
+            msg = email.message_from_bytes(raw_message)
+            meta = self.get_message_meta(msg, email_id, size=len(raw_message))
+            sender = meta.sender
+            subject = meta.subject
             
             self.logger.info(f"🔍 DESCARGA MEJORADA: De: {sender}, Asunto: {subject}")
             
@@ -1267,11 +4986,23 @@ class EmailImageDownloader:
             self.logger.info(f"✅ PROCESANDO CON DETECCIÓN MEJORADA: De: {sender}, Asunto: {subject}")
             
             email_date = self.get_email_date(msg)
-            downloaded_count = 0
             
             # EXTRACCIÓN AGRESIVA DE ARCHIVOS
             attachments_to_download = []
             allowed_extensions = self.config['download_settings']['allowed_extensions']
+            ext_map = {
+                'image/jpeg': '.jpg',
+                'image/jpg': '.jpg',
+                'image/png': '.png',
+                'image/gif': '.gif',
+                'image/bmp': '.bmp',
+                'image/tiff': '.tiff',
+                'image/webp': '.webp',
+                'application/pdf': '.pdf',
+                'application/dicom': '.dcm',
+                'application/msword': '.doc',
+                'application/vnd.openxmlformats-officedocument.wordprocessingml.document': '.docx'
+            }
             
             for i, part in enumerate(msg.walk()):
                 filename = part.get_filename()
@@ -1280,6 +5011,7 @@ class EmailImageDownloader:
                 
                 should_download = False
                 generated_filename = None
+                strategy = None
                 file_data = None
                 
                 # Obtener datos del archivo
@@ -1296,51 +5028,37 @@ class EmailImageDownloader:
                         decoded_filename = self.decode_email_header(filename)
                         file_ext = Path(decoded_filename).suffix.lower()
                         
-                        if file_ext in allowed_extensions:
+                        if file_ext in allowed_extensions or self.is_expandable_archive(decoded_filename, content_type):
                             should_download = True
                             generated_filename = decoded_filename
+                            strategy = 'filename'
                             self.logger.debug(f"✅ ARCHIVO ENCONTRADO (filename): {decoded_filename}")
                     except Exception as e:
                         self.logger.debug(f"Error con filename: {e}")
                 
                 # ESTRATEGIA 2: Sin filename pero content-type conocido
-                elif content_type and not should_download:
-                    ext_map = {
-                        'image/jpeg': '.jpg',
-                        'image/jpg': '.jpg',
-                        'image/png': '.png',
-                        'image/gif': '.gif',
-                        'image/bmp': '.bmp',
-                        'image/tiff': '.tiff',
-                        'image/webp': '.webp',
-                        'application/pdf': '.pdf',
-                        'application/msword': '.doc',
-                        'application/vnd.openxmlformats-officedocument.wordprocessingml.document': '.docx'
-                    }
-                    
-                    if content_type in ext_map:
-                        file_ext = ext_map[content_type]
-                        if file_ext in allowed_extensions:
-                            should_download = True
-                            generated_filename = f"archivo_parte_{i}{file_ext}"
-                            self.logger.debug(f"✅ ARCHIVO ENCONTRADO (content-type): {content_type} -> {generated_filename}")
+                elif content_type in ext_map:
+                    file_ext = ext_map[content_type]
+                    if file_ext in allowed_extensions:
+                        should_download = True
+                        generated_filename = f"archivo_parte_{i}{file_ext}"
+                        strategy = 'content_type'
+                        self.logger.debug(f"✅ ARCHIVO ENCONTRADO (content-type): {content_type} -> {generated_filename}")
+                
+                # ZIP sin nombre: sus miembros se clasifican al guardar
+                elif self.is_expandable_archive(None, content_type):
+                    should_download = True
+                    generated_filename = f"archivo_parte_{i}.zip"
+                    strategy = 'content_type'
                 
                 # ESTRATEGIA 3: Detección por magic bytes
                 elif not should_download and file_data:
-                    detected_ext = None
-                    
-                    if file_data.startswith(b'\xff\xd8\xff'):  # JPEG
-                        detected_ext = '.jpg'
-                    elif file_data.startswith(b'\x89PNG'):  # PNG
-                        detected_ext = '.png'
-                    elif file_data.startswith(b'%PDF'):  # PDF
-                        detected_ext = '.pdf'
-                    elif file_data.startswith(b'GIF8'):  # GIF
-                        detected_ext = '.gif'
+                    detected_ext = self.detect_extension_from_magic(file_data)
                     
                     if detected_ext and detected_ext in allowed_extensions:
                         should_download = True
                         generated_filename = f"archivo_magic_{i}{detected_ext}"
+                        strategy = 'magic_bytes'
                         self.logger.debug(f"✅ ARCHIVO ENCONTRADO (magic bytes): {detected_ext} -> {generated_filename}")
                 
                 # ESTRATEGIA 4: Si es attachment, intentar descargar
@@ -1356,6 +5074,7 @@ class EmailImageDownloader:
                     if detected_ext in allowed_extensions:
                         should_download = True
                         generated_filename = f"attachment_{i}{detected_ext}"
+                        strategy = 'attachment'
                         self.logger.debug(f"✅ ARCHIVO ENCONTRADO (attachment): {generated_filename}")
                 
                 # Agregar a la lista de descarga
@@ -1364,48 +5083,13 @@ class EmailImageDownloader:
                         'filename': generated_filename,
                         'data': file_data,
                         'content_type': content_type,
+                        'strategy': strategy,
                         'source': f'estrategia_mejorada_parte_{i}'
                     })
                     self.logger.info(f"📎 AGREGADO PARA DESCARGA: {generated_filename} ({len(file_data)} bytes)")
             
             # Descargar archivos encontrados
-            if attachments_to_download:
-                target_folder, email_date = self.create_folder_structure(msg, sender)
-                download_path = str(target_folder)
-                
-                self.logger.info(f"📁 Descargando {len(attachments_to_download)} archivos en: {target_folder}")
-                
-                for idx, attachment in enumerate(attachments_to_download):
-                    try:
-                        if self.config['download_settings']['rename_files']:
-                            new_filename = self.generate_filename(
-                                msg, sender, subject, idx, attachment['filename'], email_date
-                            )
-                        else:
-                            new_filename = attachment['filename']
-                        
-                        file_path = target_folder / new_filename
-                        
-                        # Resolver conflictos de nombres
-                        counter = 1
-                        original_path = file_path
-                        while file_path.exists():
-                            stem = original_path.stem
-                            suffix = original_path.suffix
-                            file_path = original_path.parent / f"{stem}_{counter}{suffix}"
-                            counter += 1
-                        
-                        file_path.write_bytes(attachment['data'])
-                        downloaded_count += 1
-                        self.logger.info(f"✅ DESCARGADO: {file_path}")
-                        
-                    except Exception as e:
-                        self.logger.error(f"❌ Error descargando {attachment['filename']}: {e}")
-                
-                self.update_email_report_status(email_id, "DESCARGADO", downloaded_count, download_path)
-            else:
-                self.logger.warning(f"⚠️ No se pudieron extraer archivos de: {sender} - {subject}")
-                self.update_email_report_status(email_id, "SIN_ARCHIVOS", 0, "N/A")
+            downloaded_count = self.save_attachments(email_id, msg, sender, subject, attachments_to_download)
             
             return downloaded_count
             
@@ -1414,6 +5098,480 @@ class EmailImageDownloader:
             self.update_email_report_status(email_id, "ERROR", 0, f"Error: {str(e)}")
             return 0
     
+    def get_attachment_writer(self):
+        """Etapa de escritura compartida (se crea al primer uso)"""
+        if self.attachment_writer is None:
+            settings = self.config['download_settings']
+            self.attachment_writer = AttachmentWriter(
+                workers=int(settings.get('writer_workers', 4)),
+                max_pending_mb=float(settings.get('writer_max_pending_mb', 256))
+            )
+        return self.attachment_writer
+    
+    def get_storage_compression(self, filename):
+        """
+        (códec, nivel) con que se guarda un archivo según download_settings.storage_compression, o None
+        para guardarlo tal cual (siempre para JPEG, PNG, PDF y demás formatos ya comprimidos)
+        """
+        settings = self.config['download_settings'].get('storage_compression', {})
+        if not settings.get('enabled', False):
+            return None
+        
+        extension = Path(filename).suffix.lower()
+        selected = {ext.lower() for ext in settings.get('extensions', ['.dcm', '.bmp'])}
+        if extension not in selected or extension not in STORAGE_COMPRESSIBLE_EXTENSIONS:
+            return None
+        
+        codec = settings.get('codec', 'zstd')
+        if codec == 'zstd' and zstd is None:
+            codec = 'gzip'
+        if codec not in STORAGE_CODEC_SUFFIXES:
+            return None
+        return codec, int(settings.get('level') or STORAGE_DEFAULT_LEVELS[codec])
+    
+    def save_link_file(self, target_folder, filename, file_data):
+        """Guarda el archivo de un enlace (comprimido si corresponde); devuelve la ruta final"""
+        compression = self.get_storage_compression(filename)
+        if compression:
+            filename += STORAGE_CODEC_SUFFIXES[compression[0]]
+        return self.get_attachment_writer().write(target_folder, filename, file_data, compression)
+    
+    def get_dicom_index(self):
+        """Índice local de archivos DICOM (download_settings.dicom_index); se abre al primer uso"""
+        index_config = self.config['download_settings'].get('dicom_index', {})
+        if not index_config.get('enabled', False) or self.dicom_index is not None:
+            return self.dicom_index
+        
+        try:
+            self.dicom_index = DicomIndex(self.get_state_path(index_config.get('path'), '.cache/dicom_index.sqlite3'))
+        except Exception as e:
+            self.logger.warning(f"⚠️ No se pudo abrir el índice DICOM: {e}")
+        
+        return self.dicom_index
+    
+    def get_perceptual_config(self):
+        return self.config['download_settings'].get('perceptual_dedup', {})
+    
+    def get_perceptual_index(self):
+        """Índice de casi duplicados (download_settings.perceptual_dedup); requiere Pillow y NumPy"""
+        dedup_config = self.get_perceptual_config()
+        if not dedup_config.get('enabled', False) or self.perceptual_index is not None or self.perceptual_index_failed:
+            return self.perceptual_index
+        
+        try:
+            if np is None or Image is None:
+                raise RuntimeError("requiere Pillow y NumPy instalados")
+            self.perceptual_index = PerceptualHashIndex(
+                dedup_config.get('index_path', '.cache/phash_index.npz'),
+                max_distance=int(dedup_config.get('max_distance', 6)),
+                workers=int(dedup_config.get('workers', 4))
+            )
+        except Exception as e:
+            self.perceptual_index_failed = True
+            self.logger.warning(f"⚠️ Detección de casi duplicados desactivada: {e}")
+        
+        return self.perceptual_index
+    
+    def hash_images(self, items):
+        """dHash (en el pool) de los (nombre, datos) que son imágenes; devuelve {posición: hash}"""
+        index = self.get_perceptual_index()
+        if index is None:
+            return {}
+        
+        positions = [position for position, (name, _) in enumerate(items)
+                     if Path(name).suffix.lower() in IMAGE_EXTENSIONS]
+        hashes = index.hash_many([items[position][1] for position in positions])
+        return {position: image_hash for position, image_hash in zip(positions, hashes) if image_hash is not None}
+    
+    def find_near_duplicate(self, image_hash):
+        """(ruta, distancia) de una imagen casi igual ya guardada bajo la carpeta base, o None"""
+        if image_hash is None or self.perceptual_index is None:
+            return None
+        scope = str(Path(self.config['download_settings']['base_folder'])) + os.sep
+        return self.perceptual_index.find(image_hash, scope)
+    
+    def skip_near_duplicate(self, filename, near_duplicate):
+        """Registra un casi duplicado; True si la configuración indica omitirlo (si no, sólo se marca)"""
+        if near_duplicate is None:
+            return False
+        
+        duplicate_path, distance = near_duplicate
+        if self.get_perceptual_config().get('action', 'skip') == 'skip':
+            self.logger.info(f"⏭️ Casi duplicado omitido: {filename} (≈ {duplicate_path}, distancia {distance})")
+            return True
+        
+        self.logger.info(f"🔁 Casi duplicado marcado: {filename} (≈ {duplicate_path}, distancia {distance})")
+        return False
+    
+    def get_thumbnail_cache(self):
+        """Etapa de miniaturas (download_settings.thumbnails); requiere Pillow"""
+        thumbnail_config = self.config['download_settings'].get('thumbnails', {})
+        if not thumbnail_config.get('enabled', False) or self.thumbnail_cache is not None or not ThumbnailCache.available():
+            return self.thumbnail_cache
+        
+        try:
+            self.thumbnail_cache = ThumbnailCache(
+                thumbnail_config.get('cache_dir', '.cache/miniaturas'),
+                size=thumbnail_config.get('size', 256),
+                image_format=thumbnail_config.get('format', 'WEBP'),
+                workers=int(thumbnail_config.get('workers', 2))
+            )
+        except Exception as e:
+            self.logger.warning(f"⚠️ No se pudo iniciar la generación de miniaturas: {e}")
+        
+        return self.thumbnail_cache
+    
+    def get_archive_config(self):
+        return self.config['download_settings'].get('archive_expansion', {})
+    
+    def is_expandable_archive(self, filename, content_type):
+        """Un adjunto ZIP cuyos miembros se clasifican por separado (download_settings.archive_expansion)"""
+        if not self.get_archive_config().get('enabled', False):
+            return False
+        if filename:
+            return Path(filename).suffix.lower() == '.zip'
+        return content_type in ARCHIVE_CONTENT_TYPES
+    
+    def get_archive_expander(self):
+        """Expansor de ZIP compartido (se crea al primer uso)"""
+        archive_config = self.get_archive_config()
+        if archive_config.get('enabled', False) and self.archive_expander is None:
+            self.archive_expander = ArchiveExpander(
+                self.detect_extension_from_magic,
+                max_members=int(archive_config.get('max_members', 2000)),
+                max_member_mb=float(archive_config.get('max_member_mb', 512)),
+                max_total_mb=float(archive_config.get('max_total_mb', 2048)),
+                max_ratio=float(archive_config.get('max_ratio', 200)),
+                workers=int(archive_config.get('workers', 4))
+            )
+        return self.archive_expander
+    
+    def expand_archive_attachments(self, attachments, reserve=None, release=None, empty_archives=None):
+        """
+        Genera los adjuntos reemplazando cada ZIP por sus miembros permitidos, de a uno (el ZIP se conserva
+        sólo si '.zip' está permitido). Los miembros llevan 'reservado': bytes a liberar con release() al
+        terminar su escritura. Los ZIP sin miembros permitidos se agregan a empty_archives.
+        """
+        allowed_extensions = self.config['download_settings']['allowed_extensions']
+        
+        for attachment in attachments:
+            if not self.is_expandable_archive(attachment['filename'], attachment['content_type']):
+                yield attachment
+                continue
+            
+            if '.zip' in allowed_extensions:
+                yield attachment
+            
+            warnings = []
+            member_count = 0
+            for member_name, member_data, strategy, reserved in self.get_archive_expander().iter_members(
+                    attachment['data'], allowed_extensions, warnings, reserve, release):
+                member_count += 1
+                yield {
+                    'filename': member_name,
+                    'data': member_data,
+                    'content_type': mimetypes.guess_type(member_name)[0] or 'application/octet-stream',
+                    'strategy': strategy,
+                    'source': f"{attachment['source']}:{attachment['filename']}",
+                    'reservado': reserved
+                }
+            
+            for warning in warnings:
+                self.logger.warning(f"⚠️ {attachment['filename']}: {warning}")
+            if member_count:
+                self.logger.info(f"📦 {attachment['filename']}: {member_count} archivos permitidos dentro del ZIP")
+            else:
+                self.logger.warning(f"⚠️ {attachment['filename']}: ZIP sin archivos permitidos")
+                if empty_archives is not None:
+                    empty_archives.append(attachment['filename'])
+    
+    def record_dicom_files(self, entries):
+        """Agrega al índice DICOM las entradas (ruta, email_id, tamaño, tags) de archivos ya escritos"""
+        if not entries or self.get_dicom_index() is None:
+            return
+        
+        try:
+            self.dicom_index.record(entries)
+        except Exception as e:
+            self.logger.warning(f"⚠️ No se pudo actualizar el índice DICOM: {e}")
+    
+    def finalize_pending_saves(self, wait=False):
+        """
+        Marca en el reporte los emails cuyas escrituras ya terminaron (todas si wait=True); devuelve
+        cuántos archivos de esos emails se escribieron con éxito
+        """
+        still_pending = []
+        saved_count = 0
+        
+        for email_id, download_path, writes in self.pending_saves:
+            if not wait and not all(future.done() for future, _ in writes):
+                still_pending.append((email_id, download_path, writes))
+                continue
+            
+            saved_attachments = []
+            dicom_entries = []
+            for future, record in writes:
+                dicom_tags = record.pop('dicom', None)
+                try:
+                    file_path = future.result()
+                except Exception as e:
+                    self.logger.error(f"❌ Error escribiendo {record['nombre_original']}: {e}")
+                    continue
+                record['ruta_archivo'] = str(file_path)
+                # Manifiesto: tamaño y MD5 son los del original; el tamaño en disco, el del archivo guardado
+                record['tamano_en_disco'] = file_path.stat().st_size if record.get('compresion') else record['tamano_bytes']
+                saved_attachments.append(record)
+                self.logger.info(f"✅ DESCARGADO: {file_path}")
+                if dicom_tags is not None:
+                    dicom_entries.append((file_path, record['email_id'], record['tamano_bytes'], dicom_tags))
+                if self.get_thumbnail_cache() is not None:
+                    self.thumbnail_cache.submit(file_path, record['md5'])
+            
+            self.record_dicom_files(dicom_entries)
+            self.update_email_report_status(email_id, "DESCARGADO", len(saved_attachments), download_path, saved_attachments)
+            saved_count += len(saved_attachments)
+        
+        self.pending_saves = still_pending
+        return saved_count
+    
+    def save_attachments(self, email_id, msg, sender, subject, attachments_to_download):
+        """
+        Encola los archivos extraídos de un email en la etapa de escritura; el reporte se actualiza al terminar.
+        Devuelve los archivos escritos con éxito de los emails que terminaron en este llamado (los que siguen
+        en curso se cuentan cuando finalize_pending_saves los completa)
+        """
+        saved_count = 0
+        writes = []
+        empty_archives = []
+        target_folder = None
+        writer = self.get_attachment_writer()
+        
+        # Los miembros de un ZIP se leen de a uno: cada uno se reserva en el límite de bytes en vuelo
+        # (además de los bytes del mensaje que ya tiene reservados este hilo) hasta que termina su escritura
+        reserve = release = None
+        if self.inflight_budget is not None:
+            held = self.message_sizes.get(email_id, 0)
+            reserve = lambda size, pending: self.inflight_budget.acquire(size, held=held + pending)
+            release = self.inflight_budget.release
+        
+        direct_hashes = self.hash_images([(attachment['filename'], attachment['data']) for attachment in attachments_to_download])
+        image_hashes = {id(attachments_to_download[position]): image_hash for position, image_hash in direct_hashes.items()}
+        
+        for idx, attachment in enumerate(self.expand_archive_attachments(attachments_to_download, reserve, release, empty_archives)):
+            reserved = attachment.pop('reservado', 0)
+            submitted = False
+            try:
+                if target_folder is None:
+                    target_folder, email_date = self.create_folder_structure(msg, sender)
+                    self.logger.info(f"📁 Descargando archivos en: {target_folder}")
+                
+                if id(attachment) in image_hashes:
+                    image_hash = image_hashes[id(attachment)]
+                else:
+                    image_hash = self.hash_images([(attachment['filename'], attachment['data'])]).get(0)
+                near_duplicate = self.find_near_duplicate(image_hash)
+                if self.skip_near_duplicate(attachment['filename'], near_duplicate):
+                    continue
+                
+                if self.config['download_settings']['rename_files']:
+                    new_filename = self.generate_filename(
+                        msg, sender, subject, idx, attachment['filename'], email_date
+                    )
+                else:
+                    new_filename = attachment['filename']
+                
+                compression = self.get_storage_compression(new_filename)
+                if compression:
+                    new_filename += STORAGE_CODEC_SUFFIXES[compression[0]]
+                
+                file_path = writer.reserve_path(target_folder, new_filename)
+                if image_hash is not None and near_duplicate is None:
+                    self.perceptual_index.add(image_hash, file_path)
+                future = writer.submit(file_path, attachment['data'], compression)
+                submitted = True
+                if reserved and release is not None:
+                    future.add_done_callback(lambda _, size=reserved: release(size))
+                writes.append((future, {
+                    'email_id': int(email_id),
+                    'indice': idx,
+                    'nombre_original': attachment['filename'],
+                    'ruta_archivo': str(file_path),
+                    'content_type': attachment['content_type'],
+                    'estrategia': attachment['strategy'],
+                    'tamano_bytes': len(attachment['data']),
+                    'md5': hashlib.md5(attachment['data']).hexdigest(),
+                    'casi_duplicado_de': near_duplicate[0] if near_duplicate else '',
+                    'compresion': compression[0] if compression else '',
+                    # Sólo se leen el preámbulo y el file meta header, no los datos de imagen
+                    'dicom': read_dicom_header(attachment['data'])
+                }))
+                
+            except Exception as e:
+                self.logger.error(f"❌ Error descargando {attachment['filename']}: {e}")
+            finally:
+                if reserved and release is not None and not submitted:
+                    release(reserved)
+        
+        if target_folder is not None:
+            self.pending_saves.append((email_id, str(target_folder), writes))
+            saved_count = self.finalize_pending_saves()
+        elif empty_archives:
+            self.logger.warning(f"⚠️ ZIP sin archivos permitidos en: {sender} - {subject}")
+            self.update_email_report_status(email_id, "SIN_ARCHIVOS", 0, "N/A",
+                                            motivo_rechazo=f"ZIP sin archivos permitidos ({', '.join(empty_archives)})")
+        else:
+            self.logger.warning(f"⚠️ No se pudieron extraer archivos de: {sender} - {subject}")
+            self.update_email_report_status(email_id, "SIN_ARCHIVOS", 0, "N/A")
+        
+        return saved_count
+    
+    def fetch_structures_batch(self, email_ids):
+        """BODYSTRUCTURE, RFC822.SIZE y headers básicos de varios emails en un solo FETCH: {uid: (msg, partes, tamaño)}"""
+        message_set = ','.join(uid.decode() if isinstance(uid, bytes) else str(uid) for uid in email_ids)
+        result, data = self.imap_fetch(message_set, '(RFC822.SIZE BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE)])')
+        if result != 'OK':
+            return {}
+        
+        structures = {}
+        for value in self.parse_imap_response(data):
+            if not isinstance(value, list):
+                continue
+            
+            items = self.fetch_items_to_dict(value)
+            header = next((item for key, item in items.items() if key.startswith('BODY[HEADER')), None)
+            if items.get('UID') is None or header is None or 'BODYSTRUCTURE' not in items:
+                continue
+            
+            structures[items['UID']] = (
+                email.message_from_bytes(header),
+                self.flatten_bodystructure(items['BODYSTRUCTURE']),
+                int(items.get('RFC822.SIZE') or 0)
+            )
+        
+        return structures
+    
+    def estimate_decoded_size(self, part):
+        """Tamaño aproximado del archivo a partir del tamaño codificado que informa BODYSTRUCTURE"""
+        if part['encoding'] == 'base64':
+            # 57 bytes de datos por cada línea de 76 caracteres + CRLF
+            return part['size'] * 57 // 78
+        return part['size']
+    
+    def estimate_email(self, email_id, structure):
+        """Agrega al reporte la proyección de un email (archivos y bytes) sin descargar su cuerpo"""
+        if structure is None:
+            self.add_email_to_report(email_id, None, "ERROR", 0, "BODYSTRUCTURE no disponible", "N/A")
+            return False
+        
+        msg, parts, message_size = structure
+        summary = self.summarize_structure_parts(parts)
+        meta = self.get_message_meta(msg, email_id, size=message_size, attachment_summary=summary)
+        sender = meta.sender
+        subject = meta.subject
+        
+        passes_filters, rejection_reasons = self.check_email_matches_filters(msg, sender, subject, check_attachments=False)
+        if not passes_filters:
+            self.add_email_to_report(email_id, msg, "DESCARTADO", 0, "; ".join(rejection_reasons), "N/A", summary)
+            return False
+        
+        projected = [part for part in self.plan_section_downloads(parts)
+                     if part['strategy'] != 'magic_bytes' or self.resolve_magic_part(email_id, part)]
+        
+        if not projected:
+            self.add_email_to_report(email_id, msg, "SIN_ARCHIVOS", 0,
+                                     "Sin adjuntos de tipos permitidos en BODYSTRUCTURE (podría tener enlaces o imágenes en el HTML)",
+                                     "N/A", summary)
+            return False
+        
+        target_folder, email_date = self.get_target_folder(msg, sender)
+        self.add_email_to_report(email_id, msg, "ESTIMADO", len(projected), "", str(target_folder), summary)
+        
+        for idx, part in enumerate(projected):
+            if self.config['download_settings']['rename_files']:
+                filename = self.generate_filename(msg, sender, subject, idx, part['filename'], email_date)
+            else:
+                filename = part['filename']
+            
+            self.report.add_attachment({
+                'email_id': int(email_id),
+                'indice': idx,
+                'nombre_original': part['filename'],
+                'ruta_archivo': str(target_folder / filename),
+                'content_type': part['content_type'],
+                'estrategia': part['strategy'],
+                'tamano_bytes': self.estimate_decoded_size(part),
+                'md5': ''
+            })
+        
+        return True
+    
+    def run_estimate(self, batch_size=200):
+        """
+        Modo estimación: misma búsqueda y mismos filtros que run_complete_analysis, pero sólo con
+        BODYSTRUCTURE y RFC822.SIZE (por lotes). Genera el reporte con estado ESTIMADO y los archivos
+        y bytes que se descargarían, sin traer ningún cuerpo de mensaje.
+        """
+        self.logger.info("=== ESTIMACIÓN (SIN DESCARGAS) ===")
+        
+        if self.get_source_config().get('type', 'imap') != 'imap':
+            self.logger.warning("⚠️ La estimación sólo está disponible para cuentas IMAP")
+            return None
+        
+        if not self.connect_to_email():
+            return None
+        
+        try:
+            self.open_report_store(prefix='reporte_estimacion_emails')
+            email_ids = self.search_emails_by_date_range()
+            
+            if not email_ids:
+                self.logger.warning("⚠️ No se encontraron emails en el rango de fechas especificado")
+                return None
+            
+            valid_count = 0
+            mailbox_bytes = 0
+            
+            for start in range(0, len(email_ids), batch_size):
+                batch = email_ids[start:start + batch_size]
+                try:
+                    structures = self.fetch_structures_batch(batch)
+                except Exception as e:
+                    self.logger.error(f"❌ Error obteniendo BODYSTRUCTURE de un lote: {e}")
+                    structures = {}
+                
+                for email_id in batch:
+                    structure = structures.get(email_id)
+                    if self.estimate_email(email_id, structure):
+                        valid_count += 1
+                        mailbox_bytes += structure[2]
+                
+                self.logger.info(f"🔎 Estimación: {min(start + batch_size, len(email_ids))}/{len(email_ids)} emails")
+            
+            report_filename = self.generate_report_csv()
+            
+            self.logger.info("📈 ESTIMACIÓN:")
+            self.logger.info(f"  • Emails en rango: {len(email_ids)}")
+            self.logger.info(f"  • Emails que cumplen criterios: {valid_count}")
+            self.logger.info(f"  • Archivos a descargar: {self.report.total_files}")
+            self.logger.info(f"  • Tamaño estimado en disco: {self.report.total_bytes / 1048576:.1f} MB")
+            self.logger.info(f"  • Tamaño de los emails en el servidor: {mailbox_bytes / 1048576:.1f} MB")
+            
+            return {
+                'estimate': True,
+                'total_emails': len(email_ids),
+                'valid_emails': valid_count,
+                'total_files': self.report.total_files,
+                'total_bytes': self.report.total_bytes,
+                'mailbox_bytes': mailbox_bytes,
+                'rate': self.get_rate_stats(),
+                'report_file': report_filename,
+                'attachments_file': str(self.report.attachments_path) if self.report.attachments_path else None
+            }
+        
+        finally:
+            self.report.close()
+            self.disconnect()
+    
     def run(self):
         """Método principal para compatibilidad con la interfaz - llama a run_complete_analysis"""
         return self.run_complete_analysis()
@@ -1434,65 +5592,110 @@ class EmailImageDownloader:
             self.logger.info(f"  • Hasta: {end_date.strftime('%d/%m/%Y %H:%M:%S')} ")
             self.logger.info(f"  • Duración: {duration} días")
         
-        # Conectar al email
-        if not self.connect_to_email():
+        # Conectar al email (salvo que la fuente sea un mbox/Maildir/.eml local)
+        if self.get_source_config().get('type', 'imap') != 'imap':
+            try:
+                self.open_message_source()
+            except Exception as e:
+                self.logger.error(f"❌ No se pudo abrir la fuente offline: {e}")
+                return None
+        elif not self.connect_to_email():
             return None
         
         try:
-            # PASO 1: Buscar emails en el rango de fechas
-            self.logger.info("🔍 PASO 1: Buscando TODOS los emails en el rango configurado...")
-            email_ids = self.search_emails_by_date_range()
-            
-            if not email_ids:
-                self.logger.warning("⚠️ No se encontraron emails en el rango de fechas especificado")
-                return None
-            
-            self.logger.info(f"📊 Se analizarán {len(email_ids)} emails en total")
-            
-            # PASO 2: Analizar cada email contra los filtros
-            self.logger.info("📋 PASO 2: Analizando cada email contra los filtros configurados...")
+            self.open_run_journal()
+            if not self.config.get('profiles'):
+                self.open_report_store()
+            if self.message_source is None:
+                self.open_message_cache()
+            self.open_profiles()
+            self.track_processed_messages()
+            # Con perfiles la pasada es única y secuencial: cada mensaje se evalúa para todos antes del siguiente
+            shard_mode = None if self.message_source or self.profile_downloaders else self.get_shard_mode()
             
-            valid_emails = []
-            
-            for email_id in email_ids:
-                if self.analyze_email_for_report(email_id):
-                    valid_emails.append(email_id)
+            if self.message_source:
+                # PASOS 1-3 sobre el archivo local: mismo filtrado, extracción y reporte
+                totals = self.run_offline_analysis()
+                total_emails = totals['total_emails']
+                valid_count = totals['valid_emails']
+                
+                if not total_emails:
+                    self.logger.warning("⚠️ La fuente offline no contiene emails en el rango especificado")
+                    return None
+            elif shard_mode:
+                # PASOS 1-3 por ventanas de fechas (historial grande, reanudable)
+                self.logger.info(f"🔍 PASOS 1-3: Análisis fragmentado por {'mes' if shard_mode == 'month' else 'semana'}...")
+                totals = self.run_sharded_analysis()
+                total_emails = totals['total_emails']
+                valid_count = totals['valid_emails']
+                
+                if not total_emails:
+                    self.logger.warning("⚠️ No se encontraron emails en el rango de fechas especificado")
+                    return None
+            else:
+                # PASO 1: Buscar emails en el rango de fechas
+                self.logger.info("🔍 PASO 1: Buscando TODOS los emails en el rango configurado...")
+                email_ids = self.search_emails_by_date_range()
+                
+                if not email_ids:
+                    self.logger.warning("⚠️ No se encontraron emails en el rango de fechas especificado")
+                    return None
+                
+                self.logger.info(f"📊 Se analizarán {len(email_ids)} emails en total")
+                
+                # PASOS 2 y 3: Analizar cada email contra los filtros y descargar los válidos
+                self.logger.info("📋 PASO 2: Analizando cada email contra los filtros configurados...")
+                valid_emails, total_files_downloaded = self.process_email_ids_by_size(email_ids)
+                total_emails = len(email_ids)
+                valid_count = len(valid_emails)
+                
+                self.logger.info("✅ PASOS 2 y 3 COMPLETADOS:")
+                self.logger.info(f"  • Total emails analizados: {total_emails}")
+                self.logger.info(f"  • Emails que cumplen criterios: {valid_count}")
+                self.logger.info(f"  • Emails descartados: {total_emails - valid_count}")
+                self.logger.info(f"  • Total archivos descargados: {total_files_downloaded}")
             
-            self.logger.info("✅ PASO 2 COMPLETADO:")
-            self.logger.info(f"  • Total emails analizados: {len(email_ids)}")
-            self.logger.info(f"  • Emails que cumplen criterios: {len(valid_emails)}")
-            self.logger.info(f"  • Emails descartados: {len(email_ids) - len(valid_emails)}")
+            marked = self.mark_processed_messages()
+            transfer = self.get_transfer_stats()
+            rate_stats = self.get_rate_stats()
             
-            # PASO 3: Descargar archivos de emails válidos
-            if valid_emails:
-                self.logger.info(f"📥 PASO 3: Descargando archivos de {len(valid_emails)} emails válidos...")
+            if self.profile_downloaders:
+                # PASO 4 con perfiles: un reporte por perfil
+                self.logger.info("📊 PASO 4: Generando reportes por perfil...")
+                profile_results = self.close_profiles(completed=True)
                 
-                total_files_downloaded = 0
+                for profile_result in profile_results:
+                    self.logger.info(f"  • Perfil '{profile_result['name']}': {profile_result['valid_emails']} emails, "
+                                     f"{profile_result['total_files']} archivos → {profile_result['report_file']}")
                 
-                for email_id in valid_emails:
-                    try:
-                        files_downloaded = self.download_images_from_email(email_id)
-                        total_files_downloaded += files_downloaded
-                    except Exception as e:
-                        self.logger.error(f"Error descargando email {email_id}: {e}")
+                if self.journal:
+                    self.journal.mark_completed()
                 
-                self.logger.info("✅ PASO 3 COMPLETADO:")
-                self.logger.info(f"  • Total archivos descargados: {total_files_downloaded}")
-            else:
-                self.logger.info("⚠️ No hay emails que cumplan los criterios para descarga")
+                return {
+                    'total_emails': total_emails,
+                    'valid_emails': valid_count,
+                    'total_files': sum(result['total_files'] for result in profile_results),
+                    'total_bytes': sum(result['total_bytes'] for result in profile_results),
+                    'transfer': transfer,
+                    'rate': rate_stats,
+                    'marked': marked,
+                    'report_file': None,
+                    'attachments_file': None,
+                    'profiles': profile_results
+                }
             
             # PASO 4: Generar reporte
             self.logger.info("📊 PASO 4: Generando reporte detallado...")
             report_filename = self.generate_report_csv()
             
             # Estadísticas finales
-            descargados = len([email for email in self.report_data if email['estado'] == 'DESCARGADO'])
-            sin_archivos = len([email for email in self.report_data if email['estado'] == 'SIN_ARCHIVOS'])
-            descartados = len([email for email in self.report_data if email['estado'] == 'DESCARTADO'])
-            errores = len([email for email in self.report_data if email['estado'] == 'ERROR'])
-            total_archivos = sum([email['archivos_descargados'] for email in self.report_data])
+            descargados = self.report.count('DESCARGADO')
+            sin_archivos = self.report.count('SIN_ARCHIVOS')
+            descartados = self.report.count('DESCARTADO')
+            errores = self.report.count('ERROR')
+            total_archivos = self.report.total_files
             
-            self.logger.info(f"  • Total emails analizados: {len(self.report_data)}")
+            self.logger.info(f"  • Total emails analizados: {self.report.total_rows}")
             self.logger.info(f"  • Emails con archivos descargados: {descargados}")
             self.logger.info(f"  • Emails descartados: {descartados}")
             self.logger.info(f"  • Emails con error: {errores}")
@@ -1500,35 +5703,236 @@ class EmailImageDownloader:
             
             self.logger.info("=== PROCESO COMPLETADO ===")
             self.logger.info("📈 RESUMEN FINAL:")
-            self.logger.info(f"  • Total emails en rango de fechas: {len(email_ids)}")
-            self.logger.info(f"  • Emails que cumplen criterios: {len(valid_emails)}")
-            self.logger.info(f"  • Emails descartados: {len(email_ids) - len(valid_emails)}")
-            self.logger.info(f"  • Reporte CSV generado: {report_filename}")
+            self.logger.info(f"  • Total emails en rango de fechas: {total_emails}")
+            self.logger.info(f"  • Emails que cumplen criterios: {valid_count}")
+            self.logger.info(f"  • Emails descartados: {total_emails - valid_count}")
+            self.logger.info(f"  • Reporte generado: {report_filename}")
             
             if filters['date_range']['enabled']:
                 start_date_str = filters['date_range']['start_date'].strftime('%d/%m/%Y')
                 end_date_str = filters['date_range']['end_date'].strftime('%d/%m/%Y')
                 self.logger.info(f"  • Rango procesado: {start_date_str} - {end_date_str}")
             
+            if transfer['decoded_bytes_in']:
+                self.logger.info(f"  • Transferencia IMAP: {transfer['wire_bytes_in'] / 1048576:.1f} MB en la red / "
+                                 f"{transfer['decoded_bytes_in'] / 1048576:.1f} MB decodificados "
+                                 f"({'con' if transfer['compression'] else 'sin'} compresión)")
+            
+            if rate_stats['imap']['commands']:
+                self.logger.info(f"  • Ritmo IMAP logrado: {rate_stats['imap']['achieved_rate']:.1f} comandos/s "
+                                 f"({rate_stats['imap']['throttles']} limitaciones del servidor)")
+            if rate_stats['http']['commands']:
+                self.logger.info(f"  • Ritmo HTTP logrado: {rate_stats['http']['achieved_rate']:.1f} descargas/s "
+                                 f"({rate_stats['http']['throttles']} limitaciones)")
+            
+            if self.message_cache is not None:
+                hits = self.message_cache.hits + sum(h for h, _ in self.cache_stats_from_workers)
+                misses = self.message_cache.misses + sum(m for _, m in self.cache_stats_from_workers)
+                self.logger.info(f"  • Caché de mensajes: {hits} aciertos / {misses} descargas del servidor")
+            
             self.logger.info("=" * 50)
             
+            if shard_mode:
+                self.clear_shard_checkpoints()
+            if self.journal:
+                self.journal.mark_completed()
+            
             return {
-                'total_emails': len(email_ids),
-                'valid_emails': len(valid_emails),
+                'total_emails': total_emails,
+                'valid_emails': valid_count,
                 'total_files': total_archivos,
-                'report_file': report_filename
+                'total_bytes': self.report.total_bytes,
+                'transfer': transfer,
+                'rate': rate_stats,
+                'marked': marked,
+                'report_file': report_filename,
+                'attachments_file': str(self.report.attachments_path) if self.report.attachments_path else None
             }
             
         finally:
-            if self.mail:
-                self.mail.close()
-                self.mail.logout()
+            if self.profile_downloaders:
+                self.close_profiles()
+            if self.attachment_writer is not None:
+                self.finalize_pending_saves(wait=True)
+                self.attachment_writer.close()
+                self.attachment_writer = None
+            if self.dicom_index is not None:
+                self.dicom_index.close()
+                self.dicom_index = None
+            if self.perceptual_index is not None:
+                self.perceptual_index.close()
+                self.perceptual_index = None
+            if self.thumbnail_cache is not None:
+                self.thumbnail_cache.close()
+                self.thumbnail_cache = None
+            if self.archive_expander is not None:
+                self.archive_expander.close()
+                self.archive_expander = None
+            if self.http_cache is not None:
+                self.http_cache.close()
+                self.http_cache = None
+            if self.journal:
+                self.journal.close()
+            self.report.close()
+            if self.message_source is not None:
+                self.message_source.close()
+            if self.message_cache is not None:
+                self.message_cache.close()
+                self.message_cache = None
+            self.disconnect()
+    
+    def get_mark_config(self):
+        """
+        Marcado en el servidor de los emails procesados (processing.mark_processed). El antiguo
+        processing.mark_as_read=True equivale a marcarlos como leídos
+        """
+        processing = self.config.get('processing', {})
+        settings = dict(processing.get('mark_processed') or {})
+        settings.setdefault('enabled', bool(processing.get('mark_as_read', False)))
+        settings.setdefault('mode', 'seen')
+        settings.setdefault('statuses', ['DESCARGADO'])
+        return settings
+    
+    def get_mark_keyword(self, settings):
+        """Palabra clave IMAP válida (un atom: sin espacios, paréntesis, comillas ni barras)"""
+        return re.sub(r'[^A-Za-z0-9_.$&+-]', '_', settings.get('keyword') or 'Archivado')
+    
+    def get_mark_store_args(self, settings):
+        """Item y valor de UID STORE según el modo: \\Seen, palabra clave propia o etiqueta de Gmail"""
+        mode = settings.get('mode', 'seen')
+        if mode == 'keyword':
+            return '+FLAGS.SILENT', f'({self.get_mark_keyword(settings)})'
+        if mode == 'gmail_label':
+            label = (settings.get('label') or 'Archivado').replace('\\', '\\\\').replace('"', '\\"')
+            return '+X-GM-LABELS', f'("{label}")'
+        return '+FLAGS.SILENT', '(\\Seen)'
+    
+    def get_marked_search_exclusion(self):
+        """Criterio que deja fuera de la búsqueda el correo ya marcado en ejecuciones anteriores (o None)"""
+        settings = self.get_mark_config()
+        if not settings.get('exclude_marked'):
+            return None
+        
+        mode = settings.get('mode', 'seen')
+        if mode == 'keyword':
+            return f'UNKEYWORD {self.get_mark_keyword(settings)}'
+        if mode == 'gmail_label':
+            # En la sintaxis de búsqueda de Gmail los espacios del nombre de la etiqueta se escriben como guiones
+            label = re.sub(r'[\s"\\]+', '-', settings.get('label') or 'Archivado').strip('-')
+            return f'X-GM-RAW "-label:{label}"'
+        return 'UNSEEN'
+    
+    def track_processed_messages(self):
+        """Con el marcado activo, los reportes (también los de cada perfil) recuerdan los UID a marcar"""
+        settings = self.get_mark_config()
+        if not settings['enabled'] or self.message_source is not None:
+            return
+        
+        for report in [self.report] + [child.report for child in self.profile_downloaders]:
+            report.track_statuses(settings['statuses'])
+    
+    def mark_processed_messages(self):
+        """
+        Marca los emails procesados al final de la ejecución con unos pocos UID STORE sobre conjuntos
+        de UIDs comprimidos, en lugar de un comando por mensaje. Sólo aquí se tocan las marcas: el análisis
+        trae los mensajes con BODY.PEEK[], que no marca \\Seen. Devuelve {uids, commands, failed} o None
+        """
+        settings = self.get_mark_config()
+        if not settings['enabled'] or self.message_source is not None:
+            return None
+        
+        uids = set(self.report.tracked_uids)
+        for child in self.profile_downloaders:
+            uids |= child.report.tracked_uids
+        if not uids:
+            return None
+        
+        item, value = self.get_mark_store_args(settings)
+        uid_sets = compress_uid_set(uids)
+        failed = 0
+        stored = 0
+        
+        for uid_set in uid_sets:
+            try:
+                typ, data = self.run_imap_command('STORE', uid_set, item, value)
+            except Exception as e:
+                typ, data = 'NO', [str(e).encode()]
+            if typ != 'OK':
+                failed += 1
+                self.logger.warning(f"⚠️ No se pudo marcar un lote de emails ({item} {value}): {data}")
+            else:
+                stored += 1
+        
+        # Las búsquedas en caché son anteriores al marcado: con exclude_marked ya no son válidas
+        if stored and self.search_cache is not None:
+            self.search_cache.clear()
+        
+        self.logger.info(f"🏷️ {len(uids)} emails marcados con {item} {value} en {len(uid_sets)} comando(s)"
+                         + (f", {failed} con error" if failed else ""))
+        return {'uids': len(uids), 'commands': len(uid_sets), 'failed': failed}
+    
+    def open_run_journal(self):
+        """Abre (o reanuda) el diario de la ejecución si está habilitado"""
+        processing = self.config.get('processing', {})
+        if not processing.get('journal', True):
+            return None
+        
+        signature = self.get_run_signature()
+        journal_dir = self.get_state_path(processing.get('journal_dir'), '.journal')
+        self.journal = RunJournal(journal_dir / f"run_{signature}.jsonl", signature, self.uidvalidity).open()
+        
+        if self.journal.resumed:
+            self.logger.info(f"♻️ Reanudando ejecución interrumpida: {len(self.journal.index)} emails ya registrados en el diario")
+        
+        return self.journal
     
     def disconnect(self):
-        """Desconecta del servidor de email"""
+        """Desconecta del servidor de email (con pool de sesiones, la conexión queda abierta para la próxima ejecución)"""
+        if self.mail and self.session_pool is not None and self.session_key is not None:
+            self.session_pool.release(self.session_key, self.mail)
+            self.mail = None
+            return
+        
         if self.mail:
             try:
                 self.mail.close()
                 self.mail.logout()
             except:
-                pass
\ No newline at end of file
+                pass
+
+
+def process_offline_range(config, id_range):
+    """Procesa un rango de IDs de una fuente offline en un proceso aparte; devuelve filas del reporte"""
+    worker = EmailImageDownloader(config)
+    worker.open_message_source()
+    perceptual_index = worker.get_perceptual_index()
+    if perceptual_index is not None:
+        # Cada proceso consulta el índice guardado pero no lo sobrescribe (lo haría sin ver a los demás)
+        perceptual_index.read_only = True
+    
+    try:
+        worker.report.begin_capture()
+        valid_emails, files_downloaded = worker.process_email_ids(id_range)
+        rows, attachments = worker.report.end_capture()
+    finally:
+        worker.message_source.close()
+        if worker.attachment_writer is not None:
+            worker.attachment_writer.close()
+        if worker.dicom_index is not None:
+            worker.dicom_index.close()
+        if perceptual_index is not None:
+            perceptual_index.close()
+        if worker.thumbnail_cache is not None:
+            worker.thumbnail_cache.close()
+        if worker.archive_expander is not None:
+            worker.archive_expander.close()
+        if worker.http_cache is not None:
+            worker.http_cache.close()
+    
+    return {
+        'total_emails': len(id_range),
+        'valid_emails': len(valid_emails),
+        'total_files': files_downloaded,
+        'rows': rows,
+        'attachments': attachments
+    }
@@ -0,0 +1,174 @@
+import re
+import socketserver
+import sys
+import threading
+import zlib
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture
+def config(tmp_path):
+    """Configuración mínima de una ejecución (estructura de app.py) con la carpeta base en tmp_path"""
+    return {
+        'email_settings': {
+            'server': '127.0.0.1',
+            'port': 993,
+            'email': 'user@example.com',
+            'password': 'secret',
+            'use_ssl': False
+        },
+        'filters': {
+            'date_range': {'enabled': False},
+            'sender_emails': [],
+            'subject_keywords': [],
+            'folder': 'INBOX'
+        },
+        'download_settings': {
+            'base_folder': str(tmp_path / 'descargas'),
+            'folder_structure': {'by_date': False, 'by_sender': False, 'by_subject': False},
+            'allowed_extensions': ['.jpg', '.png', '.pdf', '.dcm'],
+            'max_file_size_mb': 0,
+            'rename_files': False
+        },
+        'processing': {
+            'delay_between_emails': 0.0
+        }
+    }
+
+
+class LoopbackIMAPHandler(socketserver.StreamRequestHandler):
+    """
+    Servidor IMAP mínimo para pruebas: CAPABILITY, LOGIN, SELECT, COMPRESS DEFLATE, UID SEARCH
+    (ALL, UNSEEN, UNKEYWORD, X-GM-RAW "-label:..."), UID FETCH (RFC822), UID STORE (+FLAGS y
+    +X-GM-LABELS), CLOSE y LOGOUT sobre los mensajes y las marcas del servidor.
+    """
+    
+    def setup(self):
+        super().setup()
+        self.compressor = None
+        self.decompressor = None
+        self.pending = b''
+    
+    def send(self, data):
+        if self.compressor:
+            data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.wfile.write(data)
+        self.wfile.flush()
+    
+    def receive_line(self):
+        if not self.decompressor:
+            return self.rfile.readline()
+        while b'\n' not in self.pending:
+            chunk = self.rfile.read1(4096)
+            if not chunk:
+                return b''
+            self.pending += self.decompressor.decompress(chunk)
+        end = self.pending.index(b'\n') + 1
+        line, self.pending = self.pending[:end], self.pending[end:]
+        return line
+    
+    def uid_set_members(self, uid_set):
+        """UIDs existentes de un conjunto IMAP ('3:7,10')"""
+        members = set()
+        for item in uid_set.split(','):
+            start, _, end = item.partition(':')
+            low, high = sorted((int(start), int(end or start)))
+            members.update(uid for uid in self.server.messages if low <= uid <= high)
+        return members
+    
+    def search(self, criteria):
+        marks = self.server.flags
+        uids = list(self.server.messages)
+        if 'UNSEEN' in criteria.upper():
+            uids = [uid for uid in uids if '\\Seen' not in marks.get(uid, ())]
+        keyword = re.search(r'UNKEYWORD (\S+)', criteria)
+        if keyword:
+            uids = [uid for uid in uids if keyword.group(1) not in marks.get(uid, ())]
+        label = re.search(r'X-GM-RAW "-label:([^"]+)"', criteria)
+        if label:
+            uids = [uid for uid in uids if f'label:{label.group(1)}' not in marks.get(uid, ())]
+        return uids
+    
+    def store(self, args):
+        _, uid_set, item, value = args.split(' ', 3)
+        if item.upper() == '+X-GM-LABELS':
+            # Las etiquetas se guardan como 'label:<nombre>' (con espacios como guiones, igual que X-GM-RAW)
+            names = {'label:' + re.sub(r'\s+', '-', name) for name in re.findall(r'"([^"]*)"', value)}
+        else:
+            names = set(value.strip('()').split())
+        for uid in self.uid_set_members(uid_set):
+            self.server.flags.setdefault(uid, set()).update(names)
+        self.server.store_commands.append(uid_set)
+    
+    def handle(self):
+        capabilities = 'IMAP4rev1' + (' COMPRESS=DEFLATE' if self.server.allow_compress else '')
+        messages = self.server.messages
+        self.send(b'* OK loopback IMAP ready\r\n')
+        
+        while True:
+            line = self.receive_line()
+            if not line:
+                return
+            tag, command, *rest = line.decode().strip().split(' ', 2)
+            command = command.upper()
+            args = rest[0] if rest else ''
+            
+            if command == 'CAPABILITY':
+                self.send(f'* CAPABILITY {capabilities}\r\n{tag} OK done\r\n'.encode())
+            elif command == 'LOGIN':
+                self.send(f'{tag} OK logged in\r\n'.encode())
+            elif command == 'SELECT':
+                self.send(f'* {len(messages)} EXISTS\r\n* OK [UIDVALIDITY 1] ok\r\n{tag} OK [READ-WRITE] done\r\n'.encode())
+            elif command == 'COMPRESS' and self.server.allow_compress and not self.compressor:
+                self.send(f'{tag} OK DEFLATE active\r\n'.encode())
+                self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+                self.decompressor = zlib.decompressobj(-15)
+            elif command == 'UID' and args.upper().startswith('SEARCH'):
+                uids = ' '.join(str(uid) for uid in self.search(args))
+                self.send(f'* SEARCH {uids}\r\n{tag} OK done\r\n'.encode())
+            elif command == 'UID' and args.upper().startswith('STORE'):
+                self.store(args)
+                self.send(f'{tag} OK done\r\n'.encode())
+            elif command == 'UID' and args.upper().startswith('FETCH'):
+                for seq, uid in enumerate(messages, 1):
+                    if str(uid) in args.split(' ')[1].split(','):
+                        raw = messages[uid]
+                        self.send(f'* {seq} FETCH (UID {uid} RFC822 {{{len(raw)}}}\r\n'.encode() + raw + b')\r\n')
+                self.send(f'{tag} OK done\r\n'.encode())
+            elif command == 'CLOSE':
+                self.send(f'{tag} OK done\r\n'.encode())
+            elif command == 'LOGOUT':
+                self.send(f'* BYE\r\n{tag} OK done\r\n'.encode())
+                return
+            else:
+                self.send(f'{tag} BAD unsupported\r\n'.encode())
+
+
+@pytest.fixture
+def imap_server():
+    """
+    Arranca servidores IMAP en 127.0.0.1; devuelve una fábrica (messages, allow_compress, flags) -> puerto.
+    flags ({uid: set de marcas}) es el estado del servidor: los STORE lo modifican y SEARCH lo consulta
+    """
+    servers = []
+    
+    def start(messages, allow_compress=True, flags=None):
+        server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), LoopbackIMAPHandler)
+        server.daemon_threads = True
+        server.messages = messages
+        server.allow_compress = allow_compress
+        server.flags = {} if flags is None else flags
+        server.store_commands = []
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server.server_address[1]
+    
+    yield start
+    
+    for server in servers:
+        server.shutdown()
+        server.server_close()
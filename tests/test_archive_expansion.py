@@ -0,0 +1,104 @@
+import io
+import random
+import zipfile
+from email.message import EmailMessage
+
+import pytest
+
+from functions import ArchiveExpander, EmailImageDownloader
+
+
+JPEG = b'\xff\xd8\xff\xe0' + b'\x00' * 2000
+DICOM = b'\x00' * 128 + b'DICM' + b'\x01' * 2000
+
+
+def make_zip(members, compression=zipfile.ZIP_DEFLATED):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression) as archive:
+        for name, data in members.items():
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+def make_message(zip_data, filename='estudio.zip', content_type=('application', 'octet-stream')):
+    msg = EmailMessage()
+    msg['From'] = 'lab@example.com'
+    msg['Subject'] = 'Estudio'
+    msg.set_content('Adjunto el estudio')
+    msg.add_attachment(zip_data, maintype=content_type[0], subtype=content_type[1], filename=filename)
+    if filename is None:
+        # Parte sin nombre ni disposición: sólo la identifican su tipo y sus bytes
+        attachment = msg.get_payload()[-1]
+        del attachment['Content-Disposition']
+    return msg
+
+
+@pytest.fixture
+def downloader(config):
+    config['download_settings']['archive_expansion'] = {'enabled': True, 'workers': 2}
+    downloader = EmailImageDownloader(config)
+    yield downloader
+    if downloader.archive_expander is not None:
+        downloader.archive_expander.close()
+
+
+@pytest.mark.parametrize('filename, content_type', [
+    ('estudio.zip', ('application', 'octet-stream')),
+    ('estudio.zip', ('application', 'zip')),
+    (None, ('application', 'zip')),
+])
+def test_zip_is_approved_only_with_allowed_members(downloader, filename, content_type):
+    useful = make_message(make_zip({'foto.jpg': JPEG, 'leeme.txt': b'hola'}), filename, content_type)
+    # Más de 1 KB de binario: tampoco cuenta como 'archivo genérico' en el último intento del análisis
+    useless = make_message(make_zip({'leeme.txt': b'hola', 'datos.bin': random.Random(1).randbytes(4000)}),
+                           filename, content_type)
+    
+    assert downloader.has_relevant_attachments(useful)
+    assert not downloader.has_relevant_attachments(useless)
+
+
+def test_central_directory_is_read_from_the_tail():
+    expander = ArchiveExpander(lambda data: None, workers=1)
+    data = make_zip({'grande.bin': bytes(range(256)) * 4096, 'scan': DICOM, 'notas.txt': b'x'},
+                    compression=zipfile.ZIP_STORED)
+    
+    # Sólo los últimos bytes: el directorio central alcanza para ver los nombres
+    infos = expander.list_tail_members(data[-512:])
+    assert [info.filename for info in infos] == ['grande.bin', 'scan', 'notas.txt']
+    # 'scan' no tiene extensión: podría ser un DICOM, se descarga
+    assert expander.may_contain_allowed(infos, {'.dcm'})
+    assert not expander.may_contain_allowed([info for info in infos if info.filename != 'scan'], {'.dcm', '.jpg'})
+    
+    assert expander.list_tail_members(data[:100]) is None
+    expander.close()
+
+
+def test_iter_members_streams_allowed_members_and_balances_reservations(downloader):
+    expander = downloader.get_archive_expander()
+    data = make_zip({'__MACOSX/._foto.jpg': b'x', 'a/foto.jpg': JPEG, 'scan': DICOM, 'notas.txt': b'hola'})
+    reserved = []
+    released = []
+    warnings = []
+    
+    members = []
+    for name, content, strategy, size in expander.iter_members(
+            data, {'.jpg', '.dcm'}, warnings,
+            reserve=lambda size, pending: reserved.append(size), release=released.append):
+        members.append((name, content, strategy))
+        released.append(size)
+    
+    assert members == [('foto.jpg', JPEG, 'zip_filename'), ('scan.dcm', DICOM, 'zip_magic_bytes')]
+    assert warnings == []
+    assert sorted(reserved) == sorted(released)
+
+
+def test_lying_member_size_is_rejected(downloader):
+    expander = downloader.get_archive_expander()
+    data = bytearray(make_zip({'foto.jpg': JPEG}, compression=zipfile.ZIP_STORED))
+    # Tamaño declarado menor que el real en el directorio central
+    central = data.rindex(b'PK\x01\x02')
+    data[central + 24:central + 28] = (100).to_bytes(4, 'little')
+    warnings = []
+    
+    assert list(expander.iter_members(bytes(data), {'.jpg'}, warnings)) == []
+    assert len(warnings) == 1
@@ -0,0 +1,143 @@
+import base64
+import quopri
+import re
+
+import pytest
+
+from functions import EmailImageDownloader
+
+
+# Respuestas FETCH tal como las entrega imaplib (los literales llegan como tuplas), con el
+# formato que devuelven Gmail (mayúsculas, extensiones completas) y Exchange Online / Outlook
+# (minúsculas, literales en nombres largos, parámetros RFC 2231 y mensajes reenviados)
+GMAIL_FETCH = [
+    b'1 (UID 5 BODYSTRUCTURE ((("TEXT" "PLAIN" ("CHARSET" "UTF-8") NIL NIL "7BIT" 24 1 NIL NIL NIL NIL)'
+    b'("TEXT" "HTML" ("CHARSET" "UTF-8") NIL NIL "QUOTED-PRINTABLE" 47 1 NIL NIL NIL NIL) "ALTERNATIVE" '
+    b'("BOUNDARY" "000000000000a1b2c3") NIL NIL NIL)'
+    b'("IMAGE" "JPEG" ("NAME" "radiografia panoramica.jpg") "<f_lx1a2b3c0>" NIL "BASE64" 123456 NIL '
+    b'("ATTACHMENT" ("FILENAME" "radiografia panoramica.jpg")) NIL NIL)'
+    b'("APPLICATION" "OCTET-STREAM" NIL NIL NIL "BASE64" 4096 NIL NIL NIL NIL) "MIXED" '
+    b'("BOUNDARY" "000000000000d4e5f6") NIL NIL NIL))'
+]
+
+OUTLOOK_FETCH = [
+    (b'2 (UID 9 BODYSTRUCTURE (("text" "html" ("charset" "utf-8") NIL NIL "quoted-printable" 2210 45 NIL NIL NIL NIL)'
+     b'("application" "octet-stream" ("name" {25}',
+     b'estudio "final" RX 01.dcm'),
+    b') NIL NIL "base64" 700000 NIL ("attachment" ("filename*" "utf-8\'\'tomograf%C3%ADa%20maxilar.dcm" '
+    b'"size" "512000" "creation-date" "Mon, 07 Oct 2024 10:15:00 GMT")) NIL NIL)'
+    b'("message" "rfc822" NIL NIL NIL "7bit" 3000 ("Mon, 07 Oct 2024 09:00:00 +0000" "RV: Estudio" '
+    b'(("Lab" NIL "lab" "example.com")) (("Lab" NIL "lab" "example.com")) (("Lab" NIL "lab" "example.com")) '
+    b'(("Dr" NIL "dr" "example.com")) NIL NIL NIL "<abc@example.com>") '
+    b'("image" "png" ("name" "firma.png") NIL NIL "base64" 2048 NIL ("inline" ("filename" "firma.png")) NIL NIL) '
+    b'40 NIL ("attachment" ("filename" "RV Estudio.eml")) NIL NIL) "mixed" ("boundary" "_004_DM6PR") NIL "es-AR"))'
+]
+
+
+@pytest.fixture
+def downloader(config):
+    config['download_settings']['allowed_extensions'] = ['.jpg', '.pdf', '.dcm']
+    return EmailImageDownloader(config)
+
+
+def test_parse_imap_response_handles_literals_nil_and_quotes():
+    data = [(b'* 1 FETCH (A "b \\"c\\"" NIL BODY[HEADER.FIELDS (DATE)] {3}', b'x y'), b' (D nil) BODY[1.2]<0> "")']
+    
+    assert EmailImageDownloader.parse_imap_response(data) == [
+        b'*', b'1', b'FETCH',
+        [b'A', b'b "c"', None, b'BODY[HEADER.FIELDS (DATE)]', b'x y', [b'D', None], b'BODY[1.2]<0>', b'']
+    ]
+
+
+def test_flatten_gmail_bodystructure(downloader):
+    items = downloader.parse_fetch_items(GMAIL_FETCH)
+    parts = downloader.flatten_bodystructure(items['BODYSTRUCTURE'])
+    
+    assert [(part['section'], part['content_type']) for part in parts] == [
+        ('1.1', 'text/plain'), ('1.2', 'text/html'), ('2', 'image/jpeg'), ('3', 'application/octet-stream')
+    ]
+    assert parts[1]['encoding'] == 'quoted-printable'
+    assert parts[2] == {
+        'section': '2', 'content_type': 'image/jpeg', 'encoding': 'base64', 'size': 123456,
+        'filename': 'radiografia panoramica.jpg', 'disposition': 'attachment'
+    }
+    assert parts[3]['filename'] is None and parts[3]['disposition'] == ''
+
+
+def test_flatten_outlook_bodystructure(downloader):
+    items = downloader.parse_fetch_items(OUTLOOK_FETCH)
+    parts = downloader.flatten_bodystructure(items['BODYSTRUCTURE'])
+    
+    assert [(part['section'], part['content_type']) for part in parts] == [
+        ('1', 'text/html'), ('2', 'application/octet-stream'), ('3.1', 'image/png')
+    ]
+    # El filename de la disposición (RFC 2231) tiene prioridad sobre el name del literal
+    assert parts[1]['filename'] == 'tomografía maxilar.dcm'
+    assert parts[1]['size'] == 700000 and parts[1]['disposition'] == 'attachment'
+    # El cuerpo no multipart de un mensaje reenviado es la sección N.1
+    assert parts[2]['filename'] == 'firma.png' and parts[2]['disposition'] == 'inline'
+
+
+def test_plan_section_downloads(downloader):
+    gmail_parts = downloader.flatten_bodystructure(downloader.parse_fetch_items(GMAIL_FETCH)['BODYSTRUCTURE'])
+    outlook_parts = downloader.flatten_bodystructure(downloader.parse_fetch_items(OUTLOOK_FETCH)['BODYSTRUCTURE'])
+    
+    gmail_plan = downloader.plan_section_downloads(gmail_parts)
+    assert [(part['section'], part['strategy'], part['filename']) for part in gmail_plan] == [
+        ('2', 'filename', 'radiografia panoramica.jpg'), ('3', 'magic_bytes', None)
+    ]
+    assert gmail_plan[1]['part_index'] == 3
+    
+    # firma.png no es una extensión permitida
+    outlook_plan = downloader.plan_section_downloads(outlook_parts)
+    assert [(part['section'], part['filename']) for part in outlook_plan] == [('2', 'tomografía maxilar.dcm')]
+
+
+def serve_section(downloader, encoded):
+    """Responde BODY.PEEK[n]<0.N> con los primeros N bytes de la sección codificada"""
+    requests = []
+    
+    def imap_fetch(email_id, message_parts):
+        requests.append(message_parts)
+        section, length = re.search(r'BODY\.PEEK\[([\d.]+)\]<0\.(\d+)>', message_parts).groups()
+        head = encoded[:int(length)]
+        return 'OK', [(f'1 (UID 5 BODY[{section}]<0> {{{len(head)}}}'.encode(), head), b')']
+    
+    downloader.imap_fetch = imap_fetch
+    return requests
+
+
+DICOM_HEAD = b'\x00' * 128 + b'DICM' + b'\x02\x00\x00\x00UL\x04\x00' + bytes(range(256))
+
+
+@pytest.mark.parametrize('encoding, encode', [
+    ('base64', base64.encodebytes),
+    ('quoted-printable', lambda data: quopri.encodestring(data)),
+])
+def test_magic_bytes_are_sniffed_after_decoding(downloader, encoding, encode):
+    requests = serve_section(downloader, encode(DICOM_HEAD))
+    part = {'section': '3', 'content_type': 'application/octet-stream', 'encoding': encoding,
+            'disposition': '', 'part_index': 3, 'strategy': 'magic_bytes', 'filename': None}
+    
+    head = downloader.peek_section_magic(5, part)
+    assert head.startswith(b'\x00' * 128 + b'DICM')
+    assert len(requests) == 1
+    
+    assert downloader.resolve_magic_part(5, part)
+    assert part['filename'] == 'archivo_magic_3.dcm'
+
+
+def test_unknown_generic_part_is_not_downloaded(downloader):
+    serve_section(downloader, base64.encodebytes(b'\x13\x37' * 200))
+    part = {'section': '3', 'content_type': 'application/octet-stream', 'encoding': 'base64',
+            'disposition': '', 'part_index': 3, 'strategy': 'magic_bytes', 'filename': None}
+    
+    assert not downloader.resolve_magic_part(5, part)
+
+
+def test_decode_section_payload(downloader):
+    data = b'%PDF-1.7\n' + bytes(range(256)) * 4
+    
+    assert downloader.decode_section_payload(base64.encodebytes(data), 'base64') == data
+    assert downloader.decode_section_payload(quopri.encodestring(data), 'quoted-printable') == data
+    assert downloader.decode_section_payload(b'texto plano', '7bit') == b'texto plano'
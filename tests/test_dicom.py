@@ -0,0 +1,118 @@
+import struct
+
+import pytest
+
+from functions import DicomIndex, EmailImageDownloader, read_dicom_header
+
+
+EXPLICIT_LE = '1.2.840.10008.1.2.1'
+IMPLICIT_LE = '1.2.840.10008.1.2'
+EXPLICIT_BE = '1.2.840.10008.1.2.2'
+DEFLATED = '1.2.840.10008.1.2.1.99'
+UNDEFINED = 0xFFFFFFFF
+
+
+def pad(value, filler=b' '):
+    value = value.encode('ascii') if isinstance(value, str) else value
+    return value + filler if len(value) % 2 else value
+
+
+def element(tag, vr, value, explicit=True, endian='<', length=None):
+    """Codifica un elemento DICOM con VR explícito o implícito"""
+    group, number = tag
+    length = len(value) if length is None else length
+    header = struct.pack(endian + 'HH', group, number)
+    if not explicit or group == 0xFFFE:
+        return header + struct.pack(endian + 'I', length) + value
+    if vr in (b'OB', b'OW', b'SQ', b'UN', b'UT'):
+        return header + vr + b'\x00\x00' + struct.pack(endian + 'I', length) + value
+    return header + vr + struct.pack(endian + 'H', length) + value
+
+
+def part10(transfer_syntax, truncate_at=None):
+    """Archivo DICOM Part 10 mínimo: preámbulo, file meta y un dataset con una secuencia de longitud indefinida"""
+    meta_elements = element((0x0002, 0x0010), b'UI', pad(transfer_syntax, b'\x00'))
+    meta = element((0x0002, 0x0000), b'UL', struct.pack('<I', len(meta_elements))) + meta_elements
+    
+    explicit = transfer_syntax != IMPLICIT_LE
+    endian = '>' if transfer_syntax == EXPLICIT_BE else '<'
+    
+    def data_element(tag, vr, value, length=None):
+        return element(tag, vr, value, explicit, endian, length)
+    
+    item = data_element((0xFFFE, 0xE000), None, data_element((0x0008, 0x1150), b'UI', pad('1.2.3', b'\x00')),
+                        length=UNDEFINED) + data_element((0xFFFE, 0xE00D), None, b'')
+    sequence = data_element((0x0008, 0x1111), b'SQ', item, length=UNDEFINED) + data_element((0xFFFE, 0xE0DD), None, b'')
+    dataset = b''.join([
+        data_element((0x0008, 0x0018), b'UI', pad('1.2.826.0.1.3680043.1.1', b'\x00')),
+        data_element((0x0008, 0x0020), b'DA', pad('20240502')),
+        data_element((0x0008, 0x0060), b'CS', pad('CT')),
+        sequence,
+        data_element((0x0010, 0x0010), b'PN', pad('PEREZ^JUAN')),
+        data_element((0x0010, 0x0020), b'LO', pad('HC-1234')),
+        data_element((0x0020, 0x000D), b'UI', pad('1.2.826.0.1.3680043.2', b'\x00')),
+        data_element((0x0020, 0x000E), b'UI', pad('1.2.826.0.1.3680043.2.1', b'\x00')),
+        data_element((0x7FE0, 0x0010), b'OW', b'\x00\x01' * 4096),
+    ])
+    data = b'\x00' * 128 + b'DICM' + meta + dataset
+    return data[:truncate_at] if truncate_at else data
+
+
+EXPECTED = {
+    'sop_instance_uid': '1.2.826.0.1.3680043.1.1',
+    'study_date': '20240502',
+    'modality': 'CT',
+    'patient_name': 'PEREZ^JUAN',
+    'patient_id': 'HC-1234',
+    'study_uid': '1.2.826.0.1.3680043.2',
+    'series_uid': '1.2.826.0.1.3680043.2.1',
+}
+
+
+@pytest.mark.parametrize('transfer_syntax', [EXPLICIT_LE, IMPLICIT_LE, EXPLICIT_BE])
+def test_read_dicom_header(transfer_syntax):
+    assert read_dicom_header(part10(transfer_syntax)) == dict(EXPECTED, transfer_syntax=transfer_syntax)
+
+
+def test_truncated_header_returns_what_was_read():
+    data = part10(EXPLICIT_LE)
+    cut = data.index(b'PEREZ') + 3
+    
+    tags = read_dicom_header(data[:cut])
+    
+    assert tags['modality'] == 'CT' and tags['study_date'] == '20240502'
+    assert 'patient_id' not in tags and 'study_uid' not in tags
+    # Sólo preámbulo y parte del file meta
+    assert read_dicom_header(data[:140]) == {}
+
+
+def test_non_dicom_and_deflated():
+    assert read_dicom_header(b'\xff\xd8\xff' + b'\x00' * 400) is None
+    assert read_dicom_header(b'\x00' * 128 + b'DICX' + b'\x00' * 64) is None
+    assert read_dicom_header(part10(DEFLATED)) == {'transfer_syntax': DEFLATED}
+
+
+def test_dicom_index_groups_files_by_study(tmp_path):
+    index = DicomIndex(tmp_path / 'indice.sqlite3')
+    tags = read_dicom_header(part10(EXPLICIT_LE))
+    index.record([
+        (tmp_path / 'a.dcm', 5, 1000, tags),
+        (tmp_path / 'b.dcm', 5, 2000, dict(tags, sop_instance_uid='1.2.3.9', modality='MR')),
+    ])
+    
+    studies = index.studies()
+    assert len(studies) == 1
+    assert studies[0]['patient_id'] == 'HC-1234'
+    assert studies[0]['modalities'] == ['CT', 'MR']
+    assert studies[0]['files'] == 2 and studies[0]['bytes'] == 3000
+    assert [path for _, path in index.files(tags['study_uid'])] == [str(tmp_path / 'a.dcm'), str(tmp_path / 'b.dcm')]
+    index.close()
+
+
+def test_index_is_opt_in_and_lives_under_base_folder(config, tmp_path):
+    assert EmailImageDownloader(config).get_dicom_index() is None
+    
+    config['download_settings']['dicom_index'] = {'enabled': True}
+    index = EmailImageDownloader(config).get_dicom_index()
+    assert index.index_path == tmp_path / 'descargas' / '.cache' / 'dicom_index.sqlite3'
+    index.close()
@@ -0,0 +1,115 @@
+import os
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from functions import EmailImageDownloader
+
+
+PNG = b'\x89PNG\r\n\x1a\n' + bytes(range(256)) * 8
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    """Sirve una imagen con ETag y responde 304 a las revalidaciones"""
+    
+    ETAG = '"firma-v1"'
+    
+    def send_image_headers(self, status):
+        self.send_response(status)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('ETag', self.ETAG)
+        self.send_header('Content-Length', '0' if status == 304 else str(len(PNG)))
+        self.end_headers()
+    
+    def do_HEAD(self):
+        self.send_image_headers(200)
+    
+    def do_GET(self):
+        if self.headers.get('If-None-Match') == self.ETAG:
+            self.server.revalidated += 1
+            self.send_image_headers(304)
+            return
+        self.server.bodies_sent += 1
+        self.send_image_headers(200)
+        self.wfile.write(PNG)
+    
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def image_url():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ImageHandler)
+    server.bodies_sent = 0
+    server.revalidated = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server, f'http://127.0.0.1:{server.server_address[1]}/firma.png'
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def downloader(config):
+    config['download_settings']['http_cache'] = {'enabled': True, 'max_age_hours': 24}
+    downloader = EmailImageDownloader(config)
+    yield downloader
+    if downloader.attachment_writer is not None:
+        downloader.attachment_writer.close()
+    if downloader.http_cache is not None:
+        downloader.http_cache.close()
+
+
+def download(downloader, url, folder, index=1, email_date=datetime(2024, 5, 2)):
+    link = {'type': 'url', 'url': url, 'source': 'link'}
+    return downloader.download_from_image_link(link, folder, 'lab@example.com', 'Estudio', index, email_date)
+
+
+def test_cache_is_opt_in_and_lives_under_base_folder(config, tmp_path):
+    assert EmailImageDownloader(config).get_http_cache() is None
+    
+    config['download_settings']['http_cache'] = {'enabled': True}
+    cache = EmailImageDownloader(config).get_http_cache()
+    assert cache.cache_path == tmp_path / 'descargas' / '.cache' / 'descargas_http.sqlite3'
+    cache.close()
+
+
+def test_repeated_link_is_linked_instead_of_copied(downloader, image_url, tmp_path):
+    server, url = image_url
+    base = tmp_path / 'descargas'
+    
+    first = download(downloader, url, base / 'a')
+    assert first.read_bytes() == PNG
+    assert server.bodies_sent == 1
+    
+    # Otro email: el archivo ya descargado se enlaza, sin pedirlo ni escribir otra copia
+    second = download(downloader, url, base / 'b')
+    assert second.parent == base / 'b'
+    assert os.path.samefile(first, second)
+    assert server.bodies_sent == 1
+    assert downloader.http_cache.hits == 1
+    
+    # En la misma carpeta se reutiliza la ruta existente
+    assert download(downloader, url, base / 'a', index=2) == first
+    assert sorted(path.name for path in (base / 'a').iterdir()) == [first.name]
+
+
+def test_stale_entry_is_revalidated_without_body(downloader, image_url, tmp_path):
+    server, url = image_url
+    base = tmp_path / 'descargas'
+    first = download(downloader, url, base / 'a')
+    
+    downloader.config['download_settings']['http_cache']['max_age_hours'] = 0
+    revalidated = download(downloader, url, base / 'c')
+    
+    assert server.revalidated == 1
+    assert server.bodies_sent == 1
+    assert os.path.samefile(first, revalidated)
+    
+    # Si el archivo en caché desapareció, se vuelve a descargar (en un email de otro día)
+    first.unlink()
+    revalidated.unlink()
+    fresh = download(downloader, url, base / 'd', email_date=datetime(2024, 5, 3))
+    assert fresh.read_bytes() == PNG
+    assert server.bodies_sent == 2
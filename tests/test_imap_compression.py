@@ -0,0 +1,55 @@
+import pytest
+
+from functions import CompressibleIMAP4
+
+
+def make_message(uid):
+    body = ''.join(f'Línea {i} del informe del paciente {uid}\r\n' for i in range(400))
+    return (
+        f'From: lab@example.com\r\nTo: user@example.com\r\nSubject: Informe {uid}\r\n'
+        f'Content-Type: text/plain; charset=utf-8\r\n\r\n{body}'
+    ).encode()
+
+
+@pytest.fixture
+def messages():
+    return {uid: make_message(uid) for uid in (3, 7, 12)}
+
+
+def search_and_fetch(port, compress):
+    mail = CompressibleIMAP4('127.0.0.1', port)
+    try:
+        mail.login('user', 'secret')
+        enabled = mail.enable_compression() if compress else False
+        mail.select('INBOX')
+        
+        typ, data = mail.uid('SEARCH', None, 'ALL')
+        assert typ == 'OK'
+        uids = [int(uid) for uid in data[0].split()]
+        
+        fetched = {}
+        for uid in uids:
+            typ, data = mail.uid('FETCH', str(uid), '(RFC822)')
+            assert typ == 'OK'
+            fetched[uid] = data[0][1]
+        
+        return enabled, fetched, mail.get_transfer_stats()
+    finally:
+        mail.logout()
+
+
+@pytest.mark.parametrize('allow_compress, compress', [(True, True), (True, False), (False, True)])
+def test_search_fetch(imap_server, messages, allow_compress, compress):
+    port = imap_server(messages, allow_compress=allow_compress)
+    
+    enabled, fetched, stats = search_and_fetch(port, compress)
+    
+    assert fetched == messages
+    assert enabled is (allow_compress and compress)
+    assert stats['compression'] is enabled
+    if enabled:
+        assert stats['wire_bytes_in'] < stats['decoded_bytes_in'] / 4
+        assert stats['wire_bytes_out'] < stats['decoded_bytes_out']
+    else:
+        assert stats['wire_bytes_in'] == stats['decoded_bytes_in']
+        assert stats['wire_bytes_out'] == stats['decoded_bytes_out']
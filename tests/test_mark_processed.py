@@ -0,0 +1,81 @@
+import pytest
+
+from functions import EmailImageDownloader, compress_uid_set
+
+
+def expand(uid_sets):
+    uids = []
+    for uid_set in uid_sets:
+        for item in uid_set.split(','):
+            start, _, end = item.partition(':')
+            uids.extend(range(int(start), int(end or start) + 1))
+    return uids
+
+
+@pytest.mark.parametrize('uids, expected', [
+    ([], []),
+    ([5], ['5']),
+    ([9, 3, 4, 5, 1], ['1,3:5,9']),
+    ([4, 4, 3, 3, 5], ['3:5']),
+    ([1, 2, 3, 7, 10, 11, 20], ['1:3,7,10:11,20']),
+    (['12', b'13', 14], ['12:14']),
+])
+def test_compress_uid_set(uids, expected):
+    assert compress_uid_set(uids) == expected
+
+
+def test_compress_uid_set_splits_long_sets():
+    uids = range(1, 20000, 2)
+    
+    uid_sets = compress_uid_set(uids, max_length=200)
+    
+    assert len(uid_sets) > 1
+    assert all(len(uid_set) <= 200 for uid_set in uid_sets)
+    assert expand(uid_sets) == list(uids)
+
+
+@pytest.fixture
+def messages():
+    return {uid: f'Subject: Informe {uid}\r\n\r\nCuerpo\r\n'.encode() for uid in range(1, 11)}
+
+
+def connected_downloader(config, imap_server, messages, flags, settings):
+    config['email_settings']['port'] = imap_server(messages, flags=flags)
+    config['processing']['mark_processed'] = dict(settings, enabled=True, exclude_marked=True)
+    downloader = EmailImageDownloader(config)
+    assert downloader.connect_to_email()
+    return downloader
+
+
+@pytest.mark.parametrize('settings, marks', [
+    ({'mode': 'seen'}, {'\\Seen'}),
+    ({'mode': 'keyword', 'keyword': 'Archivado'}, {'Archivado'}),
+    ({'mode': 'gmail_label', 'label': 'Estudios medicos'}, {'label:Estudios-medicos'}),
+])
+def test_mark_processed_round_trip(config, imap_server, messages, settings, marks):
+    flags = {}
+    downloader = connected_downloader(config, imap_server, messages, flags, settings)
+    try:
+        downloader.report.tracked_uids.update({2, 3, 4, 8, 10})
+        
+        result = downloader.mark_processed_messages()
+        
+        assert result == {'uids': 5, 'commands': 1, 'failed': 0}
+        assert flags == {uid: marks for uid in (2, 3, 4, 8, 10)}
+        
+        # Con exclude_marked la siguiente búsqueda ya no devuelve los emails marcados
+        typ, data = downloader.imap_search('ALL')
+        assert typ == 'OK'
+        assert [int(uid) for uid in data[0].split()] == [1, 5, 6, 7, 9]
+    finally:
+        downloader.disconnect()
+
+
+def test_mark_processed_without_tracked_uids(config, imap_server, messages):
+    flags = {}
+    downloader = connected_downloader(config, imap_server, messages, flags, {'mode': 'seen'})
+    try:
+        assert downloader.mark_processed_messages() is None
+        assert flags == {}
+    finally:
+        downloader.disconnect()
@@ -0,0 +1,28 @@
+import zipfile
+
+from functions import ResultsZipPackager
+
+
+def test_zip_keeps_relative_paths_and_skips_recompression(tmp_path):
+    base = tmp_path / 'descargas'
+    (base / '2024' / 'lab').mkdir(parents=True)
+    photo = base / '2024' / 'lab' / 'foto.jpg'
+    photo.write_bytes(b'\xff\xd8\xff' + b'jpeg' * 100)
+    notes = base / '2024' / 'notas.txt'
+    notes.write_text('informe ' * 200)
+    outside = tmp_path / 'otra_carpeta' / 'anexo.pdf'
+    outside.parent.mkdir()
+    outside.write_bytes(b'%PDF-1.4')
+    (base / 'de_otra_ejecucion.pdf').write_bytes(b'%PDF-1.4')
+    
+    zip_path, count = ResultsZipPackager(base).build([photo, notes, outside], tmp_path / 'resultado.zip')
+    assert count == 3
+    
+    with zipfile.ZipFile(zip_path) as archive:
+        assert sorted(archive.namelist()) == ['2024/lab/foto.jpg', '2024/notas.txt', 'anexo.pdf']
+        # Los formatos ya comprimidos van sin recomprimir
+        assert archive.getinfo('2024/lab/foto.jpg').compress_type == zipfile.ZIP_STORED
+        assert archive.getinfo('2024/notas.txt').compress_type == zipfile.ZIP_DEFLATED
+        assert archive.read('2024/lab/foto.jpg') == photo.read_bytes()
+        assert archive.read('2024/notas.txt') == notes.read_bytes()
+        assert archive.testzip() is None
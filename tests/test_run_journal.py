@@ -0,0 +1,90 @@
+from functions import EmailImageDownloader, RunJournal
+
+
+def row(uid, estado):
+    return {'email_id': str(uid), 'estado': estado, 'archivos_descargados': 0}
+
+
+def write_interrupted_run(path):
+    journal = RunJournal(path, 'firma', 42).open()
+    journal.record_analysis(1, True, row(1, 'APROBADO'))
+    journal.record_download(1, 'DESCARGADO', 2, '/tmp/descargas/1', [{'archivo': 'a.jpg'}])
+    journal.record_analysis(2, False, row(2, 'DESCARTADO'))
+    journal.record_analysis(3, True, row(3, 'APROBADO'))
+    journal.record_download(3, 'ERROR', 0, '', motivo_rechazo='timeout')
+    journal.close()
+    
+    # Interrupción a mitad de una escritura: la última línea queda cortada
+    with open(path, 'ab') as journal_file:
+        journal_file.write(b'{"e": "analysis", "uid": 4, "approved": tr')
+
+
+def test_resume_after_truncated_last_line(tmp_path):
+    path = tmp_path / 'run.jsonl'
+    write_interrupted_run(path)
+    
+    journal = RunJournal(path, 'firma', 42).open()
+    assert journal.resumed
+    assert sorted(journal.index) == [1, 2, 3]
+    
+    downloaded, approved, attachments = journal.get_resumable(1)
+    assert approved and downloaded['estado'] == 'DESCARGADO' and downloaded['archivos_descargados'] == 2
+    assert attachments == [{'archivo': 'a.jpg'}]
+    assert journal.get_resumable(2) == (row(2, 'DESCARTADO'), False, [])
+    # Los emails con error se vuelven a procesar, y el truncado nunca llegó a registrarse
+    assert journal.get_resumable(3) is None
+    assert journal.get_resumable(4) is None
+    
+    # Lo que se escribe tras reanudar empieza en una línea propia y se puede leer en la siguiente reanudación
+    journal.record_analysis(4, True, row(4, 'APROBADO'))
+    journal.close()
+    
+    journal = RunJournal(path, 'firma', 42).open()
+    assert journal.resumed
+    assert journal.get_resumable(4) == (row(4, 'APROBADO'), True, [])
+    assert journal.get_resumable(1)[0]['estado'] == 'DESCARGADO'
+    journal.close()
+
+
+def test_completed_run_starts_a_new_journal(tmp_path):
+    path = tmp_path / 'run.jsonl'
+    write_interrupted_run(path)
+    
+    journal = RunJournal(path, 'firma', 42).open()
+    journal.mark_completed()
+    journal.close()
+    
+    journal = RunJournal(path, 'firma', 42).open()
+    assert not journal.resumed
+    assert journal.index == {}
+    assert journal.get_resumable(1) is None
+    journal.close()
+    assert path.read_bytes().count(b'\n') == 1
+
+
+def test_other_configuration_or_uidvalidity_is_not_resumed(tmp_path):
+    path = tmp_path / 'run.jsonl'
+    write_interrupted_run(path)
+    
+    journal = RunJournal(path, 'otra_firma', 42).open()
+    assert not journal.resumed and journal.index == {}
+    journal.close()
+    
+    write_interrupted_run(path)
+    journal = RunJournal(path, 'firma', 43).open()
+    assert not journal.resumed and journal.index == {}
+    journal.close()
+
+
+def test_journal_lives_under_base_folder(config, tmp_path):
+    downloader = EmailImageDownloader(config)
+    downloader.uidvalidity = 42
+    
+    journal = downloader.open_run_journal()
+    journal.close()
+    
+    assert journal.journal_path.is_relative_to(tmp_path / 'descargas' / '.journal')
+    assert journal.journal_path.exists()
+    
+    config['processing']['journal'] = False
+    assert EmailImageDownloader(config).open_run_journal() is None
@@ -0,0 +1,65 @@
+from datetime import date
+
+from functions import EmailImageDownloader
+
+
+def test_shard_mode_is_opt_in(config):
+    assert EmailImageDownloader(config).get_shard_mode() is None
+    
+    config['processing']['shard_mode'] = 'week'
+    assert EmailImageDownloader(config).get_shard_mode() == 'week'
+    
+    config['processing']['shard_mode'] = 'year'
+    assert EmailImageDownloader(config).get_shard_mode() is None
+
+
+def test_build_date_shards_by_month_and_week(config):
+    downloader = EmailImageDownloader(config)
+    
+    assert downloader.build_date_shards(date(2024, 1, 15), date(2024, 3, 2), 'month') == [
+        (date(2024, 1, 15), date(2024, 1, 31)),
+        (date(2024, 2, 1), date(2024, 2, 29)),
+        (date(2024, 3, 1), date(2024, 3, 2)),
+    ]
+    # Ventanas de lunes a domingo; el 2024-01-03 es miércoles
+    assert downloader.build_date_shards(date(2024, 1, 3), date(2024, 1, 16), 'week') == [
+        (date(2024, 1, 3), date(2024, 1, 7)),
+        (date(2024, 1, 8), date(2024, 1, 14)),
+        (date(2024, 1, 15), date(2024, 1, 16)),
+    ]
+
+
+def test_open_first_shard_searches_only_before(config):
+    downloader = EmailImageDownloader(config)
+    
+    assert downloader.build_date_search_criteria(None, date(2024, 1, 31)) == 'BEFORE 01-Feb-2024'
+    assert downloader.build_date_search_criteria(date(2024, 1, 1), date(2024, 1, 31)) == 'SINCE 01-Jan-2024 BEFORE 01-Feb-2024'
+
+
+def test_checkpoints_live_under_base_folder(config, tmp_path):
+    downloader = EmailImageDownloader(config)
+    shard = (date(2024, 1, 1), date(2024, 1, 31))
+    
+    path = downloader.get_shard_checkpoint_path(shard)
+    
+    assert path.is_relative_to(tmp_path / 'descargas' / '.checkpoints')
+    assert path.name == 'shard_20240101_20240131.json'
+
+
+def test_completed_run_clears_its_checkpoints(config):
+    config['processing']['shard_mode'] = 'month'
+    downloader = EmailImageDownloader(config)
+    shard = (date(2024, 1, 1), date(2024, 1, 31))
+    downloader.save_shard_checkpoint(shard, {'total_emails': 3, 'valid_emails': 1, 'total_files': 2})
+    
+    assert downloader.load_shard_checkpoint(shard)['total_files'] == 2
+    
+    # Con una ventana fallida los checkpoints se conservan para reanudar
+    downloader.failed_shards = 1
+    downloader.clear_shard_checkpoints()
+    assert downloader.load_shard_checkpoint(shard) is not None
+    
+    downloader.failed_shards = 0
+    downloader.clear_shard_checkpoints()
+    assert downloader.load_shard_checkpoint(shard) is None
+    assert not downloader.get_shard_checkpoint_dir().exists()